@@ -54,7 +54,7 @@ def energyplot():
             KE = hdf["halo_kinetic_energies"][...]
             GE = hdf["halo_gravitational_energies"][...]
             m = hdf["nparts"][...] * pmass
-            reals = hdf["real_flag"][...]
+            reals = utilities.read_real_flags(inputs["haloSavePath"], str(snap), 0)
             total_KE.extend(KE[reals])
             total_GE.extend(GE[reals])
             mass.extend(m[reals])
@@ -65,7 +65,7 @@ def energyplot():
             KE = hdf["Subhalos"]["halo_kinetic_energies"][...]
             GE = hdf["Subhalos"]["halo_gravitational_energies"][...]
             m = hdf["Subhalos"]["nparts"][...] * pmass
-            reals = hdf["Subhalos"]["real_flag"][...]
+            reals = utilities.read_real_flags(inputs["haloSavePath"], str(snap), 1)
             total_KE.extend(KE[reals])
             total_GE.extend(GE[reals])
             mass.extend(m[reals])
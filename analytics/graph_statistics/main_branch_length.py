@@ -6,6 +6,9 @@ import warnings
 import h5py
 import time
 import pickle
+import sys
+sys.path.insert(1, 'core/')
+import utilities
 
 
 def mainbranchlengthDMLJ(tree_data, cutoff=None):
@@ -80,6 +83,31 @@ def mainbranchlengthDMLJ(tree_data, cutoff=None):
     return lengths
 
 
+def mainbranchlengthMEGA(treepath, snaplist, cutoff=None, density_rank=0):
+    """ A function that computes the main branch length of every real halo in the final snapshot
+    from the MEGA linking data, walking all main branches at once (see utilities.get_main_branches).
+
+    :param treepath: The filepath of the direct progenitor and descendant (Mgraph) files.
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param cutoff: The halo mass cutoff in number of particles. Halos under this mass threshold are skipped.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+
+    :return: lengths: An array of main branch lengths for all halos above the cutoff.
+             halo_masses: The mass of each of these halos.
+    """
+
+    roots, lengths, mass_history, last_merger = utilities.get_main_branches(treepath, snaplist, density_rank)
+
+    # Ignore halos with mass less than the cutoff if one is provided
+    halo_masses = mass_history[:, -1]
+    if cutoff != None:
+        okinds = halo_masses >= cutoff
+        lengths = lengths[okinds]
+        halo_masses = halo_masses[okinds]
+
+    return lengths, halo_masses
+
+
 def mainBranchLengthCompPlot(tree_data, SMTtreepath, cutoff=None):
     """ A function which walks the main branches of any algorithms with data in the supplied directory with the
     correct format (during this project this was SMT comparison project algorithms) and the main branches produced
@@ -0,0 +1,82 @@
+import numpy as np
+import time
+import sys
+from scipy.spatial import cKDTree
+sys.path.insert(1, 'core/')
+import fof
+
+
+def make_clustered_particles(npart, nclust, boxsize, seed=42):
+    """ A function to generate a synthetic clustered particle distribution. Half the particles are
+    placed in clusters with power law sizes and steep radial profiles and the rest are spread
+    uniformly through a periodic box.
+
+    :param npart: The number of particles.
+    :param nclust: The number of clusters.
+    :param boxsize: The length of the box along one axis.
+    :param seed: The random seed.
+    :return: The particle positions.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Draw the cluster sizes from a power law normalised to half the particles
+    weights = rng.pareto(1.0, nclust) + 1
+    sizes = np.floor(weights / weights.sum() * npart / 2).astype(int)
+
+    # Place each cluster's particles at radii concentrated towards the cluster centre
+    centres = np.repeat(rng.uniform(0, boxsize, (nclust, 3)), sizes, axis=0)
+    radii = np.repeat(0.1 * boxsize * (sizes / sizes.max()) ** (1 / 3), sizes)
+    dirs = rng.normal(size=(sizes.sum(), 3))
+    dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+    clust_pos = centres + dirs * (radii * rng.uniform(0, 1, sizes.sum()) ** 1.5)[:, None]
+
+    pos = np.concatenate([clust_pos, rng.uniform(0, boxsize, (npart - sizes.sum(), 3))])
+
+    return pos % boxsize
+
+
+def same_groups(labels1, labels2):
+    """ A function to test whether two labellings describe the same groups. """
+
+    okinds = labels1 >= 0
+    if not np.array_equal(okinds, labels2 >= 0):
+        return False
+    pairs = np.unique(np.column_stack([labels1[okinds], labels2[okinds]]), axis=0)
+
+    return np.unique(pairs[:, 0]).size == np.unique(pairs[:, 1]).size == pairs.shape[0]
+
+
+# Get the benchmark size from the command line
+npart = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 5
+nclust = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+boxsize = 100
+linkl = 0.2 * boxsize / npart ** (1 / 3)
+
+pos = make_clustered_particles(npart, nclust, boxsize)
+tree = cKDTree(pos, leafsize=16, compact_nodes=False, balanced_tree=False, boxsize=[boxsize, boxsize, boxsize])
+
+# The query is shared by every backend so only the grouping is timed
+query_start = time.time()
+query = tree.query_ball_point(pos, r=linkl, return_sorted=False)
+print("Query:", time.time() - query_start)
+
+backends = ['python', 'scipy']
+if fof.nb is not None:
+    backends.append('numba')
+
+    # Compile the union find before timing
+    fof.find_groups_query(query[:10], npart, backend='numba')
+
+results = {}
+for backend in backends:
+
+    start = time.time()
+    labels, groups = fof.find_groups_query(query, npart, backend=backend)
+    results[backend] = labels
+
+    print(backend + ":", time.time() - start, "seconds,", len(groups), "groups,",
+          sum(1 for group in groups.values() if len(group) >= 10), "with 10 or more particles")
+
+for backend in backends[1:]:
+    print(backend, "matches python:", same_groups(results['python'], results[backend]))
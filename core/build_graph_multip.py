@@ -1,15 +1,16 @@
 import numpy as np
 import h5py
 import multiprocessing
-from multiprocessing import Lock
 from functools import partial
 from guppy import hpy; hp = hpy()
-import pickle
-from utilities import get_linked_halo_data
+from utilities import get_linked_halo_data, read_mapped_dataset
 
 
-# Initialise lock object
-lock = Lock()
+# The linking data and the flags marking root halos already found in a graph. These are set in
+# main_get_graph_members before the worker pool is forked so every worker inherits them read only
+# (the found flags are shared memory and written by the workers) rather than each reloading them
+data_dict = None
+found_roots = None
 
 
 def get_graph(z0halo, snaplist, data_dict):
@@ -49,7 +50,6 @@ def get_graph(z0halo, snaplist, data_dict):
     # Loop until no new halos are found
     while len(new_halos) != 0:
 
-        print(count)
         count += 1
 
         # Overwrite the last set of new_halos
@@ -61,21 +61,22 @@ def get_graph(z0halo, snaplist, data_dict):
         for prog_snap, snap in zip(snaplist[1:], snaplist[:-1]):
 
             # Assign the halos variable for the next stage of the tree
-            halos = graph_dict[snap]
+            halos = graph_dict.get(snap, set())
 
             # Loop over halos in this snapshot
             for halo in halos:
 
                 # Get the progenitors
-                these_progs = get_linked_halo_data(data_dict['progs'], data_dict['prog_start_index'][halo[0]],
-                                                   data_dict['nprogs'][halo[0]])
+                these_progs = get_linked_halo_data(data_dict['progs'][snap],
+                                                   data_dict['prog_start_index'][snap][halo[0]],
+                                                   data_dict['nprogs'][snap][halo[0]])
 
                 # Assign progenitors using a tuple to keep track of the snapshot ID
                 # in addition to the halo ID
                 graph_dict.setdefault(prog_snap, set()).update({(p, prog_snap) for p in these_progs})
 
             # Add any new halos not found in found halos to the new halos set
-            new_halos.update(graph_dict[prog_snap] - found_halos)
+            new_halos.update(graph_dict.get(prog_snap, set()) - found_halos)
 
         # =============== Descendants ===============
 
@@ -90,15 +91,16 @@ def get_graph(z0halo, snaplist, data_dict):
             for halo in halos:
 
                 # Get the descendants
-                these_descs = get_linked_halo_data(data_dict['descs'], data_dict['desc_start_index'][halo[0]],
-                                                   data_dict['ndescs'][halo[0]])
+                these_descs = get_linked_halo_data(data_dict['descs'][snap],
+                                                   data_dict['desc_start_index'][snap][halo[0]],
+                                                   data_dict['ndescs'][snap][halo[0]])
 
                 # Load descendants adding the snapshot * 100000 to keep track of the snapshot ID
                 # in addition to the halo ID
                 graph_dict.setdefault(desc_snap, set()).update({(d, desc_snap) for d in these_descs})
 
             # Redefine the new halos set to have any new halos not found in found halos
-            new_halos.update(graph_dict[desc_snap] - found_halos)
+            new_halos.update(graph_dict.get(desc_snap, set()) - found_halos)
 
         # Add the new_halos to the found halos set
         found_halos.update(new_halos)
@@ -113,7 +115,7 @@ def get_graph(z0halo, snaplist, data_dict):
         graph_dict[snap] = np.array([int(halo[0]) for halo in graph_dict[snap]])
 
         # Get the halo masses
-        mass_dict[snap] = data_dict['nparts'][graph_dict[snap]]
+        mass_dict[snap] = data_dict['nparts'][snap][graph_dict[snap]]
 
         # Sort by mass
         sinds = np.argsort(mass_dict[snap])[::-1]
@@ -124,16 +126,17 @@ def get_graph(z0halo, snaplist, data_dict):
 
 
 def graph_worker(root_halo, snaplist, verbose):
+    """ A function to get the graph of a root halo using the linking data inherited from the parent
+    process. Roots already found in another graph are skipped.
+
+    :param root_halo: The ID of the root halo.
+    :param snaplist: The list of snapshot IDs in descending time order (present to past).
+    :param verbose: Flag for verbose output.
+    :return: The graph and mass dictionaries of the graph (an empty dictionary if the root was
+             already found).
+    """
 
-    lock.acquire()
-    with open('utilityfiles/roothalos.pck', 'rb') as pfile:
-        roots = pickle.load(pfile)
-        if verbose:
-            print(len(roots) - 1, 'Roots')
-    with open('utilityfiles/link_datadict.pck', 'rb') as pfile:
-        data_dict = pickle.load(pfile)
-    lock.release()
-    if int(root_halo) in roots:
+    if found_roots[root_halo]:
         if verbose:
             print('Halo ' + str(root_halo) + '\'s Forest exists...')
         return {}
@@ -141,23 +144,27 @@ def graph_worker(root_halo, snaplist, verbose):
     # Get the graph with this halo at it's root
     graph_dict, mass_dict = get_graph(root_halo, snaplist, data_dict)
 
-    print('Halo ' + str(root_halo) + '\'s Forest extracted...')
+    if verbose:
+        print('Halo ' + str(root_halo) + '\'s Forest extracted...')
 
-    lock.acquire()
-    with open('utilityfiles/roothalos.pck', 'rb') as file:
-        roots = pickle.load(file)
-    for root in graph_dict['061']:
-        roots.update([root])
-    with open('utilityfiles/roothalos.pck', 'wb') as file:
-        pickle.dump(roots, file)
-    lock.release()
+    # Flag every root in this graph as found, two workers walking the same graph at once only
+    # waste work since the writer skips repeated graphs
+    for root in graph_dict[snaplist[0]]:
+        found_roots[root] = 1
 
     return graph_dict, mass_dict
 
 
 def graph_writer(graphs, graphpath, snaplist, verbose):
-
-    # Reverse the snapshot list such that the present day is the first element
+    """ A function to write graphs to file as they are produced.
+
+    :param graphs: An iterable of (graph_dict, mass_dict) tuples, e.g. the results of a worker pool
+                   consumed as they complete.
+    :param graphpath: The filepath and basename for the graph file.
+    :param snaplist: The list of snapshot IDs in descending time order (present to past).
+    :param verbose: Flag for verbose output.
+    :return: None
+    """
 
     hdf = h5py.File(graphpath + '.hdf5', 'w')
 
@@ -190,10 +197,10 @@ def graph_writer(graphs, graphpath, snaplist, verbose):
 
         graph = hdf.create_group(str(root_halo))  # create halo group
 
-        for snap in range(snaplist):
+        for snap in range(len(snaplist)):
 
             # Extract this generation
-            this_gen = graph_dict.pop(snaplist[snap])
+            this_gen = graph_dict.pop(snaplist[snap], [])
 
             if len(this_gen) == 0:
                 continue
@@ -208,12 +215,26 @@ def graph_writer(graphs, graphpath, snaplist, verbose):
 
         # IDs in this generation of this graph
         graph.create_dataset('halo_ids', data=np.array(this_graph), dtype=int, compression='gzip')
-        graph.create_dataset('generation_length', data=np.array(this_graph), dtype=int, compression='gzip')
+        graph.create_dataset('generation_start_index', data=generation_start_index, dtype=int, compression='gzip')
+        graph.create_dataset('generation_length', data=generation_length, dtype=int, compression='gzip')
 
     hdf.close()
 
 
-def main_get_graph_members(treepath, graphpath, snaplist, density_rank, verbose):
+def main_get_graph_members(treepath, graphpath, snaplist, density_rank, verbose, nprocs=None, chunksize=16):
+    """ A function to build the graph of every real root halo with a pool of worker processes.
+
+    :param treepath: The filepath of the direct progenitor and descendant (Mgraph) files.
+    :param graphpath: The filepath and basename for the graph file.
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param verbose: Flag for verbose output.
+    :param nprocs: The number of worker processes (defaults to all but two CPUs).
+    :param chunksize: The number of roots sent to a worker at once.
+    :return: None
+    """
+
+    global data_dict, found_roots
 
     # Get the root snapshot
     snaplist.reverse()
@@ -253,35 +274,36 @@ def main_get_graph_members(treepath, graphpath, snaplist, density_rank, verbose)
 
             hdf = h5py.File(treepath + 'SubMgraph_' + snap + '.hdf5', 'r')
 
-        # Assign
-        progs[snap] = hdf['Prog_haloIDs'][...]
-        descs[snap] = hdf['Desc_haloIDs'][...]
-        nprogs[snap] = hdf['nProgs'][...]
-        ndescs[snap] = hdf['nDescs'][...]
-        prog_start_index[snap] = hdf['prog_start_index'][...]
-        desc_start_index[snap] = hdf['desc_start_index'][...]
-        nparts[snap] = hdf['nparts'][...]
+        # Assign (memory mapping where the file allows it)
+        progs[snap] = read_mapped_dataset(hdf['Prog_haloIDs'])
+        descs[snap] = read_mapped_dataset(hdf['Desc_haloIDs'])
+        nprogs[snap] = read_mapped_dataset(hdf['nProgs'])
+        ndescs[snap] = read_mapped_dataset(hdf['nDescs'])
+        prog_start_index[snap] = read_mapped_dataset(hdf['prog_start_index'])
+        desc_start_index[snap] = read_mapped_dataset(hdf['desc_start_index'])
+        nparts[snap] = read_mapped_dataset(hdf['nparts'])
 
         hdf.close()
 
     data_dict = {'progs': progs, 'descs': descs, 'nprogs': nprogs, 'ndescs': ndescs,
                  'prog_start_index': prog_start_index, 'desc_start_index': desc_start_index, 'nparts': nparts}
 
-    with open('utilityfiles/link_datadict.pck', 'wb') as file:
-        pickle.dump(data_dict, file)
-
-    roots = {-999}
-
-    with open('utilityfiles/roothalos.pck', 'wb') as file:
-        pickle.dump(roots, file)
+    # Shared flags marking the roots already found in a graph
+    found_roots = multiprocessing.RawArray('b', len(halo_ids))
 
     # Extract only the real roots
     roots = halo_ids[reals]
 
-    p = multiprocessing.Pool(processes=multiprocessing.cpu_count() - 2)
-    graphs = p.map(partial(graph_worker, snaplist=snaplist, verbose=verbose), iter(roots))
-    p.close()
-    p.join()
+    if nprocs is None:
+        nprocs = max(multiprocessing.cpu_count() - 2, 1)
 
-    # Write out the result
+    # Fork the workers after the globals are set so they inherit the linking data without copying
+    p = multiprocessing.get_context('fork').Pool(processes=nprocs)
+    graphs = p.imap_unordered(partial(graph_worker, snaplist=snaplist, verbose=verbose), iter(roots),
+                              chunksize=chunksize)
+
+    # Write out the graphs as they are completed
     graph_writer(graphs, graphpath, snaplist, verbose)
+
+    p.close()
+    p.join()
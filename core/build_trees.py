@@ -0,0 +1,221 @@
+import numpy as np
+import multiprocessing
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import graph_io
+import utilities
+
+
+# The columns of the graph file. These are set in main_get_trees before the worker pool is forked
+# so every worker inherits the memory mapped graphs rather than each reopening the file
+graph_columns = None
+
+NO_DATA = 2 ** 30
+
+# The halo datasets copied from the graph to the trees, the linking datasets are rebuilt from the
+# main descendant links and trees carry no subhalos
+TREE_HALO_KEYS = [key for key in graph_io.HALO_KEYS
+                  if key not in ['nprog', 'ndesc', 'prog_start_index', 'desc_start_index',
+                                 'subhalo_start_index', 'nsubhalos']]
+
+# The datasets with an entry per tree whose start indices are shifted when concatenating forests
+TREE_START_KEYS = {'graph_start_index': 'halo_catalog_halo_ids', 'graph_prog_start_index': 'direct_prog_ids',
+                   'graph_desc_start_index': 'direct_desc_ids'}
+
+
+def get_forest_trees(graph):
+    """ A function to split a graph into trees. Only the main descendant (the descendant receiving the
+    most particles) of each halo is kept, the trees are then the connected components of the graph
+    and the graph itself is their forest. Progenitor links are kept where the progenitor's main
+    descendant is the halo.
+
+    :param graph: The MergerGraph of the forest.
+    :return: A dictionary of the trees' columns in the graph file layout (see graph_io) with an entry
+             per tree in the per graph datasets. The start indices of the trees are relative to the
+             start of the forest.
+    """
+
+    nhalo = graph.nhalos
+    nsnap = graph.generation_length.size
+    halos = np.arange(nhalo)
+    main_descs = graph.get_main_descs()
+
+    # Label the trees as the connected components of the main descendant links
+    okinds = main_descs >= 0
+    adj = coo_matrix((np.ones(np.count_nonzero(okinds), dtype=np.int8), (halos[okinds], main_descs[okinds])),
+                     shape=(nhalo, nhalo))
+    ntree, labels = connected_components(adj, directed=False)
+
+    # Each tree has a single root (the halo without a main descendant), order the trees by decreasing
+    # root mass and their halos by generation and decreasing mass
+    nparts = np.asarray(graph['nparts'], dtype=np.int64)
+    roots = halos[~okinds]
+    root_nparts = np.zeros(ntree, dtype=np.int64)
+    root_nparts[labels[roots]] = nparts[roots]
+    tree_order = np.argsort(-root_nparts, kind='stable')
+    tree_rank = np.empty(ntree, dtype=np.int64)
+    tree_rank[tree_order] = np.arange(ntree)
+
+    halo_tree = tree_rank[labels]
+    order = np.lexsort((-nparts, graph.halo_generation, halo_tree))
+    inv = np.empty(nhalo, dtype=np.int64)
+    inv[order] = np.arange(nhalo)
+    halo_tree = halo_tree[order]
+
+    nhalos_in_graph = np.bincount(halo_tree, minlength=ntree)
+    graph_start_index = np.cumsum(nhalos_in_graph) - nhalos_in_graph
+
+    trees = {key: np.asarray(graph[key])[order] for key in TREE_HALO_KEYS}
+    trees['nhalos_in_graph'] = nhalos_in_graph
+    trees['graph_start_index'] = graph_start_index
+    trees['root_nparts'] = root_nparts[tree_order]
+
+    # Keep the tree links, their order within each halo (by contribution) is unchanged
+    for link, get_linked in [('prog', graph.get_progs), ('desc', graph.get_descs)]:
+
+        link_halos, linked, conts = get_linked(halos)
+        if link == 'prog':
+            okinds = main_descs[linked] == link_halos
+        else:
+            okinds = linked == main_descs[link_halos]
+        link_halos = inv[link_halos[okinds]]
+        sinds = np.argsort(link_halos, kind='stable')
+        link_halos = link_halos[sinds]
+
+        nlinks = np.bincount(link_halos, minlength=nhalo)
+        link_start = np.cumsum(nlinks) - nlinks
+        graph_nlinks = np.bincount(halo_tree, weights=nlinks, minlength=ntree).astype(np.int64)
+        graph_link_start = np.cumsum(graph_nlinks) - graph_nlinks
+
+        # Keep the no adjacent snapshot flag (-1) of halos at either end of the snapshots
+        prev_nlinks = np.asarray(graph['n' + link])[order]
+        trees['n' + link] = np.where(prev_nlinks < 0, prev_nlinks, nlinks)
+        trees[link + '_start_index'] = np.where(nlinks > 0, link_start - graph_link_start[halo_tree], NO_DATA)
+        trees['direct_' + link + '_ids'] = (inv[linked[okinds][sinds]]
+                                            - graph_start_index[halo_tree[link_halos]])
+        trees['direct_' + link + '_contribution'] = conts[okinds][sinds]
+        trees['graph_' + link + '_start_index'] = graph_link_start
+        trees['graph_n' + link + '_links'] = graph_nlinks
+
+    # Get the generation tables of each tree
+    halo_gen = graph.halo_generation[order]
+    gen_keys = halo_tree * nsnap + halo_gen
+    generation_length = np.bincount(gen_keys, minlength=ntree * nsnap).reshape((ntree, nsnap))
+    generation_start_index = np.full(ntree * nsnap, NO_DATA, dtype=np.int64)
+    ugen_keys, first = np.unique(gen_keys, return_index=True)
+    generation_start_index[ugen_keys] = first - graph_start_index[halo_tree[first]]
+
+    trees['graph_lengths'] = np.count_nonzero(generation_length, axis=1)
+    trees['generation_start_index'] = generation_start_index.reshape((ntree, nsnap))
+    trees['generation_length'] = np.where(generation_length > 0, generation_length, NO_DATA)
+    trees['generation_id'] = np.where(generation_length > 0, np.arange(nsnap), NO_DATA)
+
+    return trees
+
+
+def forest_worker(forest_id):
+    """ A function to get the trees of a single forest from the graph columns inherited from the
+    parent process.
+
+    :param forest_id: The ID of the forest's graph in the graph file.
+    :return: The forest ID and its trees from get_forest_trees.
+    """
+
+    graph = graph_io.MergerGraph(graph_io.get_graph_view(graph_columns, forest_id))
+
+    trees = get_forest_trees(graph)
+    trees['forest_id'] = np.full(len(trees['nhalos_in_graph']), forest_id, dtype=np.int64)
+
+    return forest_id, trees
+
+
+def concatenate_forests(forests, nsnap):
+    """ A function to concatenate the trees of many forests, shifting each forest's tree start
+    indices by the size of the forests before it.
+
+    :param forests: A list of tree dictionaries from forest_worker.
+    :param nsnap: The number of snapshots (the width of the generation tables).
+    :return: A dictionary of the concatenated tree columns.
+    """
+
+    keys = (TREE_HALO_KEYS + ['nprog', 'ndesc', 'prog_start_index', 'desc_start_index']
+            + graph_io.PROG_KEYS + graph_io.DESC_KEYS + graph_io.GRAPH_KEYS + ['forest_id'])
+
+    columns = {}
+    for key in keys:
+
+        arrs = [trees[key] for trees in forests]
+        if key in TREE_START_KEYS:
+            sizes = np.array([len(trees[TREE_START_KEYS[key]]) for trees in forests], dtype=np.int64)
+            arrs = [arr + shift for arr, shift in zip(arrs, np.cumsum(sizes) - sizes)]
+
+        if len(arrs) == 0:
+            if key in graph_io.GRAPH_KEYS[-3:]:
+                shape = (0, nsnap)
+            elif key in ['mean_pos', 'mean_vel']:
+                shape = (0, 3)
+            else:
+                shape = (0,)
+            arrs.append(np.zeros(shape, dtype=graph_io.DTYPES.get(key, np.int32)))
+
+        columns[key] = np.concatenate(arrs)
+
+    return columns
+
+
+def main_get_trees(graphpath, treepath, comm=None, nprocs=None, chunksize=1):
+    """ A function to derive the merger trees from the graph file. Every graph (forest) is split into
+    trees by keeping only the main descendant links. Forests are distributed across MPI ranks and
+    then across a pool of worker processes on each rank, weighted by their number of halos, and the
+    trees are written in the graph file layout with the forest of each tree in "forest_id".
+
+    :param graphpath: The filepath and basename of the graph file.
+    :param treepath: The filepath and basename for the tree file.
+    :param comm: The MPI communicator (None when running from a single process).
+    :param nprocs: The number of worker processes on each rank (defaults to all but two CPUs),
+                   1 processes the forests without a pool.
+    :param chunksize: The number of forests sent to a worker at once.
+    :return: None
+    """
+
+    global graph_columns
+
+    if comm is None:
+        rank, size = 0, 1
+    else:
+        rank, size = comm.rank, comm.size
+
+    graph_columns, header = graph_io.read_graph_file(graphpath)
+    nsnap = graph_columns['generation_length'].shape[1]
+
+    # Get the forests, graphs replaced by a merged graph are skipped
+    ngraph = len(graph_columns['nhalos_in_graph'])
+    if 'superseded' in graph_columns:
+        forests = np.where(~np.asarray(graph_columns['superseded'], dtype=bool))[0]
+    else:
+        forests = np.arange(ngraph)
+
+    # Distribute the forests across ranks balancing the number of halos, each rank's forests are
+    # given most expensive first so the pool finishes with the cheapest
+    rank_inds, load = utilities.assign_costs(graph_columns['nhalos_in_graph'][forests], size)
+    myforests = forests[np.array(rank_inds[rank], dtype=np.int64)]
+
+    print("Rank", rank, "has", myforests.size, "forests containing", load[rank], "halos")
+
+    if nprocs is None:
+        nprocs = max(multiprocessing.cpu_count() - 2, 1)
+
+    # Fork the workers after the graph columns are set so they inherit them without copying
+    if nprocs == 1:
+        results = list(map(forest_worker, myforests))
+    else:
+        p = multiprocessing.get_context('fork').Pool(processes=nprocs)
+        results = list(p.imap_unordered(forest_worker, myforests, chunksize=chunksize))
+        p.close()
+        p.join()
+
+    # Write the trees in forest order
+    results.sort(key=lambda result: result[0])
+    columns = concatenate_forests([trees for _, trees in results], nsnap)
+
+    graph_io.write_graph_file(treepath, columns, header, comm)
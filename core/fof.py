@@ -0,0 +1,409 @@
+import itertools
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# numba is optional, without it the groups are found with scipy's connected components
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+
+# ===== Neighbour lists =====
+
+def query_to_csr(query):
+    """ A function to flatten the neighbour lists returned by cKDTree.query_ball_point into
+    compressed sparse row form (the neighbours of query point i are indices[indptr[i]: indptr[i + 1]]).
+
+    :param query: The list of neighbour lists (query_ball_point with return_sorted=False).
+    :return: indptr: The start of each query point's neighbours (with the total appended).
+             indices: The neighbour indices.
+    """
+
+    lengths = np.fromiter(map(len, query), dtype=np.int64, count=len(query))
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    indices = np.fromiter(itertools.chain.from_iterable(query), dtype=np.int64, count=indptr[-1])
+
+    return indptr, indices
+
+
+def csr_to_edges(indptr, indices):
+    """ A function to convert neighbour lists to edges. Every neighbour in a list is linked to
+    the first entry of the list, which is enough to connect them all.
+
+    :param indptr: The start of each query point's neighbours (with the total appended).
+    :param indices: The neighbour indices.
+    :return: The two ends of each edge.
+    """
+
+    lengths = np.diff(indptr)
+    okinds = lengths > 0
+
+    return np.repeat(indices[indptr[:-1][okinds]], lengths[okinds]), indices
+
+
+def get_tree_pairs(tree, inds, r, boxsize=None):
+    """ A function to get the pairs of particles within a linking length from an existing tree.
+    The particles must be a closed group at a linking length of at least r (e.g. a friends of
+    friends halo found with the same tree) so every neighbour is one of the particles.
+
+    :param tree: The cKDTree containing the particles.
+    :param inds: The sorted indices of the particles in the tree.
+    :param r: The linking length.
+    :param boxsize: The length of the box along one axis if the tree is periodic.
+    :return: pairs: The (npair, 2) array of linked pairs (as indices into inds).
+             dists: The separation of each pair.
+    """
+
+    pos = tree.data[inds]
+
+    # Get the neighbours in the group's own indices, each pair is kept once
+    indptr, indices = query_to_csr(tree.query_ball_point(pos, r=r, return_sorted=False))
+    rows = np.repeat(np.arange(inds.size), np.diff(indptr))
+    cols = np.searchsorted(inds, indices)
+    okinds = np.logical_and(cols < inds.size, rows < cols)
+    okinds[okinds] = inds[cols[okinds]] == indices[okinds]
+    pairs = np.column_stack([rows[okinds], cols[okinds]])
+
+    # Compute the separations (with the nearest periodic image)
+    sep = pos[pairs[:, 1]] - pos[pairs[:, 0]]
+    if boxsize is not None:
+        sep -= boxsize * np.round(sep / boxsize)
+
+    return pairs, np.linalg.norm(sep, axis=1)
+
+
+def get_subset_pairs(pairs, dists, nnode, inds):
+    """ A function to get the pairs linking a subset of the particles.
+
+    :param pairs: The (npair, 2) array of linked pairs.
+    :param dists: The separation of each pair.
+    :param nnode: The number of particles the pairs index.
+    :param inds: The indices of the subset.
+    :return: The pairs with both ends in the subset (as indices into inds) and their separations.
+    """
+
+    local = np.full(nnode, -1, dtype=np.int64)
+    local[inds] = np.arange(len(inds))
+    pairs = local[pairs]
+    okinds = np.all(pairs >= 0, axis=1)
+
+    return pairs[okinds], dists[okinds]
+
+
+# ===== Group finding backends =====
+
+if nb is not None:
+
+    @nb.njit(nogil=True, cache=True)
+    def _union_find(parent, rows, cols):
+        """ Link the nodes of every edge with a union find (union by lower root, path halving),
+        starting from the existing links in parent, and return each node's root. """
+
+        nnode = parent.size
+
+        for ind in range(rows.size):
+
+            # Find the roots of both ends
+            i = rows[ind]
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            j = cols[ind]
+            while parent[j] != j:
+                parent[j] = parent[parent[j]]
+                j = parent[j]
+
+            # Join the trees under the lower root
+            if i < j:
+                parent[j] = i
+            elif j < i:
+                parent[i] = j
+
+        # Flatten every node onto its root
+        for i in range(nnode):
+            parent[i] = parent[parent[i]]
+
+        return parent
+
+
+def get_roots_numba(nnode, rows, cols, roots=None):
+    """ A function to find the root (lowest index member) of each node's group with the numba
+    compiled union find.
+
+    :param nnode: The number of nodes.
+    :param rows: The first end of each edge.
+    :param cols: The second end of each edge.
+    :param roots: The roots from linking a previous set of edges, which are kept.
+    :return: The root of each node.
+    """
+
+    if roots is None:
+        parent = np.arange(nnode)
+    else:
+        parent = np.array(roots, dtype=np.int64)
+
+    return _union_find(parent, np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+
+
+def get_roots_scipy(nnode, rows, cols, roots=None):
+    """ A function to find the root (lowest index member) of each node's group from the connected
+    components of the sparse adjacency matrix.
+
+    :param nnode: The number of nodes.
+    :param rows: The first end of each edge.
+    :param cols: The second end of each edge.
+    :param roots: The roots from linking a previous set of edges, which are kept.
+    :return: The root of each node.
+    """
+
+    # Previous groups are kept by linking each node to its root
+    if roots is not None:
+        rows = np.concatenate([rows, np.arange(nnode)])
+        cols = np.concatenate([cols, roots])
+
+    adj = coo_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)), shape=(nnode, nnode))
+    ncomp, comps = connected_components(adj, directed=False)
+
+    roots = np.full(ncomp, nnode, dtype=np.int64)
+    np.minimum.at(roots, comps, np.arange(nnode))
+
+    return roots[comps]
+
+
+def get_labels_python(query, nnode):
+    """ A function to group particles by looping over the neighbour lists in Python, combining
+    halos with a dictionary of linked halo IDs (the original halo finder loop, kept for reference
+    and benchmarking).
+
+    :param query: The list of neighbour lists.
+    :param nnode: The number of nodes.
+    :return: The halo ID of each node as returned by get_fof_labels.
+    """
+
+    part_haloids = np.full(nnode, -1, dtype=np.int64)
+    linked_halos_dict = {}
+    ihaloid = -1
+
+    for query_part_inds in iter(query):
+
+        query_part_inds = np.array(query_part_inds, dtype=int)
+
+        # Find only the particles not already in a halo
+        new_parts = query_part_inds[np.where(part_haloids[query_part_inds] < 0)]
+
+        # If only one particle is returned by the query and it is new it is a 'single particle halo'
+        if new_parts.size == query_part_inds.size == 1:
+            part_haloids[new_parts] = -2
+
+        # If all particles are new increment the halo ID and assign a new halo
+        elif new_parts.size == query_part_inds.size:
+            ihaloid += 1
+            part_haloids[new_parts] = ihaloid
+            linked_halos_dict[ihaloid] = {ihaloid}
+
+        else:
+
+            # Combine every halo linked to the halos returned by the query
+            uni_cont_halos = np.unique(part_haloids[query_part_inds])
+            uni_cont_halos = uni_cont_halos[uni_cont_halos >= 0]
+            linked_halos = set().union(*[linked_halos_dict[halo] for halo in uni_cont_halos])
+            linked_halos_dict.update(dict.fromkeys(linked_halos, linked_halos))
+
+            part_haloids[new_parts] = min(linked_halos)
+
+    # Reassign all halos to their final halo ID and relabel them in the same order as get_fof_labels
+    okinds = part_haloids >= 0
+    final_ids = np.array([min(linked_halos_dict[halo]) for halo in range(ihaloid + 1)], dtype=np.int64)
+    part_haloids[okinds] = final_ids[part_haloids[okinds]]
+
+    return relabel_roots(part_haloids, okinds)
+
+
+def relabel_roots(roots, okinds):
+    """ A function to give each group a consecutive ID in order of its lowest index member.
+
+    :param roots: The group root (or any group identifier) of each node.
+    :param okinds: Flags for the nodes in a group, all other entries are returned unchanged.
+    :return: The group IDs.
+    """
+
+    labels = np.array(roots, dtype=np.int64)
+    first = np.unique(roots[okinds], return_index=True)[1]
+    lut_keys = roots[okinds][np.sort(first)]
+    sinds = np.argsort(lut_keys)
+    labels[okinds] = sinds[np.searchsorted(lut_keys[sinds], roots[okinds])]
+
+    return labels
+
+
+def get_roots(nnode, rows, cols, roots=None, backend=None):
+    """ A function to find the root (lowest index member) of each node's group with the chosen
+    backend.
+
+    :param nnode: The number of nodes.
+    :param rows: The first end of each edge.
+    :param cols: The second end of each edge.
+    :param roots: The roots from linking a previous set of edges, which are kept.
+    :param backend: "numba" or "scipy" (defaults to numba when it is available).
+    :return: The root of each node.
+    """
+
+    if backend is None:
+        backend = 'numba' if nb is not None else 'scipy'
+
+    if backend == 'numba':
+        return get_roots_numba(nnode, rows, cols, roots)
+    else:
+        return get_roots_scipy(nnode, rows, cols, roots)
+
+
+def roots_to_labels(roots, touched=None):
+    """ A function to convert group roots to group IDs (see get_fof_labels).
+
+    :param roots: The root of each node.
+    :param touched: Flags for the nodes which were queried or returned by a query (defaults to every
+                    node), untouched nodes are given -1.
+    :return: The group ID of each node.
+    """
+
+    # Nodes alone in their group are single particle halos
+    sizes = np.bincount(roots, minlength=roots.size)
+    okinds = sizes[roots] > 1
+    labels = relabel_roots(roots, okinds)
+    labels[~okinds] = -2
+
+    if touched is not None:
+        labels[~touched] = -1
+
+    return labels
+
+
+def get_fof_labels(nnode, rows, cols, touched=None, backend=None):
+    """ A function to assign every node to its friends of friends group, the connected components of
+    the graph of edges between linked nodes.
+
+    :param nnode: The number of nodes.
+    :param rows: The first end of each edge (self edges are allowed).
+    :param cols: The second end of each edge.
+    :param touched: Flags for the nodes which were queried or returned by a query (defaults to every
+                    node), untouched nodes are given -1.
+    :param backend: "numba" or "scipy" (defaults to numba when it is available).
+    :return: The group ID of each node, consecutive from 0 in order of each group's lowest index
+             member. Nodes with no neighbours other than themselves are given -2.
+    """
+
+    roots = get_roots(nnode, rows, cols, backend=backend)
+
+    return roots_to_labels(roots, touched)
+
+
+def get_fof_groups(labels):
+    """ A function to get the members of each group.
+
+    :param labels: The group ID of each node from get_fof_labels.
+    :return: A dictionary of the member indices of each group keyed by group ID.
+    """
+
+    okinds = np.where(labels >= 0)[0]
+    okinds = okinds[np.argsort(labels[okinds], kind='stable')]
+    groups, starts = np.unique(labels[okinds], return_index=True)
+
+    return dict(zip(groups, np.split(okinds, starts[1:]))) if groups.size > 0 else {}
+
+
+def find_groups_query(query, nnode, backend=None):
+    """ A function to find the friends of friends groups from cKDTree.query_ball_point neighbour
+    lists, where the tree may hold more particles than were queried.
+
+    :param query: The list of neighbour lists.
+    :param nnode: The number of particles in the tree.
+    :param backend: "numba", "scipy" or "python" (the original loop).
+    :return: The group ID of each particle (-1 for particles in no list, -2 for particles with no
+             neighbours) and a dictionary of the particles in each group keyed by group ID.
+    """
+
+    if backend == 'python':
+        labels = get_labels_python(query, nnode)
+    else:
+        indptr, indices = query_to_csr(query)
+        touched = np.zeros(nnode, dtype=bool)
+        touched[indices] = True
+        rows, cols = csr_to_edges(indptr, indices)
+        labels = get_fof_labels(nnode, rows, cols, touched, backend)
+
+    return labels, get_fof_groups(labels)
+
+
+def find_groups_tree(tree, r, backend=None):
+    """ A function to find the friends of friends groups of every particle in a tree from its pairs
+    within the linking length.
+
+    :param tree: The cKDTree of the particles.
+    :param r: The linking length (in the tree's coordinates).
+    :param backend: "numba", "scipy" or "python" (the original loop).
+    :return: The group ID of each particle (-2 for particles with no neighbours) and a dictionary of
+             the particles in each group keyed by group ID.
+    """
+
+    if backend == 'python':
+        return find_groups_query(tree.query_ball_point(tree.data, r=r), tree.n, backend)
+
+    pairs = tree.query_pairs(r=r, output_type='ndarray')
+    labels = get_fof_labels(tree.n, pairs[:, 0], pairs[:, 1], backend=backend)
+
+    return labels, get_fof_groups(labels)
+
+
+def find_groups_pairs(nnode, pairs, dists, r, backend=None):
+    """ A function to find the friends of friends groups at a linking length from pairs found at a
+    longer linking length, without building or querying a tree.
+
+    :param nnode: The number of particles.
+    :param pairs: The (npair, 2) array of linked pairs.
+    :param dists: The separation of each pair.
+    :param r: The linking length (no longer than the one used to find the pairs).
+    :param backend: "numba" or "scipy".
+    :return: The group ID of each particle (-2 for particles with no neighbours) and a dictionary of
+             the particles in each group keyed by group ID.
+    """
+
+    okinds = dists <= r
+    labels = get_fof_labels(nnode, pairs[okinds, 0], pairs[okinds, 1], backend=backend)
+
+    return labels, get_fof_groups(labels)
+
+
+def find_groups_hierarchy(nnode, pairs, dists, rs, backend=None):
+    """ A function to find the nested friends of friends groups at several linking lengths in a
+    single pass. The pairs are sorted by separation once and linked in order (single linkage), the
+    groups at each linking length are the union find state once every shorter pair is linked, so
+    each level only links the pairs between its linking length and the previous one.
+
+    :param nnode: The number of particles.
+    :param pairs: The (npair, 2) array of linked pairs.
+    :param dists: The separation of each pair.
+    :param rs: The linking lengths (none longer than the one used to find the pairs).
+    :param backend: "numba" or "scipy".
+    :return: A list containing the group IDs and group dictionary (as returned by find_groups_pairs)
+             at each linking length, in the order of rs.
+    """
+
+    sinds = np.argsort(dists, kind='stable')
+    pairs = pairs[sinds]
+    dists = dists[sinds]
+
+    # Sweep the linking lengths from shortest to longest
+    levels = [None] * len(rs)
+    roots = None
+    start = 0
+    for ind in np.argsort(rs):
+        end = np.searchsorted(dists, rs[ind], side='right')
+        roots = get_roots(nnode, pairs[start:end, 0], pairs[start:end, 1], roots, backend)
+        start = end
+
+        labels = roots_to_labels(roots)
+        levels[ind] = (labels, get_fof_groups(labels))
+
+    return levels
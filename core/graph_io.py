@@ -0,0 +1,655 @@
+import h5py
+import numpy as np
+import utilities
+
+
+# ===== Graph file layout =====
+# Every halo of every graph is stored in flat datasets sorted by graph and then generation, the
+# halos of a graph are found with graph_start_index and nhalos_in_graph and their links with
+# graph_prog_start_index and graph_desc_start_index (and the link counts). Within a graph progenitor and descendant IDs,
+# their start indices and the generation start indices are relative to the start of the graph.
+# Subhalos use the same layout with a "sub_" prefix (with the exception of their catalogue IDs,
+# stored in "subhalo_catalog_halo_ids", and the index of their host in "host_halos"), the subhalos
+# of a host graph are those of the same graph ID.
+# Graphs extended with a new snapshot by update_graph store the new halos and links in extension
+# segments appended to the datasets. A graph's last extension is given by graph_extension_index and
+# each extension points to the one before it, the halos (and links) of an extended graph are its base
+# segment followed by its extensions. Graphs replaced by a merged graph are flagged as superseded.
+# Tree files (build_trees) use the host halo part of this layout with an entry per tree in the per
+# graph datasets, the graph each tree was cut from (its forest) is stored in "forest_id".
+
+# Datasets with an entry per halo
+HALO_KEYS = ['halo_catalog_halo_ids', 'snapshots', 'redshifts', 'nparts', 'mean_pos', 'mean_vel',
+             'rms_radius', '3D_velocity_dispersion', 'v_max', 'half_mass_radius', 'half_mass_velocity_radius',
+             'nprog', 'ndesc', 'prog_start_index', 'desc_start_index', 'subhalo_start_index', 'nsubhalos']
+SUB_HALO_KEYS = (['subhalo_catalog_halo_ids', 'host_halos']
+                 + ['sub_' + key for key in HALO_KEYS[1: -2]])
+
+# Datasets with an entry per progenitor and descendant link
+PROG_KEYS = ['direct_prog_ids', 'direct_prog_contribution']
+DESC_KEYS = ['direct_desc_ids', 'direct_desc_contribution']
+
+# Datasets with an entry (or a row of an entry per generation) per graph
+GRAPH_KEYS = ['graph_start_index', 'nhalos_in_graph', 'graph_prog_start_index', 'graph_nprog_links',
+              'graph_desc_start_index', 'graph_ndesc_links', 'graph_lengths', 'root_nparts',
+              'generation_start_index', 'generation_length', 'generation_id']
+
+# Datasets with an entry per extension segment
+EXTENSION_KEYS = ['extension_graph', 'extension_prev_index', 'extension_start_index', 'extension_local_start',
+                  'extension_nhalos', 'extension_prog_start_index', 'extension_prog_local_start',
+                  'extension_nprog_links', 'extension_desc_start_index', 'extension_desc_local_start',
+                  'extension_ndesc_links']
+
+# The datasets not stored as 32 bit integers
+DTYPES = {'halo_catalog_halo_ids': np.int64, 'subhalo_catalog_halo_ids': np.int64, 'root_mass_index': np.int64,
+          'superseded': bool}
+
+# The start indices index the full flat datasets and can therefore exceed the int32 range
+for key in ['graph_start_index', 'graph_prog_start_index', 'graph_desc_start_index', 'extension_start_index',
+            'extension_prog_start_index', 'extension_desc_start_index']:
+    DTYPES[key] = np.int64
+    DTYPES['sub_' + key] = np.int64
+for key in ['redshifts', 'mean_pos', 'mean_vel', 'rms_radius', '3D_velocity_dispersion', 'v_max',
+            'half_mass_radius', 'half_mass_velocity_radius']:
+    DTYPES[key] = float
+    DTYPES['sub_' + key] = float
+
+
+def write_graph_columns(hdf, columns):
+    """ A function to write the graph columns to the graph file. Datasets are stored contiguously
+    such that they can be memory mapped when read (see read_graph_file).
+
+    :param hdf: The open graph file.
+    :param columns: A dictionary of the arrays to write keyed by dataset name.
+    :return: None
+    """
+
+    for key, arr in columns.items():
+        hdf.create_dataset(key, data=arr, dtype=DTYPES.get(key, np.int32))
+
+
+def write_graph_file(graphpath, columns, header, comm=None):
+    """ A function to write the graph file from the graph columns of each rank. Each rank writes its
+    graphs to its own slice of every dataset (in rank order), the per graph start indices are shifted
+    to point into the full datasets. Parallel HDF5 is used when h5py supports it, otherwise the ranks
+    take it in turns to write.
+
+    :param graphpath: The filepath and basename of the graph file.
+    :param columns: A dictionary of this rank's graph columns keyed by dataset name (the same keys on
+                    every rank).
+    :param header: A dictionary of the header attributes.
+    :param comm: The MPI communicator (None when writing from a single process).
+    :return: None
+    """
+
+    if comm is None:
+        rank, size = 0, 1
+    else:
+        rank, size = comm.rank, comm.size
+
+    # Get the offset of this rank's slice of each dataset and the length of each dataset
+    keys = sorted(columns.keys())
+    lengths = np.array([len(columns[key]) for key in keys], dtype=np.int64)
+    if comm is None:
+        all_lengths = lengths[None, :]
+        root_nparts = columns['root_nparts']
+    else:
+        all_lengths = np.array(comm.allgather(lengths))
+        root_nparts = np.concatenate(comm.allgather(columns['root_nparts']))
+    offsets = dict(zip(keys, np.sum(all_lengths[:rank], axis=0)))
+    totals = dict(zip(keys, np.sum(all_lengths, axis=0)))
+
+    # Shift the start indices of each graph to point into the full datasets
+    columns = dict(columns)
+    for pre, halo_key in [('', 'halo_catalog_halo_ids'), ('sub_', 'subhalo_catalog_halo_ids')]:
+        if pre + 'graph_start_index' not in columns:
+            continue
+        for key, data_key in [('graph_start_index', halo_key),
+                              ('graph_prog_start_index', pre + 'direct_prog_ids'),
+                              ('graph_desc_start_index', pre + 'direct_desc_ids')]:
+            columns[pre + key] = columns[pre + key] + offsets[data_key]
+
+    # The root mass index covers every graph so is written by the first rank
+    keys.append('root_mass_index')
+    columns['root_mass_index'] = get_root_mass_index(root_nparts) if rank == 0 else np.array([], dtype=np.int64)
+    offsets['root_mass_index'] = 0
+    totals['root_mass_index'] = len(root_nparts)
+
+    if comm is not None and h5py.get_config().mpi:
+
+        hdf = h5py.File(graphpath + '.hdf5', 'w', driver='mpio', comm=comm)
+        create_graph_datasets(hdf, columns, header, keys, totals)
+        write_graph_slices(hdf, columns, keys, offsets)
+        hdf.close()
+
+    else:
+
+        if rank == 0:
+            hdf = h5py.File(graphpath + '.hdf5', 'w')
+            create_graph_datasets(hdf, columns, header, keys, totals)
+            hdf.close()
+
+        for r in range(size):
+
+            if comm is not None:
+                comm.Barrier()
+
+            if r == rank:
+                hdf = h5py.File(graphpath + '.hdf5', 'r+')
+                write_graph_slices(hdf, columns, keys, offsets)
+                hdf.close()
+
+        if comm is not None:
+            comm.Barrier()
+
+
+def create_graph_datasets(hdf, columns, header, keys, totals):
+    """ A function to create the header and the (empty) full length datasets of the graph file.
+
+    :param hdf: The open graph file.
+    :param columns: A dictionary of the graph columns keyed by dataset name.
+    :param header: A dictionary of the header attributes.
+    :param keys: The dataset names.
+    :param totals: A dictionary of the total length of each dataset.
+    :return: None
+    """
+
+    header_grp = hdf.create_group("Header")
+    for key, value in header.items():
+        header_grp.attrs[key] = value
+
+    for key in keys:
+        hdf.create_dataset(key, shape=(totals[key],) + columns[key].shape[1:],
+                           dtype=DTYPES.get(key, np.int32))
+
+
+def write_graph_slices(hdf, columns, keys, offsets):
+    """ A function to write each graph column to its slice of the full length dataset.
+
+    :param hdf: The open graph file.
+    :param columns: A dictionary of the graph columns keyed by dataset name.
+    :param keys: The dataset names.
+    :param offsets: A dictionary of the start of the slice in each dataset.
+    :return: None
+    """
+
+    for key in keys:
+        if len(columns[key]) > 0:
+            hdf[key][offsets[key]: offsets[key] + len(columns[key])] = columns[key]
+
+
+def get_root_mass_index(root_nparts):
+    """ A function to get the index of graphs sorted by the mass of their most massive root.
+
+    :param root_nparts: The number of particles in the most massive root of each graph.
+    :return: The graph IDs in order of decreasing root mass.
+    """
+
+    return np.argsort(-np.asarray(root_nparts, dtype=np.int64), kind='stable')
+
+
+def read_graph_file(graphpath):
+    """ A function to read the graph file, each dataset is memory mapped where possible and read
+    into memory otherwise.
+
+    :param graphpath: The filepath and basename of the graph file.
+    :return: A dictionary of the graph columns keyed by dataset name and a dictionary of the header
+             attributes.
+    """
+
+    hdf = h5py.File(graphpath + '.hdf5', 'r')
+
+    header = dict(hdf['Header'].attrs)
+    columns = {key: utilities.read_mapped_dataset(hdf[key]) for key in hdf.keys() if key != 'Header'}
+
+    hdf.close()
+
+    return columns, header
+
+
+def open_graph_file(graphpath):
+    """ A function to open the graph file for reading single graphs. Datasets are memory mapped where
+    possible, datasets that cannot be mapped (e.g. those made resizable by update_graph) are left in the
+    file such that only the slices holding a graph are read.
+
+    :param graphpath: The filepath and basename of the graph file.
+    :return: The open graph file (to be closed by the caller) and a dictionary of the graph columns
+             keyed by dataset name.
+    """
+
+    hdf = h5py.File(graphpath + '.hdf5', 'r')
+
+    columns = {}
+    for key in hdf.keys():
+        if key == 'Header':
+            continue
+        dset = hdf[key]
+        columns[key] = dset if dset.chunks is not None else utilities.read_mapped_dataset(dset)
+
+    return hdf, columns
+
+
+def get_graph_segments(columns, graph_id, pre=''):
+    """ A function to get the segments of the datasets holding a graph, the base segment followed by
+    any extension segments in the order they were added.
+
+    :param columns: The graph columns from read_graph_file (or the open graph file).
+    :param graph_id: The ID of the graph.
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :return: A list of (halo start, nhalos, prog link start, nprog links, desc link start, ndesc links)
+             tuples.
+    """
+
+    exts = []
+    if pre + 'graph_extension_index' in columns:
+        ext = columns[pre + 'graph_extension_index'][graph_id]
+        while ext != 2 ** 30:
+            exts.append(ext)
+            ext = columns[pre + 'extension_prev_index'][ext]
+    exts.reverse()
+
+    # Get the number of links in the base segment, older files only store the start indices
+    counts = []
+    for link, link_key in [('prog', 'direct_prog_ids'), ('desc', 'direct_desc_ids')]:
+        if pre + 'graph_n' + link + '_links' in columns:
+            counts.append(columns[pre + 'graph_n' + link + '_links'][graph_id])
+        else:
+            starts = columns[pre + 'graph_' + link + '_start_index']
+            end = starts[graph_id + 1] if graph_id + 1 < len(starts) else len(columns[pre + link_key])
+            counts.append(end - starts[graph_id])
+    nhalo = columns[pre + 'nhalos_in_graph'][graph_id]
+
+    if len(exts) > 0:
+        nhalo = columns[pre + 'extension_local_start'][exts[0]]
+        counts = [columns[pre + 'extension_prog_local_start'][exts[0]],
+                  columns[pre + 'extension_desc_local_start'][exts[0]]]
+
+    segments = [(columns[pre + 'graph_start_index'][graph_id], nhalo,
+                 columns[pre + 'graph_prog_start_index'][graph_id], counts[0],
+                 columns[pre + 'graph_desc_start_index'][graph_id], counts[1])]
+    for ext in exts:
+        segments.append(tuple(columns[pre + 'extension_' + key][ext]
+                              for key in ['start_index', 'nhalos', 'prog_start_index', 'nprog_links',
+                                          'desc_start_index', 'ndesc_links']))
+
+    return segments
+
+
+def get_halo_positions(segments, local_ids):
+    """ A function to convert the IDs of halos within a graph to their position in the halo datasets.
+
+    :param segments: The segments holding the graph from get_graph_segments.
+    :param local_ids: The IDs of the halos within the graph.
+    :return: The position of each halo in the halo datasets.
+    """
+
+    starts = np.array([seg[0] for seg in segments], dtype=np.int64)
+    nhalos = np.array([seg[1] for seg in segments], dtype=np.int64)
+    local_starts = np.cumsum(nhalos) - nhalos
+
+    seg_inds = np.searchsorted(local_starts, local_ids, side='right') - 1
+
+    return starts[seg_inds] + local_ids - local_starts[seg_inds]
+
+
+def get_graph_view(columns, graph_id, sub=False):
+    """ A function to get the data of a single graph, each array is a slice (and therefore a view
+    requiring no copying) of the file's columns. Graphs with extension segments are copied into
+    contiguous arrays.
+
+    :param columns: The graph columns from read_graph_file (or the open graph file).
+    :param graph_id: The ID of the graph.
+    :param sub: Flag for getting the subhalos of the graph rather than the host halos.
+    :return: A dictionary of this graph's data keyed by dataset name (without the "sub_" prefix).
+    """
+
+    if sub:
+        pre = 'sub_'
+        halo_keys = SUB_HALO_KEYS
+    else:
+        pre = ''
+        halo_keys = HALO_KEYS
+
+    segments = get_graph_segments(columns, graph_id, pre)
+    graph = {}
+
+    # Get the halos and links of this graph
+    for keys, ind in [([key for key in halo_keys if key in columns], 0),
+                      ([pre + key for key in PROG_KEYS], 2), ([pre + key for key in DESC_KEYS], 4)]:
+        for key in keys:
+            arrs = [columns[key][seg[ind]: seg[ind] + seg[ind + 1]] for seg in segments]
+            graph[key[len(pre):] if key.startswith(pre) else key] = arrs[0] if len(arrs) == 1 else np.concatenate(arrs)
+
+    # Get the graph level data
+    for key in GRAPH_KEYS + ['superseded']:
+        if pre + key in columns:
+            graph[key] = columns[pre + key][graph_id]
+
+    return graph
+
+
+class MergerGraph:
+    """ A single graph held in arrays. The halo properties are columns indexed by the halo's ID within
+    the graph, the progenitor and descendant links are held in compressed sparse row form (the links
+    of halo i are links[indptr[i]: indptr[i + 1]]) and the halos of each generation are contiguous.
+    Graphs loaded from an unextended graph file are slices of the memory mapped file.
+    """
+
+    def __init__(self, graph):
+        """
+        :param graph: A graph dictionary from get_graph_view.
+        """
+
+        self.data = graph
+        self.nhalos = len(graph['nparts'])
+        self.halo_keys = [key for key in dict.fromkeys(HALO_KEYS + ['subhalo_catalog_halo_ids', 'host_halos']
+                          + [key[4:] for key in SUB_HALO_KEYS[2:]]) if key in graph]
+
+        self.prog_indptr, self.prog_ids, self.prog_conts = self._get_links('prog')
+        self.desc_indptr, self.desc_ids, self.desc_conts = self._get_links('desc')
+
+        # Get the generation (snapshot index) of each halo
+        gen_length = np.where(graph['generation_length'] != 2 ** 30, graph['generation_length'], 0)
+        self.generation_start_index = np.where(gen_length > 0, graph['generation_start_index'], 0)
+        self.generation_length = gen_length
+        self.halo_generation = np.repeat(np.arange(gen_length.size), gen_length)
+
+        self._main_progs = None
+        self._main_descs = None
+
+    @classmethod
+    def from_file(cls, graphpath, graph_id, sub=False):
+        """ Load a graph (or its subhalos) from a graph file, memory mapping the file where possible and
+        otherwise reading only this graph's slices. """
+
+        hdf, columns = open_graph_file(graphpath)
+        graph = get_graph_view(columns, graph_id, sub)
+        hdf.close()
+
+        return cls(graph)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def _get_links(self, link):
+        """ Get the links of every halo in halo order as (indptr, linked halo IDs, contributions). """
+
+        nlinks = np.maximum(self.data['n' + link], 0).astype(np.int64)
+        indptr = np.concatenate([[0], np.cumsum(nlinks)])
+        ids = self.data['direct_' + link + '_ids']
+        conts = self.data['direct_' + link + '_contribution']
+
+        # Links written by the builder are already in halo order and need no copying
+        starts = self.data[link + '_start_index']
+        okinds = nlinks > 0
+        if np.array_equal(starts[okinds], indptr[:-1][okinds]):
+            return indptr, ids[:indptr[-1]], conts[:indptr[-1]]
+
+        pos = np.repeat(starts.astype(np.int64) - indptr[:-1], nlinks) + np.arange(indptr[-1], dtype=np.int64)
+
+        return indptr, np.asarray(ids)[pos], np.asarray(conts)[pos]
+
+    def _get_linked(self, halos, indptr, ids, conts):
+        """ Get the (halo, linked halo, contribution) triples of the given halos. """
+
+        halos = np.atleast_1d(np.asarray(halos, dtype=np.int64))
+        nlinks = indptr[halos + 1] - indptr[halos]
+        first = np.cumsum(nlinks) - nlinks
+        pos = np.repeat(indptr[halos] - first, nlinks) + np.arange(np.sum(nlinks), dtype=np.int64)
+
+        return np.repeat(halos, nlinks), np.asarray(ids[pos], dtype=np.int64), np.asarray(conts[pos])
+
+    def get_progs(self, halos):
+        """ Get the (halo, progenitor, contribution) triples of the given halos. """
+
+        return self._get_linked(halos, self.prog_indptr, self.prog_ids, self.prog_conts)
+
+    def get_descs(self, halos):
+        """ Get the (halo, descendant, contribution) triples of the given halos. """
+
+        return self._get_linked(halos, self.desc_indptr, self.desc_ids, self.desc_conts)
+
+    def get_generation(self, snap_ind):
+        """ Get the slice of the halo columns holding a generation (given by its snapshot index). """
+
+        start = self.generation_start_index[snap_ind]
+
+        return slice(start, start + self.generation_length[snap_ind])
+
+    def get_main_progs(self):
+        """ Get the main progenitor (the progenitor contributing the most particles) of every halo,
+        -1 for halos without progenitors. """
+
+        if self._main_progs is None:
+
+            halos = np.repeat(np.arange(self.nhalos), np.diff(self.prog_indptr))
+            sinds = np.lexsort((-np.asarray(self.prog_conts), halos))
+            halos_with_progs, first = np.unique(halos[sinds], return_index=True)
+
+            self._main_progs = np.full(self.nhalos, -1, dtype=np.int64)
+            self._main_progs[halos_with_progs] = np.asarray(self.prog_ids)[sinds][first]
+
+        return self._main_progs
+
+    def get_main_descs(self):
+        """ Get the main descendant (the descendant receiving the most particles) of every halo,
+        -1 for halos without descendants. """
+
+        if self._main_descs is None:
+
+            halos = np.repeat(np.arange(self.nhalos), np.diff(self.desc_indptr))
+            sinds = np.lexsort((-np.asarray(self.desc_conts), halos))
+            halos_with_descs, first = np.unique(halos[sinds], return_index=True)
+
+            self._main_descs = np.full(self.nhalos, -1, dtype=np.int64)
+            self._main_descs[halos_with_descs] = np.asarray(self.desc_ids)[sinds][first]
+
+        return self._main_descs
+
+    def get_main_branch(self, halo):
+        """ Get the halos on the main progenitor branch of a halo, starting from the halo itself. """
+
+        main_progs = self.get_main_progs()
+        branch = [halo]
+        while main_progs[branch[-1]] >= 0:
+            branch.append(main_progs[branch[-1]])
+
+        return np.array(branch, dtype=np.int64)
+
+    def get_main_branch_lengths(self, halos):
+        """ Get the number of main progenitor steps from each of the given halos to the start of its
+        main branch, walking every branch at once. """
+
+        main_progs = self.get_main_progs()
+        current = np.array(halos, dtype=np.int64, ndmin=1)
+        lengths = np.zeros(current.size, dtype=np.int64)
+        okinds = main_progs[current] >= 0
+        while okinds.any():
+            lengths[okinds] += 1
+            current[okinds] = main_progs[current[okinds]]
+            okinds[okinds] = main_progs[current[okinds]] >= 0
+
+        return lengths
+
+    def _walk(self, halos, get_linked):
+        """ Get every halo reachable from the given halos by repeatedly following links, one
+        generation at a time. """
+
+        found = np.zeros(self.nhalos, dtype=bool)
+        frontier = np.unique(np.asarray(halos, dtype=np.int64))
+        while frontier.size > 0:
+            _, linked, _ = get_linked(frontier)
+            linked = np.unique(linked)
+            frontier = linked[~found[linked]]
+            found[frontier] = True
+
+        return np.where(found)[0]
+
+    def get_ancestors(self, halos):
+        """ Get every halo on any progenitor path of the given halos (excluding the halos themselves
+        unless one is an ancestor of another). """
+
+        return self._walk(halos, self.get_progs)
+
+    def get_descendants(self, halos):
+        """ Get every halo on any descendant path of the given halos (excluding the halos themselves
+        unless one is a descendant of another). """
+
+        return self._walk(halos, self.get_descs)
+
+    def get_subgraph(self, halos):
+        """ Get the graph made of the given halos, only links between these halos are kept. Pointers
+        into the other level of the hierarchy (hosts and subhalos) are left unchanged. """
+
+        halos = np.unique(np.asarray(halos, dtype=np.int64))
+        lut = np.full(self.nhalos, -1, dtype=np.int64)
+        lut[halos] = np.arange(halos.size)
+
+        graph = {key: np.asarray(self.data[key][halos]) for key in self.halo_keys}
+        for link, get_linked in [('prog', self.get_progs), ('desc', self.get_descs)]:
+
+            link_halos, linked, conts = get_linked(halos)
+            okinds = lut[linked] >= 0
+
+            nlinks = np.bincount(lut[link_halos[okinds]], minlength=halos.size)
+            graph['n' + link] = np.where(self.data['n' + link][halos] < 0, self.data['n' + link][halos], nlinks)
+            graph[link + '_start_index'] = np.where(nlinks > 0, np.cumsum(nlinks) - nlinks, 2 ** 30)
+            graph['direct_' + link + '_ids'] = lut[linked[okinds]]
+            graph['direct_' + link + '_contribution'] = conts[okinds]
+
+        gen_length = np.bincount(self.halo_generation[halos], minlength=self.generation_length.size)
+        graph['generation_start_index'] = np.where(gen_length > 0, np.cumsum(gen_length) - gen_length, 2 ** 30)
+        graph['generation_length'] = np.where(gen_length > 0, gen_length, 2 ** 30)
+        graph['generation_id'] = np.where(gen_length > 0, np.arange(gen_length.size), 2 ** 30)
+        graph['nhalos_in_graph'] = halos.size
+
+        return MergerGraph(graph)
+
+
+def make_graph_file_resizable(graphpath):
+    """ A function to convert the datasets of a graph file to chunked datasets which can be extended
+    (along every axis). This is only needed once, files which are already resizable are left untouched.
+
+    :param graphpath: The filepath and basename of the graph file.
+    :return: None
+    """
+
+    hdf = h5py.File(graphpath + '.hdf5', 'r+')
+
+    for key in list(hdf.keys()):
+
+        if key == 'Header' or hdf[key].maxshape[0] is None:
+            continue
+
+        arr = hdf[key][...]
+        del hdf[key]
+        hdf.create_dataset(key, data=arr, dtype=arr.dtype, chunks=True, maxshape=(None,) * arr.ndim)
+
+    hdf.close()
+
+
+def append_dataset(hdf, key, arr, dtype=None):
+    """ A function to append an array to a resizable dataset (see make_graph_file_resizable), the
+    dataset is created if it does not exist.
+
+    :param hdf: The open graph file.
+    :param key: The dataset name.
+    :param arr: The array to append.
+    :param dtype: The dtype of a new dataset (defaults to the graph file dtype of this dataset).
+    :return: The index of the first appended element.
+    """
+
+    arr = np.asarray(arr)
+
+    if key not in hdf:
+        hdf.create_dataset(key, shape=(0,) + arr.shape[1:], dtype=dtype or DTYPES.get(key, np.int32),
+                           chunks=True, maxshape=(None,) * arr.ndim)
+
+    start = hdf[key].shape[0]
+    if len(arr) > 0:
+        hdf[key].resize(start + len(arr), axis=0)
+        hdf[key][start:] = arr
+
+    return start
+
+
+def convert_graph_file(oldpath, newpath):
+    """ A function to convert a graph file stored with a group per graph (the original layout) to
+    the flat columnar layout.
+
+    :param oldpath: The filepath and basename of the group per graph file.
+    :param newpath: The filepath and basename of the new columnar file.
+    :return: None
+    """
+
+    old_hdf = h5py.File(oldpath + '.hdf5', 'r')
+
+    graph_ids = sorted([key for key in old_hdf.keys() if key.isdigit()], key=int)
+    nsnap = old_hdf[graph_ids[0]]['generation_length'].shape[0] if len(graph_ids) > 0 else 0
+
+    columns = {}
+    for pre, halo_keys, id_key in [('', HALO_KEYS, 'halo_catalog_halo_ids'),
+                                   ('sub_', SUB_HALO_KEYS, 'subhalo_catalog_halo_ids')]:
+
+        data = {key: [] for key in halo_keys + [pre + key for key in PROG_KEYS + DESC_KEYS + GRAPH_KEYS]}
+
+        for graph_id in graph_ids:
+            graph = old_hdf[graph_id]
+
+            if id_key in graph:
+                nhalo = graph[id_key].shape[0]
+                for key in halo_keys + [pre + key for key in PROG_KEYS + DESC_KEYS]:
+                    if key in graph:
+                        data[key].append(graph[key][...])
+                nprog_links = graph[pre + 'direct_prog_ids'].shape[0]
+                ndesc_links = graph[pre + 'direct_desc_ids'].shape[0]
+                for key in ['generation_start_index', 'generation_length', 'generation_id']:
+                    data[pre + key].append(graph[pre + key][...])
+                data[pre + 'graph_lengths'].append(graph.attrs[pre + 'length'])
+                data[pre + 'root_nparts'].append(graph.attrs[pre + 'root_mass'])
+            else:
+                nhalo = nprog_links = ndesc_links = 0
+                for key in ['generation_start_index', 'generation_length', 'generation_id']:
+                    data[pre + key].append(np.full(nsnap, 2 ** 30))
+                data[pre + 'graph_lengths'].append(0)
+                data[pre + 'root_nparts'].append(0)
+
+            data[pre + 'nhalos_in_graph'].append(nhalo)
+            data[pre + 'graph_nprog_links'].append(nprog_links)
+            data[pre + 'graph_ndesc_links'].append(ndesc_links)
+
+            # Hosts without subhalos have no pointer into the subhalos
+            if pre == '' and 'nsubhalos' not in graph:
+                data['subhalo_start_index'].append(np.full(nhalo, 2 ** 30))
+                data['nsubhalos'].append(np.zeros(nhalo))
+
+        # Convert the counts to start indices
+        for key, count_key in [('graph_start_index', 'nhalos_in_graph'),
+                               ('graph_prog_start_index', 'graph_nprog_links'),
+                               ('graph_desc_start_index', 'graph_ndesc_links')]:
+            counts = np.array(data[pre + count_key], dtype=np.int64)
+            data[pre + key] = np.cumsum(counts) - counts
+            data[pre + count_key] = counts
+
+        for key, arrs in data.items():
+            if isinstance(arrs, list):
+                if len(arrs) > 0:
+                    columns[key] = np.concatenate(arrs) if key[len(pre):] not in GRAPH_KEYS else np.array(arrs)
+                else:
+                    columns[key] = np.array([])
+            else:
+                columns[key] = arrs
+
+    columns['root_mass_index'] = get_root_mass_index(columns['root_nparts'])
+
+    hdf = h5py.File(newpath + '.hdf5', 'w')
+
+    # Add metadata
+    header = hdf.create_group("Header")
+    for key, value in old_hdf['Header'].attrs.items():
+        header.attrs[key] = value
+
+    write_graph_columns(hdf, columns)
+
+    hdf.close()
+    old_hdf.close()
@@ -1,5 +1,4 @@
 from scipy.spatial import cKDTree
-from collections import defaultdict
 import pickle
 import numpy as np
 from guppy import hpy; hp = hpy()
@@ -13,6 +12,7 @@ import random
 import sys
 import os
 import utilities
+import fof
 
 
 def find_halos(pos, npart, boxsize, batchsize, linkl):
@@ -25,146 +25,47 @@ def find_halos(pos, npart, boxsize, batchsize, linkl):
     :param boxsize: The length of the simulation box along one axis.
     :param batchsize: The batchsize for each query to the KD-Tree (see Docs for more information).
     :param linkl: The linking length.
-    :param debug_npart: Number of particles to sort during debugging if required.
 
     :return: part_haloids: The array of halo IDs assigned to each particle (where the index is the particle ID)
              assigned_parts: A dictionary containing the particle IDs assigned to each halo.
-             final_halo_ids: An array of final halo IDs (where the index is the initial halo ID and value is the
-             final halo ID.
-             query_func: The tree query object assigned to a variable.
     """
 
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
-    # Initialise the arrays and dictionaries for storing halo data
-    part_haloids = np.full(npart, -1, dtype=np.int32)  # halo ID containing each particle
-    assigned_parts = defaultdict(set)  # dictionary to store the particles in a particular halo
-    # A dictionary where each key is an initial halo ID and the item is the halo IDs it has been linked with
-    linked_halos_dict = defaultdict(set)
-    final_halo_ids = np.full(npart, -1, dtype=np.int32)  # final halo ID of linked halos (index is initial halo ID)
-
-    # Initialise the halo ID counter (IDs start at 0)
-    ihaloid = -1
+    # =============== Initialise The KD-Tree ===============
 
     # Build the kd tree with the boxsize argument providing 'wrapping' due to periodic boundaries
     # *** Note: Contrary to CKDTree documentation compact_nodes=False and balanced_tree=False results in
     # faster queries (documentation recommends compact_nodes=True and balanced_tree=True)***
     tree = cKDTree(pos, leafsize=16, compact_nodes=False, balanced_tree=False, boxsize=[boxsize, boxsize, boxsize])
-    print(pos.shape, sys.getsizeof(tree))
-    print(hp.heap())
+
     # Assign the query object to a variable to save time on repeated calls
     query_func = tree.query_ball_point
 
-    # =============== Assign Particles To Initial Halos ===============
+    # =============== Link Particles To Their Neighbours ===============
 
     assert batchsize < npart / 2, "batchsize must be less than half the total number of particles"
 
     # Define an array of limits for looping defined by the batchsize
     limits = np.linspace(0, npart, int(npart/batchsize), dtype=np.int32)
 
-    # Loop over particle batches
+    # Loop over particle batches flattening each batch's neighbour lists into links
+    rows, cols = [], []
     for ind, limit in enumerate(limits[:-1]):
 
         # Print progress
         print('Processed: {x}/{y}'.format(x=limit, y=npart))
 
-        # Remove already assigned particles from the query particles to save time avoiding double checks
-        query_parts_poss = pos[limit:limits[ind + 1]]
-
-        # Query the tree in batches of 1000000 for speed returning a list of lists
-        query = query_func(query_parts_poss, r=linkl, n_jobs=-1)
-
-        # Loop through query results assigning initial halo IDs
-        for query_part_inds in iter(query):
-
-            # Convert the particle index list to an array for ease of use
-            query_part_inds = np.array(query_part_inds, copy=False, dtype=int)
-
-            # Assert that the query particle is returned by the tree query. Otherwise the program fails
-            assert query_part_inds.size != 0, 'Must always return particle that you are sitting on'
-
-            # Find only the particles not already in a halo
-            new_parts = query_part_inds[np.where(part_haloids[query_part_inds] == -1)]
-
-            # If only one particle is returned by the query and it is new it is a 'single particle halo'
-            if new_parts.size == query_part_inds.size == 1:
-
-                # Assign the 'single particle halo' halo ID to the particle
-                part_haloids[new_parts] = -2
-
-            # If all particles are new increment the halo ID and assign a new halo
-            elif new_parts.size == query_part_inds.size:
-
-                # Increment the halo ID by 1 (initialising a new halo)
-                ihaloid += 1
-
-                # Assign the new halo ID to the particles
-                part_haloids[new_parts] = ihaloid
-                assigned_parts[ihaloid] = set(new_parts)
-
-                # Assign the final halo ID to be the newly assigned halo ID
-                final_halo_ids[ihaloid] = ihaloid
-                linked_halos_dict[ihaloid] = {ihaloid}
-
-            else:
-
-                # ===== Get the 'final halo ID value' =====
-
-                # Extract the IDs of halos returned by the query
-                contained_halos = part_haloids[query_part_inds]
+        # Query the tree in batches for speed returning a list of lists
+        query = query_func(pos[limit:limits[ind + 1]], r=linkl, n_jobs=-1, return_sorted=False)
 
-                # Get only the unique halo IDs
-                uni_cont_halos = np.unique(contained_halos)
+        batch_rows, batch_cols = fof.csr_to_edges(*fof.query_to_csr(query))
+        rows.append(batch_rows)
+        cols.append(batch_cols)
 
-                # # Assure no single particle halos are included in the query results
-                # assert any(uni_cont_halos != -2), 'Single particle halos should never be found'
+    # =============== Assign Particles To Halos ===============
 
-                # Remove any unassigned halos
-                uni_cont_halos = uni_cont_halos[np.where(uni_cont_halos != -1)]
-
-                # If there is only one halo ID returned avoid the slower code to combine IDs
-                if uni_cont_halos.size == 1:
-
-                    # Get the list of linked halos linked to the current halo from the linked halo dictionary
-                    linked_halos = linked_halos_dict[uni_cont_halos[0]]
-
-                else:
-
-                    # Get all the linked halos from dictionary so as to not miss out any halos IDs that are linked
-                    # but not returned by this particular query
-                    linked_halos_set = set()  # initialise linked halo set
-                    linked_halos = linked_halos_set.union(*[linked_halos_dict.get(halo) for halo in uni_cont_halos])
-
-                # Find the minimum halo ID to make the final halo ID
-                final_ID = min(linked_halos)
-
-                # Assign the linked halos to all the entries in the linked halos dictionary
-                linked_halos_dict.update(dict.fromkeys(list(linked_halos), linked_halos))
-
-                # Assign the final halo ID array entries
-                final_halo_ids[list(linked_halos)] = final_ID
-
-                # Assign new particles to the particle halo IDs array with the final ID
-                part_haloids[new_parts] = final_ID
-
-                # Assign the new particles to the final ID in halo dictionary entry
-                assigned_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Halos To Their Final Halo ID ===============
-
-    # Loop over initial halo IDs reassigning them to the final halo ID
-    for halo_id in list(assigned_parts.keys()):
-
-        # Extract the final halo value
-        final_ID = final_halo_ids[halo_id]
-
-        # Assign this final ID to all the particles in the initial halo ID
-        part_haloids[list(assigned_parts[halo_id])] = final_ID
-        assigned_parts[final_ID].update(assigned_parts[halo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if halo_id != final_ID:
-            assigned_parts.pop(halo_id)
+    # Halos are the connected components of the links (see fof.get_fof_labels)
+    part_haloids = fof.get_fof_labels(npart, np.concatenate(rows), np.concatenate(cols)).astype(np.int32)
+    assigned_parts = fof.get_fof_groups(part_haloids)
 
     print('Assignment Complete')
 
@@ -176,286 +77,35 @@ def find_subhalos(halo_pos, sub_linkl):
     higher overdensity.
 
     :param halo_pos: The position vectors of particles within the host halo.
-    :param sub_llcoeff: The linking length coefficient used to define a subhalo.
-    :param boxsize: The length of the simulation box along one axis.
-    :param npart: The number of particles in the simulation.
+    :param sub_linkl: The linking length used to define a subhalo.
 
     :return: part_subhaloids: The array of subhalo IDs assigned to each particle in the host halo
              (where the index is the particle ID).
              assignedsub_parts: A dictionary containing the particle IDs assigned to each subhalo.
     """
 
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
-    # Initialise arrays and dictionaries for storing subhalo data
-    part_subhaloids = np.full(halo_pos.shape[0], -1, dtype=int)  # subhalo ID of the halo each particle is in
-    assignedsub_parts = defaultdict(set)  # Dictionary to store the particles in a particular subhalo
-    # A dictionary where each key is an initial subhalo ID and the item is the subhalo IDs it has been linked with
-    linked_subhalos_dict = defaultdict(set)
-    # Final subhalo ID of linked halos (index is initial subhalo ID)
-    final_subhalo_ids = np.full(halo_pos.shape[0], -1, dtype=int)
-
-    # Initialise subhalo ID counter (IDs start at 0)
-    isubhaloid = -1
-
-    npart = halo_pos.shape[0]
-
     # Build the halo kd tree
     # *** Note: Contrary to CKDTree documentation compact_nodes=False and balanced_tree=False results in
     # faster queries (documentation recommends compact_nodes=True and balanced_tree=True)***
     tree = cKDTree(halo_pos, leafsize=16, compact_nodes=False, balanced_tree=False)
 
-    if npart > 10000:
-
-        # Define an array of limits for looping defined by the batchsize
-        limits = np.linspace(0, npart, int(npart / 10000) + 1, dtype=int)
-
-    else:
-
-        limits = [0, npart]
-
-    # ===================== Sort Through The Results Assigning Subhalos =====================
-
-    for ind, limit in enumerate(limits[:-1]):
-
-        query_parts = halo_pos[limit:limits[ind + 1]]
-
-        if query_parts.size == 0:
-            continue
-
-        query = tree.query_ball_point(query_parts, r=sub_linkl)
-
-        # Loop through query results
-        for query_part_inds in iter(query):
-
-            # Convert the particle index list to an array for ease of use.
-            query_part_inds = np.array(query_part_inds, copy=False, dtype=int)
-
-            # Assert that the query particle is returned by the tree query. Otherwise the program fails
-            assert query_part_inds.size != 0, 'Must always return particle that you are sitting on'
-
-            # Find only the particles not already in a halo
-            new_parts = query_part_inds[np.where(part_subhaloids[query_part_inds] == -1)]
-
-            # If only one particle is returned by the query and it is new it is a 'single particle subhalo'
-            if new_parts.size == query_part_inds.size == 1:
-
-                # Assign the 'single particle subhalo' subhalo ID to the particle
-                part_subhaloids[new_parts] = -2
-
-            # If all particles are new increment the subhalo ID and assign a new subhalo ID
-            elif new_parts.size == query_part_inds.size:
-
-                # Increment the subhalo ID by 1 (initialise new halo)
-                isubhaloid += 1
-
-                # Assign the subhalo ID to the particles
-                part_subhaloids[new_parts] = isubhaloid
-                assignedsub_parts[isubhaloid] = set(new_parts)
-
-                # Assign the final subhalo ID to be the newly assigned subhalo ID
-                final_subhalo_ids[isubhaloid] = isubhaloid
-                linked_subhalos_dict[isubhaloid] = {isubhaloid}
-
-            else:
-
-                # ===== Get the 'final subhalo ID value' =====
-
-                # Extract the IDs of subhalos returned by the query
-                contained_subhalos = part_subhaloids[query_part_inds]
-
-                # Return only the unique subhalo IDs
-                uni_cont_subhalos = np.unique(contained_subhalos)
-
-                # # Assure no single particles are returned by the query
-                # assert any(uni_cont_subhalos != -2), 'Single particle halos should never be found'
-
-                # Remove any unassigned subhalos
-                uni_cont_subhalos = uni_cont_subhalos[np.where(uni_cont_subhalos != -1)]
-
-                # If there is only one subhalo ID returned avoid the slower code to combine IDs
-                if uni_cont_subhalos.size == 1:
-
-                    # Get the list of linked subhalos linked to the current subhalo from the linked subhalo dictionary
-                    linked_subhalos = linked_subhalos_dict[uni_cont_subhalos[0]]
-
-                else:
-
-                    # Get all linked subhalos from the dictionary so as to not miss out any subhalos IDs that are linked
-                    # but not returned by this particular query
-                    linked_subhalos_set = set()  # initialise linked subhalo set
-                    linked_subhalos = linked_subhalos_set.union(*[linked_subhalos_dict.get(subhalo)
-                                                                  for subhalo in uni_cont_subhalos])
-
-                # Find the minimum subhalo ID to make the final subhalo ID
-                final_ID = min(linked_subhalos)
-
-                # Assign the linked subhalos to all the entries in the linked subhalos dict
-                linked_subhalos_dict.update(dict.fromkeys(list(linked_subhalos), linked_subhalos))
-
-                # Assign the final subhalo array
-                final_subhalo_ids[list(linked_subhalos)] = final_ID
-
-                # Assign new parts to the subhalo IDs with the final ID
-                part_subhaloids[new_parts] = final_ID
-
-                # Assign the new particles to the final ID particles in subhalo dictionary entry
-                assignedsub_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Subhalos To Their Final Subhalo ID ===============
-
-    # Loop over initial subhalo IDs reassigning them to the final subhalo ID
-    for subhalo_id in list(assignedsub_parts.keys()):
-
-        # Extract the final subhalo value
-        final_ID = final_subhalo_ids[subhalo_id]
-
-        # Assign this final ID to all the particles in the initial subhalo ID
-        part_subhaloids[list(assignedsub_parts[subhalo_id])] = final_ID
-        assignedsub_parts[final_ID].update(assignedsub_parts[subhalo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if subhalo_id != final_ID:
-            assignedsub_parts.pop(subhalo_id)
+    # Subhalos are the connected components of the pairs within the subhalo linking length
+    part_subhaloids, assignedsub_parts = fof.find_groups_tree(tree, sub_linkl)
 
     return part_subhaloids, assignedsub_parts
 
 
 def find_phase_space_halos(halo_phases, linkl, vlinkl):
 
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
     # Divide halo positions by the linking length and velocites by the velocity linking length
     halo_phases[:, :3] = halo_phases[:, :3] / linkl
     halo_phases[:, 3:] = halo_phases[:, 3:] / vlinkl
 
-    # Initialise arrays and dictionaries for storing halo data
-    phase_part_haloids = np.full(halo_phases.shape[0], -1, dtype=int)  # halo ID of the halo each particle is in
-    phase_assigned_parts = {}  # Dictionary to store the particles in a particular halo
-    # A dictionary where each key is an initial subhalo ID and the item is the subhalo IDs it has been linked with
-    phase_linked_halos_dict = {}
-    # Final halo ID of linked halos (index is initial halo ID)
-    final_phasehalo_ids = np.full(halo_phases.shape[0], -1, dtype=int)
-
-    # Initialise subhalo ID counter (IDs start at 0)
-    ihaloid = -1
-
     # Initialise the halo kd tree in 6D phase space
     halo_tree = cKDTree(halo_phases, leafsize=10, compact_nodes=False, balanced_tree=False)
 
-    npart = halo_phases.shape[0]
-
-    if npart > 10000:
-
-        # Define an array of limits for looping defined by the batchsize
-        limits = np.linspace(0, npart, int(npart / 10000) + 1, dtype=int)
-
-    else:
-
-        limits = [0, npart]
-
-    # =============== Query the tree ===============
-
-    for ind, limit in enumerate(limits[:-1]):
-
-        query_phases = halo_phases[limit:limits[ind + 1]]
-
-        if query_phases.size == 0:
-            continue
-
-        query = halo_tree.query_ball_point(query_phases, r=np.sqrt(2))
-
-        # Loop through query results assigning initial halo IDs
-        for query_part_inds in iter(query):
-
-            query_part_inds = np.array(query_part_inds, dtype=int)
-
-            # Assert that the query particle is returned by the tree query. Otherwise the program fails
-            # assert query_part_inds.size != 0, 'Must always return particle that you are sitting on'
-
-            # Find only the particles not already in a halo
-            new_parts = query_part_inds[np.where(phase_part_haloids[query_part_inds] < 0)]
-
-            # If only one particle is returned by the query and it is new it is a 'single particle halo'
-            if new_parts.size == query_part_inds.size == 1:
-
-                # Assign the 'single particle halo' halo ID to the particle
-                phase_part_haloids[new_parts] = -2
-
-            # If all particles are new increment the halo ID and assign a new halo
-            elif new_parts.size == query_part_inds.size:
-
-                # Increment the halo ID by 1 (initialising a new halo)
-                ihaloid += 1
-
-                # Assign the new halo ID to the particles
-                phase_part_haloids[new_parts] = ihaloid
-                phase_assigned_parts[ihaloid] = set(new_parts)
-
-                # Assign the final halo ID to be the newly assigned halo ID
-                final_phasehalo_ids[ihaloid] = ihaloid
-                phase_linked_halos_dict[ihaloid] = {ihaloid}
-
-            else:
-
-                # ===== Get the 'final halo ID value' =====
-
-                # Extract the IDs of halos returned by the query
-                contained_halos = phase_part_haloids[query_part_inds]
-
-                # Get only the unique halo IDs
-                uni_cont_halos = np.unique(contained_halos)
-
-                # Remove any unassigned halos
-                uni_cont_halos = uni_cont_halos[np.where(uni_cont_halos >= 0)]
-
-                # If there is only one halo ID returned avoid the slower code to combine IDs
-                if uni_cont_halos.size == 1:
-
-                    # Get the list of linked halos linked to the current halo from the linked halo dictionary
-                    linked_halos = phase_linked_halos_dict[uni_cont_halos[0]]
-
-                elif uni_cont_halos.size == 0:
-                    continue
-
-                else:
-
-                    # Get all the linked halos from dictionary so as to not miss out any halos IDs that are linked
-                    # but not returned by this particular query
-                    linked_halos_set = set()  # initialise linked halo set
-                    linked_halos = linked_halos_set.union(*[phase_linked_halos_dict.get(halo)
-                                                            for halo in uni_cont_halos])
-
-                # Find the minimum halo ID to make the final halo ID
-                final_ID = min(linked_halos)
-
-                # Assign the linked halos to all the entries in the linked halos dictionary
-                phase_linked_halos_dict.update(dict.fromkeys(list(linked_halos), linked_halos))
-
-                # Assign the final halo ID array entries
-                final_phasehalo_ids[list(linked_halos)] = final_ID
-
-                # Assign new particles to the particle halo IDs array with the final ID
-                phase_part_haloids[new_parts] = final_ID
-
-                # Assign the new particles to the final ID in halo dictionary entry
-                phase_assigned_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Halos To Their Final Halo ID ===============
-
-    # Loop over initial halo IDs reassigning them to the final halo ID
-    for halo_id in list(phase_assigned_parts.keys()):
-
-        # Extract the final halo value
-        final_ID = final_phasehalo_ids[halo_id]
-
-        # Assign this final ID to all the particles in the initial halo ID
-        phase_part_haloids[list(phase_assigned_parts[halo_id])] = final_ID
-        phase_assigned_parts[final_ID].update(phase_assigned_parts[halo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if halo_id != final_ID:
-            phase_assigned_parts.pop(halo_id)
+    # Halos are the connected components of the pairs linked in both space and velocity
+    phase_part_haloids, phase_assigned_parts = fof.find_groups_tree(halo_tree, np.sqrt(2))
 
     return phase_part_haloids, phase_assigned_parts
 
@@ -548,30 +198,6 @@ def halo_energy_calc_exact(halo_poss, halo_vels, halo_npart, pmass, redshift, G,
     return halo_energy, KE, GE
 
 
-@nb.jit(nogil=True, parallel=True)
-def wrap_halo(halo_poss, boxsize):
-
-    # Define the comparison particle as the maximum position in the current dimension
-    max_part_pos = halo_poss.max(axis=0)
-
-    # Compute all the halo particle separations from the maximum position
-    sep = max_part_pos - halo_poss
-
-    # If any separations are greater than 50% the boxsize (i.e. the halo is split over the boundary)
-    # bring the particles at the lower boundary together with the particles at the upper boundary
-    # (ignores halos where constituent particles aren't separated by at least 50% of the boxsize)
-    # *** Note: fails if halo's extent is greater than 50% of the boxsize in any dimension ***
-    halo_poss[np.where(sep > 0.5 * boxsize)] += boxsize
-
-    # Compute the shifted mean position in the dimension ixyz
-    mean_halo_pos = halo_poss.mean(axis=0)
-
-    # Centre the halos about the mean in the dimension ixyz
-    halo_poss -= mean_halo_pos
-
-    return halo_poss, mean_halo_pos
-
-
 def halo_energy_calc_approx(halo_poss, halo_vels, halo_npart, pmass, redshift, G, h, soft):
 
     # Compute kinetic energy of the halo
@@ -867,17 +493,8 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath,
 
         # =============== Compute mean positions and velocities and wrap the halos ===============
 
-        # Define the comparison particle as the maximum position in the current dimension
-        max_part_pos = full_halo_poss.max(axis=0)
-
-        # Compute all the halo particle separations from the maximum position
-        sep = max_part_pos - full_halo_poss
-
-        # If any separations are greater than 50% the boxsize (i.e. the halo is split over the boundary)
-        # bring the particles at the lower boundary together with the particles at the upper boundary
-        # (ignores halos where constituent particles aren't separated by at least 50% of the boxsize)
-        # *** Note: fails if halo's extent is greater than 50% of the boxsize in any dimension ***
-        full_halo_poss[np.where(sep > 0.5 * boxsize)] += boxsize
+        # Bring the particles of halos split over the box boundary together about the halo's centre
+        full_halo_poss = utilities.wrap_halo(full_halo_poss, boxsize)
 
         result_tup = get_real_host_halos(ID, s_halo_pids, full_halo_poss, full_halo_vels, boxsize, vlinkl_halo_indp,
                                          linkl, pmass, iter_vlcoeffs[ID], decrement, redshift, G, h, soft)
@@ -937,8 +554,8 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath,
     # Open root group
     hdf = h5py.File(savepath + 'halos_' + str(snapshot) + '.hdf5', 'r+')
 
-    # Assign the full halo IDs array to the snapshot group
-    hdf.create_dataset('Halo_IDs', shape=part_haloids.shape, dtype=int, compression='gzip', data=part_haloids)
+    # Assign the halo ID of every particle at each level to the snapshot group
+    utilities.write_part_haloids(hdf, part_haloids)
 
     hdf.close()
 
@@ -1,6 +1,5 @@
 # from guppy import hpy; hp = hpy()
 import pickle
-from collections import defaultdict
 
 import mpi4py
 import numpy as np
@@ -13,8 +12,11 @@ import astropy.units as u
 import time
 import h5py
 import sys
+import functools
+import multiprocessing
 import utilities
 import halo_properties as hprop
+import fof
 
 # Initializations and preliminaries
 comm = MPI.COMM_WORLD  # get MPI communicator object
@@ -24,395 +26,57 @@ status = MPI.Status()  # get MPI status object
 
 
 def find_halos(tree, pos, linkl, npart):
-    """ A function which creates a KD-Tree using scipy.CKDTree and queries it to find particles
-    neighbours within a linking length. From This neighbour information particles are assigned
-    halo IDs and then returned.
-    :param pos: The particle position vectors array.
-    :param npart: The number of particles in the simulation.
-    :param boxsize: The length of the simulation box along one axis.
-    :param batchsize: The batchsize for each query to the KD-Tree (see Docs for more information).
+    """ A function which queries a KD-Tree to find the neighbours of particles within a linking
+    length. From This neighbour information particles are assigned halo IDs and then returned.
+    :param tree: The KD-Tree of every particle in the simulation.
+    :param pos: The position vectors of the particles to query.
     :param linkl: The linking length.
-    :param debug_npart: Number of particles to sort during debugging if required.
+    :param npart: The number of particles in the simulation.
     :return: part_haloids: The array of halo IDs assigned to each particle (where the index is the particle ID)
              assigned_parts: A dictionary containing the particle IDs assigned to each halo.
-             final_halo_ids: An array of final halo IDs (where the index is the initial halo ID and value is the
-             final halo ID.
-             query_func: The tree query object assigned to a variable.
     """
 
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
-    # Initialise the arrays and dictionaries for storing halo data
-    part_haloids = np.full(npart, -1,
-                           dtype=np.int32)  # halo ID containing each particle
-    assigned_parts = defaultdict(
-        set)  # dictionary to store the particles in a particular halo
-    # A dictionary where each key is an initial halo ID and the item is the halo IDs it has been linked with
-    linked_halos_dict = defaultdict(set)
-    final_halo_ids = np.full(npart, -1,
-                             dtype=np.int32)  # final halo ID of linked halos (index is initial halo ID)
-
-    # Initialise the halo ID counter (IDs start at 0)
-    ihaloid = -1
-
-    # Assign the query object to a variable to save time on repeated calls
-    query_func = tree.query_ball_point
-
-    # =============== Assign Particles To Initial Halos ===============
-
     # Query the tree returning a list of lists
-    query = query_func(pos, r=linkl)
-
-    # Loop through query results assigning initial halo IDs
-    for query_part_inds in iter(query):
-
-        # Convert the particle index list to an array for ease of use
-        query_part_inds = np.array(query_part_inds, copy=False, dtype=int)
-
-        # Assert that the query particle is returned by the tree query. Otherwise the program fails
-        assert query_part_inds.size != 0, 'Must always return particle that you are sitting on'
-
-        # Find only the particles not already in a halo
-        new_parts = query_part_inds[
-            np.where(part_haloids[query_part_inds] == -1)]
-
-        # If only one particle is returned by the query and it is new it is a 'single particle halo'
-        if new_parts.size == query_part_inds.size == 1:
-
-            # Assign the 'single particle halo' halo ID to the particle
-            part_haloids[new_parts] = -2
-
-        # If all particles are new increment the halo ID and assign a new halo
-        elif new_parts.size == query_part_inds.size:
-
-            # Increment the halo ID by 1 (initialising a new halo)
-            ihaloid += 1
-
-            # Assign the new halo ID to the particles
-            part_haloids[new_parts] = ihaloid
-            assigned_parts[ihaloid] = set(new_parts)
-
-            # Assign the final halo ID to be the newly assigned halo ID
-            final_halo_ids[ihaloid] = ihaloid
-            linked_halos_dict[ihaloid] = {ihaloid}
-
-        else:
-
-            # ===== Get the 'final halo ID value' =====
-
-            # Extract the IDs of halos returned by the query
-            contained_halos = part_haloids[query_part_inds]
-
-            # Get only the unique halo IDs
-            uni_cont_halos = np.unique(contained_halos)
-
-            # # Assure no single particle halos are included in the query results
-            # assert any(uni_cont_halos != -2), 'Single particle halos should never be found'
-
-            # Remove any unassigned halos
-            uni_cont_halos = uni_cont_halos[np.where(uni_cont_halos != -1)]
-
-            # If there is only one halo ID returned avoid the slower code to combine IDs
-            if uni_cont_halos.size == 1:
-
-                # Get the list of linked halos linked to the current halo from the linked halo dictionary
-                linked_halos = linked_halos_dict[uni_cont_halos[0]]
-
-            else:
-
-                # Get all the linked halos from dictionary so as to not miss out any halos IDs that are linked
-                # but not returned by this particular query
-                linked_halos_set = set()  # initialise linked halo set
-                linked_halos = linked_halos_set.union(
-                    *[linked_halos_dict.get(halo) for halo in uni_cont_halos])
-
-            # Find the minimum halo ID to make the final halo ID
-            final_ID = min(linked_halos)
+    query = tree.query_ball_point(pos, r=linkl, return_sorted=False)
 
-            # Assign the linked halos to all the entries in the linked halos dictionary
-            linked_halos_dict.update(
-                dict.fromkeys(list(linked_halos), linked_halos))
-
-            # Assign the final halo ID array entries
-            final_halo_ids[list(linked_halos)] = final_ID
-
-            # Assign new particles to the particle halo IDs array with the final ID
-            part_haloids[new_parts] = final_ID
-
-            # Assign the new particles to the final ID in halo dictionary entry
-            assigned_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Halos To Their Final Halo ID ===============
-
-    # Loop over initial halo IDs reassigning them to the final halo ID
-    for halo_id in list(assigned_parts.keys()):
-
-        # Extract the final halo value
-        final_ID = final_halo_ids[halo_id]
-
-        # Assign this final ID to all the particles in the initial halo ID
-        part_haloids[list(assigned_parts[halo_id])] = final_ID
-        assigned_parts[final_ID].update(assigned_parts[halo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if halo_id != final_ID:
-            del assigned_parts[halo_id]
+    # Halos are the connected components of the neighbour lists, particles
+    # not returned by any query are left unassigned (-1)
+    part_haloids, assigned_parts = fof.find_groups_query(query, npart)
 
     return part_haloids, assigned_parts
 
 
-def find_subhalos(halo_pos, sub_linkl):
-    """ A function that finds subhalos within host halos by applying the same KD-Tree algorithm at a
-    higher overdensity.
-    :param halo_pos: The position vectors of particles within the host halo.
-    :param sub_llcoeff: The linking length coefficient used to define a subhalo.
-    :param boxsize: The length of the simulation box along one axis.
-    :param npart: The number of particles in the simulation.
-    :return: part_subhaloids: The array of subhalo IDs assigned to each particle in the host halo
+def find_subhalos(halo_pairs, npart, sub_linkls):
+    """ A function that finds subhalos within host halos by linking particles at a higher
+    overdensity. The links are taken from the host's pairs (found with the spatial search's tree)
+    so no tree is built or queried, and every substructure level is found in a single pass over
+    the pairs sorted by separation.
+    :param halo_pairs: The pairs of linked particles within the host halo and their separations.
+    :param npart: The number of particles in the host halo.
+    :param sub_linkls: The linking length used to define each level of substructure.
+    :return: A list containing, for each level,
+             part_subhaloids: The array of subhalo IDs assigned to each particle in the host halo
              (where the index is the particle ID).
              assignedsub_parts: A dictionary containing the particle IDs assigned to each subhalo.
     """
 
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
-    # Initialise arrays and dictionaries for storing subhalo data
-    part_subhaloids = np.full(halo_pos.shape[0], -1,
-                              dtype=int)  # subhalo ID of the halo each particle is in
-    assignedsub_parts = defaultdict(
-        set)  # Dictionary to store the particles in a particular subhalo
-    # A dictionary where each key is an initial subhalo ID and the item is the subhalo IDs it has been linked with
-    linked_subhalos_dict = defaultdict(set)
-    # Final subhalo ID of linked halos (index is initial subhalo ID)
-    final_subhalo_ids = np.full(halo_pos.shape[0], -1, dtype=int)
-
-    # Initialise subhalo ID counter (IDs start at 0)
-    isubhaloid = -1
-
-    npart = halo_pos.shape[0]
-
-    # Build the halo kd tree
-    tree = cKDTree(halo_pos, leafsize=32, compact_nodes=True,
-                   balanced_tree=True)
-
-    query = tree.query_ball_point(halo_pos, r=sub_linkl)
-
-    # Loop through query results
-    for query_part_inds in iter(query):
-
-        # Convert the particle index list to an array for ease of use.
-        query_part_inds = np.array(query_part_inds, copy=False, dtype=int)
-
-        # Assert that the query particle is returned by the tree query. Otherwise the program fails
-        assert query_part_inds.size != 0, 'Must always return particle that you are sitting on'
-
-        # Find only the particles not already in a halo
-        new_parts = query_part_inds[
-            np.where(part_subhaloids[query_part_inds] == -1)]
-
-        # If only one particle is returned by the query and it is new it is a 'single particle subhalo'
-        if new_parts.size == query_part_inds.size == 1:
-
-            # Assign the 'single particle subhalo' subhalo ID to the particle
-            part_subhaloids[new_parts] = -2
-
-        # If all particles are new increment the subhalo ID and assign a new subhalo ID
-        elif new_parts.size == query_part_inds.size:
-
-            # Increment the subhalo ID by 1 (initialise new halo)
-            isubhaloid += 1
-
-            # Assign the subhalo ID to the particles
-            part_subhaloids[new_parts] = isubhaloid
-            assignedsub_parts[isubhaloid] = set(new_parts)
-
-            # Assign the final subhalo ID to be the newly assigned subhalo ID
-            final_subhalo_ids[isubhaloid] = isubhaloid
-            linked_subhalos_dict[isubhaloid] = {isubhaloid}
-
-        else:
-
-            # ===== Get the 'final subhalo ID value' =====
-
-            # Extract the IDs of subhalos returned by the query
-            contained_subhalos = part_subhaloids[query_part_inds]
-
-            # Return only the unique subhalo IDs
-            uni_cont_subhalos = np.unique(contained_subhalos)
-
-            # # Assure no single particles are returned by the query
-            # assert any(uni_cont_subhalos != -2), 'Single particle halos should never be found'
+    # Subhalos are the connected components of the pairs within each
+    # subhalo linking length
+    levels = fof.find_groups_hierarchy(npart, *halo_pairs, sub_linkls)
 
-            # Remove any unassigned subhalos
-            uni_cont_subhalos = uni_cont_subhalos[
-                np.where(uni_cont_subhalos != -1)]
-
-            # If there is only one subhalo ID returned avoid the slower code to combine IDs
-            if uni_cont_subhalos.size == 1:
-
-                # Get the list of linked subhalos linked to the current subhalo from the linked subhalo dictionary
-                linked_subhalos = linked_subhalos_dict[uni_cont_subhalos[0]]
-
-            else:
-
-                # Get all linked subhalos from the dictionary so as to not miss out any subhalos IDs that are linked
-                # but not returned by this particular query
-                linked_subhalos_set = set()  # initialise linked subhalo set
-                linked_subhalos = linked_subhalos_set.union(
-                    *[linked_subhalos_dict.get(subhalo)
-                      for subhalo in uni_cont_subhalos])
-
-            # Find the minimum subhalo ID to make the final subhalo ID
-            final_ID = min(linked_subhalos)
-
-            # Assign the linked subhalos to all the entries in the linked subhalos dict
-            linked_subhalos_dict.update(
-                dict.fromkeys(list(linked_subhalos), linked_subhalos))
-
-            # Assign the final subhalo array
-            final_subhalo_ids[list(linked_subhalos)] = final_ID
-
-            # Assign new parts to the subhalo IDs with the final ID
-            part_subhaloids[new_parts] = final_ID
-
-            # Assign the new particles to the final ID particles in subhalo dictionary entry
-            assignedsub_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Subhalos To Their Final Subhalo ID ===============
-
-    # Loop over initial subhalo IDs reassigning them to the final subhalo ID
-    for subhalo_id in list(assignedsub_parts.keys()):
-
-        # Extract the final subhalo value
-        final_ID = final_subhalo_ids[subhalo_id]
-
-        # Assign this final ID to all the particles in the initial subhalo ID
-        part_subhaloids[list(assignedsub_parts[subhalo_id])] = final_ID
-        assignedsub_parts[final_ID].update(assignedsub_parts[subhalo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if subhalo_id != final_ID:
-            assignedsub_parts.pop(subhalo_id)
-
-    return part_subhaloids, assignedsub_parts
+    return levels
 
 
 def find_phase_space_halos(halo_phases):
-    # =============== Initialise The Halo Finder Variables/Arrays and The KD-Tree ===============
-
-    # Initialise arrays and dictionaries for storing halo data
-    phase_part_haloids = np.full(halo_phases.shape[0], -1,
-                                 dtype=int)  # halo ID of the halo each particle is in
-    phase_assigned_parts = {}  # Dictionary to store the particles in a particular halo
-    # A dictionary where each key is an initial subhalo ID and the item is the subhalo IDs it has been linked with
-    phase_linked_halos_dict = {}
-    # Final halo ID of linked halos (index is initial halo ID)
-    final_phasehalo_ids = np.full(halo_phases.shape[0], -1, dtype=int)
-
-    # Initialise subhalo ID counter (IDs start at 0)
-    ihaloid = -1
 
     # Initialise the halo kd tree in 6D phase space
     halo_tree = cKDTree(halo_phases, leafsize=16, compact_nodes=True,
                         balanced_tree=True)
 
-    query = halo_tree.query_ball_point(halo_phases, r=np.sqrt(2))
-
-    # Loop through query results assigning initial halo IDs
-    for query_part_inds in iter(query):
-
-        query_part_inds = np.array(query_part_inds, dtype=int)
-
-        # If only one particle is returned by the query and it is new it is a 'single particle halo'
-        if query_part_inds.size == 1:
-            # Assign the 'single particle halo' halo ID to the particle
-            phase_part_haloids[query_part_inds] = -2
-
-        # # Find the previous halo ID associated to these particles
-        # this_halo_ids = halo_ids[query_part_inds]
-        # uni_this_halo_ids = set(this_halo_ids)
-        # if len(uni_this_halo_ids) > 1:
-        #     query_part_inds = query_part_inds[np.where(this_halo_ids == this_halo_ids[0])]
-
-        # Find only the particles not already in a halo
-        new_parts = query_part_inds[
-            np.where(phase_part_haloids[query_part_inds] < 0)]
-
-        # If all particles are new increment the halo ID and assign a new halo
-        if new_parts.size == query_part_inds.size:
-
-            # Increment the halo ID by 1 (initialising a new halo)
-            ihaloid += 1
-
-            # Assign the new halo ID to the particles
-            phase_part_haloids[new_parts] = ihaloid
-            phase_assigned_parts[ihaloid] = set(new_parts)
-
-            # Assign the final halo ID to be the newly assigned halo ID
-            final_phasehalo_ids[ihaloid] = ihaloid
-            phase_linked_halos_dict[ihaloid] = {ihaloid}
-
-        else:
-
-            # ===== Get the 'final halo ID value' =====
-
-            # Extract the IDs of halos returned by the query
-            contained_halos = phase_part_haloids[query_part_inds]
-
-            # Get only the unique halo IDs
-            uni_cont_halos = np.unique(contained_halos)
-
-            # Remove any unassigned halos
-            uni_cont_halos = uni_cont_halos[np.where(uni_cont_halos >= 0)]
-
-            # If there is only one halo ID returned avoid the slower code to combine IDs
-            if uni_cont_halos.size == 1:
-
-                # Get the list of linked halos linked to the current halo from the linked halo dictionary
-                linked_halos = phase_linked_halos_dict[uni_cont_halos[0]]
-
-            elif uni_cont_halos.size == 0:
-                continue
-
-            else:
-
-                # Get all the linked halos from dictionary so as to not miss out any halos IDs that are linked
-                # but not returned by this particular query
-                linked_halos_set = set()  # initialise linked halo set
-                linked_halos = linked_halos_set.union(
-                    *[phase_linked_halos_dict.get(halo)
-                      for halo in uni_cont_halos])
-
-            # Find the minimum halo ID to make the final halo ID
-            final_ID = min(linked_halos)
-
-            # Assign the linked halos to all the entries in the linked halos dictionary
-            phase_linked_halos_dict.update(
-                dict.fromkeys(list(linked_halos), linked_halos))
-
-            # Assign the final halo ID array entries
-            final_phasehalo_ids[list(linked_halos)] = final_ID
-
-            # Assign new particles to the particle halo IDs array with the final ID
-            phase_part_haloids[new_parts] = final_ID
-
-            # Assign the new particles to the final ID in halo dictionary entry
-            phase_assigned_parts[final_ID].update(new_parts)
-
-    # =============== Reassign All Halos To Their Final Halo ID ===============
-
-    # Loop over initial halo IDs reassigning them to the final halo ID
-    for halo_id in list(phase_assigned_parts.keys()):
-
-        # Extract the final halo value
-        final_ID = final_phasehalo_ids[halo_id]
-
-        # Assign this final ID to all the particles in the initial halo ID
-        phase_part_haloids[list(phase_assigned_parts[halo_id])] = final_ID
-        phase_assigned_parts[final_ID].update(phase_assigned_parts[halo_id])
-
-        # Remove non final ID entry from dictionary to save memory
-        if halo_id != final_ID:
-            phase_assigned_parts.pop(halo_id)
+    # Halos are the connected components of the pairs linked in both
+    # space and velocity
+    phase_part_haloids, phase_assigned_parts = fof.find_groups_tree(halo_tree,
+                                                                    np.sqrt(2))
 
     return phase_part_haloids, phase_assigned_parts
 
@@ -440,31 +104,21 @@ def spatial_node_task(thisTask, pos, tree, linkl, npart):
 
 def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
                         vlinkl_halo_indp, linkl, pmass, ini_vlcoeff,
-                        decrement, redshift, G, h, soft, min_vlcoeff, cosmo):
+                        decrement, redshift, G, h, soft, min_vlcoeff, cosmo,
+                        host_pairs=None):
     # Initialise dicitonaries to store results
     results = {}
 
-    # Define the comparison particle as the maximum position
-    # in the current dimension
-    max_part_pos = halo_poss.max(axis=0)
-
-    # Compute all the halo particle separations from the maximum position
-    sep = max_part_pos - halo_poss
-
-    # If any separations are greater than 50% the boxsize
-    # (i.e. the halo is split over the boundary)
-    # bring the particles at the lower boundary together with
-    # the particles at the upper boundary (ignores halos where
-    # constituent particles aren't separated by at least 50% of the boxsize)
-    # *** Note: fails if halo's extent is greater than 50% of
-    # the boxsize in any dimension ***
-    halo_poss[np.where(sep > 0.5 * boxsize)] += boxsize
+    # Centre the particles once, every candidate below is then in these
+    # unwrapped coordinates relative to the task's centre
+    halo_poss, task_cent = utilities.periodic_centre(halo_poss, boxsize)
 
     not_real_pids = {}
     candidate_halos = {0: {"pos": halo_poss,
                            "vel": halo_vels,
                            "pid": sim_halo_pids,
-                           "vlcoeff": ini_vlcoeff}}
+                           "vlcoeff": ini_vlcoeff,
+                           "pairs": host_pairs}}
     candidateID = 0
     thisresultID = 0
 
@@ -477,6 +131,7 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
         sim_halo_pids = candidate_halo["pid"]
         halo_npart = sim_halo_pids.size
         new_vlcoeff = candidate_halo["vlcoeff"]
+        halo_pairs = candidate_halo["pairs"]
 
         new_vlcoeff -= decrement * new_vlcoeff
 
@@ -489,7 +144,7 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
         ini_cent = np.mean(halo_poss, axis=0)
         sep = cosmo.H(redshift).value * (halo_poss - ini_cent) * (
                     1 + redshift) ** -0.5
-        halo_vels += sep
+        halo_vels = halo_vels + sep
 
         # Define the phase space vectors for this halo
         halo_phases = np.concatenate((halo_poss / linkl,
@@ -516,6 +171,14 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
             this_halo_vel = halo_vels[this_halo_pids, :]
             this_sim_halo_pids = sim_halo_pids[this_halo_pids]
 
+            # Keep the host pairs linking this halo's particles
+            if halo_pairs is not None:
+                this_halo_pairs = fof.get_subset_pairs(*halo_pairs,
+                                                       sim_halo_pids.size,
+                                                       this_halo_pids)
+            else:
+                this_halo_pairs = None
+
             # Compute the centred positions and velocities
             mean_halo_pos = this_halo_pos.mean(axis=0)
             mean_halo_vel = this_halo_vel.mean(axis=0)
@@ -563,6 +226,8 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
                                          "vmax": vmax,
                                          "hmr": hmr,
                                          "hmvr": hmvr}
+                if this_halo_pairs is not None:
+                    results[thisresultID]["pairs"] = this_halo_pairs
 
                 thisresultID += 1
 
@@ -600,6 +265,8 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
                                          "vmax": vmax,
                                          "hmr": hmr,
                                          "hmvr": hmvr}
+                if this_halo_pairs is not None:
+                    results[thisresultID]["pairs"] = this_halo_pairs
 
                 thisresultID += 1
 
@@ -610,7 +277,8 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
                                                 "vel": (this_halo_vel
                                                         + mean_halo_vel),
                                                 "pid": this_sim_halo_pids,
-                                                "vlcoeff": new_vlcoeff}
+                                                "vlcoeff": new_vlcoeff,
+                                                "pairs": this_halo_pairs}
 
                 candidateID += 1
                 thiscontID += 1
@@ -632,6 +300,14 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
             this_halo_vel = halo_vels[this_halo_pids, :]
             this_sim_halo_pids = sim_halo_pids[this_halo_pids]
 
+            # Keep the host pairs linking this halo's particles
+            if halo_pairs is not None:
+                this_halo_pairs = fof.get_subset_pairs(*halo_pairs,
+                                                       sim_halo_pids.size,
+                                                       this_halo_pids)
+            else:
+                this_halo_pairs = None
+
             # Compute the centred positions and velocities
             mean_halo_pos = this_halo_pos.mean(axis=0)
             mean_halo_vel = this_halo_vel.mean(axis=0)
@@ -683,33 +359,206 @@ def get_real_host_halos(sim_halo_pids, halo_poss, halo_vels, boxsize,
                                      "vmax": vmax,
                                      "hmr": hmr,
                                      "hmvr": hmvr}
+            if this_halo_pairs is not None:
+                results[thisresultID]["pairs"] = this_halo_pairs
 
             thisresultID += 1
 
+    # Shift the mean positions back into the box
+    for res in results.values():
+        res["mean_halo_pos"] = (res["mean_halo_pos"] + task_cent) % boxsize
+
     return results
 
 
-def get_sub_halos(halo_pids, halo_pos, sub_linkl):
-    # Do a spatial search for subhalos
-    part_subhaloids, assignedsub_parts = find_subhalos(halo_pos, sub_linkl)
+def get_sub_halos(halo_pids, halo_pairs, sub_linkls):
+    # Do a spatial search for subhalos at every level
+    levels = find_subhalos(halo_pairs, halo_pids.size, sub_linkls)
 
-    # Get the positions
+    # Get the particle IDs, keyed by level (counting the host as level 0)
     subhalo_pids = {}
-    for halo in assignedsub_parts:
-        subhalo_pids[halo] = halo_pids[list(assignedsub_parts[halo])]
+    for ind, (part_subhaloids, assignedsub_parts) in enumerate(levels):
+        for halo in assignedsub_parts:
+            subhalo_pids[(ind + 1, halo)] = halo_pids[
+                list(assignedsub_parts[halo])]
 
     return subhalo_pids
 
 
+def sub_phase_task(sub, boxsize, sub_vlinkl_indps, sub_linkls, pmass,
+                   ini_vlcoeff, decrement, redshift, G, h, soft, min_vlcoeff,
+                   cosmo):
+    """ Test a single spatial subhalo in phase space. This is module level
+        so it can be sent to a pool of worker processes.
+
+    :param sub: A tuple of the subhalo's level, sorted particle IDs,
+                positions and velocities.
+    :return: A list of the subhalo's phase space halos.
+    """
+
+    level, pids, pos, vel = sub
+
+    result = get_real_host_halos(pids, pos, vel, boxsize,
+                                 sub_vlinkl_indps[level - 1],
+                                 sub_linkls[level - 1], pmass, ini_vlcoeff,
+                                 decrement, redshift, G, h, soft,
+                                 min_vlcoeff, cosmo)
+
+    results = []
+    for key in sorted(result):
+        res = result[key]
+        res["level"] = level
+        results.append(res)
+
+    return results
+
+
+def get_host_subhalos(result, host_pids, host_pos, host_vel, sub_linkls,
+                      phase_func, pool=None, prof_d=None):
+    """ Find the subhalos of a task's host halos and test them in phase
+        space. The subhalos' positions and velocities are sliced from the
+        host task's arrays rather than read from the input file.
+
+    :param result: The host halos from get_real_host_halos (their "pairs"
+                   are removed).
+    :param host_pids: The task's sorted particle IDs.
+    :param host_pos: The task's particle positions (unwrapped).
+    :param host_vel: The task's particle velocities.
+    :param sub_linkls: The linking lengths of each level of substructure.
+    :param phase_func: The function testing a subhalo in phase space
+                       (sub_phase_task with the snapshot's constants).
+    :param pool: A multiprocessing pool the subhalos are tested on, None
+                 tests them in this process.
+    :param prof_d: The profiling dictionary (None when not profiling).
+    :return: A list of the subhalos' phase space halos.
+    """
+
+    task_start = time.time()
+
+    # Get every spatial subhalo of each host, the pairs are removed from the
+    # result so they aren't collected with the halos
+    subs = []
+    for key in sorted(result):
+        res = result[key]
+        sub_result = get_sub_halos(res["pids"], res.pop("pairs"), sub_linkls)
+
+        for (level, halo), thisSub in sub_result.items():
+            thisSub.sort()
+            subs.append((level, thisSub))
+
+    task_end = time.time()
+
+    if prof_d is not None:
+        prof_d["Sub-Spatial"]["Start"].append(task_start)
+        prof_d["Sub-Spatial"]["End"].append(task_end)
+
+    task_start = time.time()
+
+    # Slice each subhalo's particles from the host task's arrays
+    def sub_tasks():
+        for level, thisSub in subs:
+            inds = np.searchsorted(host_pids, thisSub)
+            yield level, thisSub, host_pos[inds, :], host_vel[inds, :]
+
+    # Results are kept in subhalo order so the IDs don't depend on the pool
+    if pool is None:
+        sub_results = map(phase_func, sub_tasks())
+    else:
+        sub_results = pool.imap(phase_func, sub_tasks())
+
+    results = [res for sub_result in sub_results for res in sub_result]
+
+    task_end = time.time()
+
+    if prof_d is not None:
+        prof_d["Sub-Phase"]["Start"].append(task_start)
+        prof_d["Sub-Phase"]["End"].append(task_end)
+
+    return results
+
+
+def write_deep_subhalos(snap, level, level_results, part_haloids):
+    """ Write a level of substructure below the subhalos to the halo file
+        in the same format as the subhalos ("Subhalos_<level>"). The
+        host of each halo is the halo of the level above containing most of
+        its particles (-1 if none do) and the number of halos in each
+        host is written to the level above as "occupancy".
+
+    :param snap: The open halo file.
+    :param level: The level of substructure (2 for the subhalos of
+                  subhalos).
+    :param level_results: The results of the level's halos keyed by ID.
+    :param part_haloids: The halo IDs of each particle at every level.
+    :return: None
+    """
+
+    # The result for each dataset
+    keys = {'nparts': 'npart', 'mean_positions': 'mean_halo_pos',
+            'mean_velocities': 'mean_halo_vel', 'real_flag': 'real',
+            'halo_total_energies': 'halo_energy',
+            'halo_kinetic_energies': 'KE',
+            'halo_gravitational_energies': 'GE',
+            'rms_spatial_radius': 'rms_r', 'rms_velocity_radius': 'rms_vr',
+            '1D_velocity_dispersion': 'veldisp1d',
+            '3D_velocity_dispersion': 'veldisp3d', 'v_max': 'vmax',
+            'half_mass_radius': 'hmr', 'half_mass_velocity_radius': 'hmvr'}
+
+    if level == 2:
+        host_root = snap['Subhalos']
+    else:
+        host_root = snap['Subhalos_' + str(level - 1)]
+    nhost = host_root['subhalo_IDs'].size
+
+    sub_root = snap.create_group('Subhalos_' + str(level))
+
+    subhalo_ids = np.arange(len(level_results), dtype=int)
+    host_ids = np.full(subhalo_ids.size, -1, dtype=int)
+    for subhalo_id in subhalo_ids:
+        subhalo_pids = level_results[subhalo_id]['pids']
+
+        # Find the host in the level above
+        hosts = part_haloids[subhalo_pids, level - 1]
+        hosts = hosts[hosts >= 0]
+        if hosts.size > 0:
+            host_ids[subhalo_id] = np.bincount(hosts).argmax()
+
+        # Create subhalo group
+        subhalo = sub_root.create_group(str(subhalo_id))
+        subhalo.create_dataset('Halo_Part_IDs',
+                               shape=subhalo_pids.shape,
+                               dtype=int,
+                               data=subhalo_pids)
+
+    sub_root.create_dataset('subhalo_IDs', data=subhalo_ids,
+                            compression='gzip')
+    sub_root.create_dataset('host_IDs', data=host_ids, compression='gzip')
+    for key, res_key in keys.items():
+        arr = np.array([level_results[subhalo_id][res_key]
+                        for subhalo_id in subhalo_ids])
+        sub_root.create_dataset(key, data=arr, compression='gzip')
+
+    occupancy = np.bincount(host_ids[host_ids >= 0],
+                            minlength=nhost).astype(float)
+    host_root.create_dataset('occupancy', data=occupancy, compression='gzip')
+
+
 def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
                    ini_vlcoeff, min_vlcoeff, decrement, verbose, findsubs,
-                   ncells, profile, profile_path, cosmo):
+                   ncells, profile, profile_path, cosmo, deep_llcoeffs=(),
+                   sub_workers=1):
     """ Run the halo finder, sort the output results, find subhalos and
         save to a HDF5 file.
 
     :param snapshot: The snapshot ID.
     :param llcoeff: The host halo linking length coefficient.
     :param sub_llcoeff: The subhalo linking length coefficient.
+    :param deep_llcoeffs: The (decreasing) linking length coefficients of
+                          any deeper levels of substructure, each level's
+                          halos are written to "Subhalos_<level>" with the
+                          subhalos as level 1.
+    :param sub_workers: The number of processes on each rank testing a
+                        host's subhalos in phase space (1 tests them in
+                        the rank itself).
     :param gadgetpath: The filepath to the gadget simulation data.
     :param batchsize: The number of particle to be queried at one time.
     :param debug_npart: The number of particles to run the program on when
@@ -788,8 +637,12 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
     # Define and convert particle mass to M_sun
     pmass *= 1e10 * 1 / h
 
-    # Compute the linking length for subhalos
-    sub_linkl = sub_llcoeff * mean_sep
+    # Compute the linking length for each level of subhalos
+    sub_llcoeffs = [sub_llcoeff] + list(deep_llcoeffs)
+    sub_linkls = [coeff * mean_sep for coeff in sub_llcoeffs]
+
+    # The host pairs are kept out to the longest subhalo linking length
+    sub_linkl = max(sub_linkls)
 
     # Compute the mean density
     mean_den = npart * pmass * u.M_sun / boxsize ** 3 / u.Mpc ** 3 \
@@ -800,6 +653,12 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
     vlinkl_indp = (np.sqrt(G / 2) * (4 * np.pi * 200 * mean_den / 3) ** (1 / 6)
                    * (1 + redshift) ** 0.5).value
 
+    # Define the velocity space linking length for each level of subhalos,
+    # the overdensity scales as the linking length cubed so the
+    # velocity space linking length scales as its square root
+    sub_vlinkl_indps = [vlinkl_indp * (llcoeff / coeff) ** (1 / 2)
+                        for coeff in sub_llcoeffs]
+
     if profile:
         prof_d["Housekeeping"]["Start"].append(set_up_start)
         prof_d["Housekeeping"]["End"].append(time.time())
@@ -1003,6 +862,27 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
     haloID = 0
     subhaloID = 0
 
+    if findsubs:
+
+        # Fix this snapshot's constants of the subhalo phase space test
+        sub_phase_func = functools.partial(sub_phase_task, boxsize=boxsize,
+                                           sub_vlinkl_indps=sub_vlinkl_indps,
+                                           sub_linkls=sub_linkls, pmass=pmass,
+                                           ini_vlcoeff=ini_vlcoeff,
+                                           decrement=decrement,
+                                           redshift=redshift, G=G, h=h,
+                                           soft=soft, min_vlcoeff=min_vlcoeff,
+                                           cosmo=cosmo)
+
+        # Fork the pool once for all of this rank's tasks
+        if sub_workers > 1:
+            sub_pool = multiprocessing.get_context('fork').Pool(
+                processes=sub_workers)
+        else:
+            sub_pool = None
+
+    sub_prof_d = prof_d if profile else None
+
     if profile:
         prof_d["Housekeeping"]["Start"].append(set_up_start)
         prof_d["Housekeeping"]["End"].append(time.time())
@@ -1087,12 +967,22 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
 
                     task_start = time.time()
 
+                    # Get the pairs of host particles within the subhalo
+                    # linking length from the spatial search's tree, these
+                    # are reused to find the subhalos
+                    if findsubs:
+                        host_pairs = fof.get_tree_pairs(tree, thisTask,
+                                                        sub_linkl, boxsize)
+                    else:
+                        host_pairs = None
+
                     # Do the work here
                     result = get_real_host_halos(thisTask, pos, vel, boxsize,
                                                  vlinkl_indp, linkl, pmass,
                                                  ini_vlcoeff, decrement,
                                                  redshift, G, h, soft,
-                                                 min_vlcoeff, cosmo)
+                                                 min_vlcoeff, cosmo,
+                                                 host_pairs=host_pairs)
 
                     # Save results
                     for res in result:
@@ -1108,109 +998,18 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
 
                     if findsubs:
 
-                        spatial_sub_results = {}
-
-                        # Loop over results getting spatial halos
-                        while len(result) > 0:
-
-                            read_start = time.time()
-
-                            key, res = result.popitem()
-
-                            thishalo_pids = np.sort(res["pids"])
-
-                            # Open hdf5 file
-                            hdf = h5py.File(inputpath
-                                            + "mega_inputs_"
-                                            + snapshot + ".hdf5", 'r')
-
-                            # Get the position and velocity of each
-                            # particle in this rank
-                            subhalo_poss = hdf['part_pos'][thishalo_pids, :]
-
-                            hdf.close()
-
-                            read_end = time.time()
-
-                            if profile:
-                                prof_d["Reading"]["Start"].append(read_start)
-                                prof_d["Reading"]["End"].append(read_end)
-
-                            task_start = time.time()
-
-                            # Do the work here
-                            sub_result = get_sub_halos(thishalo_pids,
-                                                       subhalo_poss,
-                                                       sub_linkl)
-
-                            while len(sub_result) > 0:
-                                key, res = sub_result.popitem()
-                                spatial_sub_results[subhaloID] = res
-
-                                subhaloID += 1
-
-                            task_end = time.time()
-
-                            if profile:
-                                prof_d["Sub-Spatial"]["Start"].append(
-                                    task_start)
-                                prof_d["Sub-Spatial"]["End"].append(task_end)
-
-                        # Loop over spatial subhalos
-                        while len(spatial_sub_results) > 0:
-
-                            read_start = time.time()
-
-                            key, thisSub = spatial_sub_results.popitem()
+                        # Find and test this host's subhalos using the host's
+                        # particles already in memory
+                        sub_result = get_host_subhalos(result, thisTask, pos,
+                                                       vel, sub_linkls,
+                                                       sub_phase_func,
+                                                       sub_pool, sub_prof_d)
 
-                            thisSub.sort()
-
-                            # Open hdf5 file
-                            hdf = h5py.File(inputpath
-                                            + "mega_inputs_"
-                                            + snapshot + ".hdf5", 'r')
-
-                            # Get the position and velocity of each
-                            # particle in this rank
-                            pos = hdf['part_pos'][thisSub, :]
-                            vel = hdf['part_vel'][thisSub, :]
-
-                            hdf.close()
-
-                            read_end = time.time()
-
-                            if profile:
-                                prof_d["Reading"]["Start"].append(read_start)
-                                prof_d["Reading"]["End"].append(read_end)
-
-                            task_start = time.time()
-
-                            # Do the work here
-                            result = get_real_host_halos(thisSub, pos, vel,
-                                                         boxsize,
-                                                         vlinkl_indp
-                                                         * (1600 / 200)
-                                                         ** (1 / 6),
-                                                         sub_linkl, pmass,
-                                                         ini_vlcoeff,
-                                                         decrement,
-                                                         redshift,
-                                                         G, h, soft,
-                                                         min_vlcoeff,
-                                                         cosmo)
-
-                            # Save results
-                            while len(result) > 0:
-                                key, res = result.popitem()
-                                sub_results[(rank, subhaloID)] = res
-
-                                subhaloID += 1
-
-                            task_end = time.time()
+                        # Save results
+                        for res in sub_result:
+                            sub_results[(rank, subhaloID)] = res
 
-                            if profile:
-                                prof_d["Sub-Phase"]["Start"].append(task_start)
-                                prof_d["Sub-Phase"]["End"].append(task_end)
+                            subhaloID += 1
 
             elif len(halo_tasks) == 0:
 
@@ -1263,11 +1062,21 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
 
                 task_start = time.time()
 
+                # Get the pairs of host particles within the subhalo
+                # linking length from the spatial search's tree, these
+                # are reused to find the subhalos
+                if findsubs:
+                    host_pairs = fof.get_tree_pairs(tree, thisTask,
+                                                    sub_linkl, boxsize)
+                else:
+                    host_pairs = None
+
                 # Do the work here
                 result = get_real_host_halos(thisTask, pos, vel, boxsize,
                                              vlinkl_indp, linkl, pmass,
                                              ini_vlcoeff, decrement, redshift,
-                                             G, h, soft, min_vlcoeff, cosmo)
+                                             G, h, soft, min_vlcoeff, cosmo,
+                                             host_pairs=host_pairs)
 
                 # Save results
                 for res in result:
@@ -1283,110 +1092,28 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
 
                 if findsubs:
 
-                    spatial_sub_results = {}
-
-                    # Loop over results getting spatial halos
-                    while len(result) > 0:
-
-                        read_start = time.time()
-
-                        key, res = result.popitem()
-
-                        thishalo_pids = np.sort(res["pids"])
-
-                        # Open hdf5 file
-                        hdf = h5py.File(inputpath
-                                        + "mega_inputs_"
-                                        + snapshot + ".hdf5", 'r')
-
-                        # Get the position and velocity of each
-                        # particle in this rank
-                        subhalo_poss = hdf['part_pos'][thishalo_pids, :]
-
-                        hdf.close()
+                    # Find and test this host's subhalos using the host's
+                    # particles already in memory
+                    sub_result = get_host_subhalos(result, thisTask, pos,
+                                                   vel, sub_linkls,
+                                                   sub_phase_func, sub_pool,
+                                                   sub_prof_d)
 
-                        read_end = time.time()
-
-                        if profile:
-                            prof_d["Reading"]["Start"].append(read_start)
-                            prof_d["Reading"]["End"].append(read_end)
-
-                        task_start = time.time()
-
-                        # Do the work here
-                        sub_result = get_sub_halos(thishalo_pids,
-                                                   subhalo_poss,
-                                                   sub_linkl)
-
-                        while len(sub_result) > 0:
-                            key, res = sub_result.popitem()
-                            spatial_sub_results[subhaloID] = res
-
-                            subhaloID += 1
-
-                        task_end = time.time()
-
-                        if profile:
-                            prof_d["Sub-Spatial"]["Start"].append(task_start)
-                            prof_d["Sub-Spatial"]["End"].append(task_end)
-
-                    # Loop over spatial subhalos
-                    while len(spatial_sub_results) > 0:
-
-                        read_start = time.time()
-
-                        key, thisSub = spatial_sub_results.popitem()
-
-                        thisSub.sort()
-
-                        # Open hdf5 file
-                        hdf = h5py.File(inputpath
-                                        + "mega_inputs_"
-                                        + snapshot + ".hdf5", 'r')
-
-                        # Get the position and velocity of each
-                        # particle in this rank
-                        pos = hdf['part_pos'][thisSub, :]
-                        vel = hdf['part_vel'][thisSub, :]
-
-                        hdf.close()
-
-                        read_end = time.time()
-
-                        if profile:
-                            prof_d["Reading"]["Start"].append(read_start)
-                            prof_d["Reading"]["End"].append(read_end)
-
-                        task_start = time.time()
-
-                        # Do the work here
-                        result = get_real_host_halos(thisSub, pos, vel,
-                                                     boxsize,
-                                                     vlinkl_indp
-                                                     * (1600 / 200) ** (1 / 6),
-                                                     sub_linkl, pmass,
-                                                     ini_vlcoeff, decrement,
-                                                     redshift, G, h, soft,
-                                                     min_vlcoeff, cosmo)
-
-                        # Save results
-                        while len(result) > 0:
-                            key, res = result.popitem()
-                            sub_results[(rank, subhaloID)] = res
-
-                            subhaloID += 1
-
-                        task_end = time.time()
+                    # Save results
+                    for res in sub_result:
+                        sub_results[(rank, subhaloID)] = res
 
-                        if profile:
-                            prof_d["Sub-Phase"]["Start"].append(task_start)
-                            prof_d["Sub-Phase"]["End"].append(task_end)
+                        subhaloID += 1
 
             elif tag == tags.EXIT:
                 break
 
         comm.send(None, dest=0, tag=tags.EXIT)
 
+    if findsubs and sub_pool is not None:
+        sub_pool.close()
+        sub_pool.join()
+
     # Collect child process results
     collect_start = time.time()
     collected_results = comm.gather(results, root=0)
@@ -1406,9 +1133,11 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
         print([len(res) for res in sub_collected_results])
 
         newPhaseID = 0
-        newPhaseSubID = 0
+        newPhaseSubIDs = [0] * len(sub_llcoeffs)
 
-        phase_part_haloids = np.full((npart, 2), -2, dtype=np.int32)
+        # Particle halo IDs for hosts and each level of subhalos
+        phase_part_haloids = np.full((npart, 1 + len(sub_llcoeffs)), -2,
+                                     dtype=np.int32)
 
         # Collect host halo results
         results_dict = {}
@@ -1420,16 +1149,20 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
                 phase_part_haloids[pids, 0] = newPhaseID
                 newPhaseID += 1
 
-        # Collect subhalo results
-        sub_results_dict = {}
+        # Collect subhalo results, the IDs of each level start at 0
+        sub_results_dicts = [{} for coeff in sub_llcoeffs]
         for subhalo_task in sub_collected_results:
             for subhalo in subhalo_task:
-                sub_results_dict[(subhalo, newPhaseSubID)] = subhalo_task[
-                    subhalo]
+                level = subhalo_task[subhalo]['level']
+                newPhaseSubID = newPhaseSubIDs[level - 1]
+                sub_results_dicts[level - 1][(subhalo, newPhaseSubID)] = \
+                    subhalo_task[subhalo]
                 pids = subhalo_task[subhalo]['pids']
                 subhaloID_dict[(subhalo, newPhaseSubID)] = newPhaseSubID
-                phase_part_haloids[pids, 1] = newPhaseSubID
-                newPhaseSubID += 1
+                phase_part_haloids[pids, level] = newPhaseSubID
+                newPhaseSubIDs[level - 1] += 1
+        sub_results_dict = sub_results_dicts[0]
+        newPhaseSubID = newPhaseSubIDs[0]
 
         if verbose:
             print("Combining the results took", time.time() - collect_start,
@@ -1571,6 +1304,8 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
 
         # Assign snapshot attributes
         snap.attrs['linking_length'] = linkl  # host halo linking length
+        if findsubs:
+            snap.attrs['sub_linking_lengths'] = sub_linkls
         # snap.attrs['rhocrit'] = rhocrit  # critical density parameter
         snap.attrs['redshift'] = redshift
         # snap.attrs['time'] = t
@@ -1680,12 +1415,8 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
                             data=hmvrs,
                             compression='gzip')
 
-        # Assign the full halo IDs array to the snapshot group
-        snap.create_dataset('particle_halo_IDs',
-                            shape=phase_part_haloids.shape,
-                            dtype=int,
-                            data=phase_part_haloids,
-                            compression='gzip')
+        # Write the halo ID of every particle at each level
+        utilities.write_part_haloids(snap, phase_part_haloids)
 
         # Get how many halos were found be real
         print("Halos found to initially not be real:",
@@ -1819,6 +1550,15 @@ def hosthalofinder(snapshot, llcoeff, sub_llcoeff, inputpath, savepath,
                             data=nsubhalos,
                             compression='gzip')
 
+        # Write any deeper levels of substructure
+        if findsubs:
+            for level in range(2, len(sub_llcoeffs) + 1):
+                level_results = {subhaloID_dict[key]: res for key, res
+                                 in sub_results_dicts[level - 1].items()}
+                print(len(level_results), "level", level, "subhalos found")
+                write_deep_subhalos(snap, level, level_results,
+                                    phase_part_haloids)
+
         snap.close()
 
         if profile:
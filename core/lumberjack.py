@@ -1,6 +1,5 @@
 import numpy as np
 import h5py
-from kdhalofinder import read_sim
 from shutil import copyfile
 import multiprocessing as mp
 from itertools import combinations
@@ -14,10 +13,16 @@ import numba as nb
 import pprint
 import warnings
 import sys
+import utilities
 
 warnings.filterwarnings('ignore')
 
 
+# The particle data of the snapshot being split. This is set in snapHaloSplitterLoop before the
+# worker pool is forked so every worker inherits it read only rather than each rereading the snapshot
+snap_data = None
+
+
 @nb.njit(nogil=True, parallel=True)
 def rms_rad(pos, cent):
 
@@ -123,20 +128,19 @@ def halo_energy_calc_exact(halo_poss, halo_vels, halo_npart, pmass, redshift, G,
     return halo_energy, KE, GE
 
 
-@nb.jit(nogil=True, parallel=True)
 def calc_overlap(halo1_poss, halo2_poss, halo1_vels, halo2_vels, boxsize):
 
-    # Wrap halos and get spatial centres
-    halo1_poss, cent1 = wrap_halo(halo1_poss, boxsize)
-    halo2_poss, cent2 = wrap_halo(halo2_poss, boxsize)
+    # Get the spatial centres and positions relative to them
+    halo1_poss, cent1 = utilities.periodic_centre(halo1_poss, boxsize)
+    halo2_poss, cent2 = utilities.periodic_centre(halo2_poss, boxsize)
 
     # Get halo velocity centres
     vcent1 = np.mean(halo1_vels, axis=0)
     vcent2 = np.mean(halo2_vels, axis=0)
 
     # Get halp radii
-    R1 = rms_rad(halo1_poss, cent1)
-    R2 = rms_rad(halo2_poss, cent2)
+    R1 = rms_rad(halo1_poss, np.zeros(3))
+    R2 = rms_rad(halo2_poss, np.zeros(3))
     vR1 = rms_rad(halo1_vels, vcent1)
     vR2 = rms_rad(halo2_vels, vcent2)
 
@@ -154,491 +158,524 @@ def calc_overlap(halo1_poss, halo2_poss, halo1_vels, halo2_vels, boxsize):
     return overlap, voverlap
 
 
-@nb.jit(nogil=True, parallel=True)
-def wrap_halo(halo_poss, boxsize):
+def read_part_haloids(halopath, snap):
+    """ A function to read the host halo ID of every particle in a snapshot's halo catalogue.
+
+    :param halopath: The filepath of the halo catalogues.
+    :param snap: The snapshot ID.
+    :return: part_haloids: The host halo ID of each particle (-2 for particles not in a halo).
+             reals: The real flag of each halo, including the updates from the linking.
+    """
+
+    hdf = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+
+    part_haloids = utilities.read_part_haloids(hdf, 0).astype(np.int64)
+
+    hdf.close()
+
+    # Include the reality flag updates made by the linking
+    reals = utilities.read_real_flags(halopath, snap)
 
-    # Define the comparison particle as the maximum position in the current dimension
-    max_part_pos = halo_poss.max(axis=0)
+    return part_haloids, reals
 
-    # Compute all the halo particle separations from the maximum position
-    sep = max_part_pos - halo_poss
 
-    # If any separations are greater than 50% the boxsize (i.e. the halo is split over the boundary)
-    # bring the particles at the lower boundary together with the particles at the upper boundary
-    # (ignores halos where constituent particles aren't separated by at least 50% of the boxsize)
-    # *** Note: fails if halo's extent is greater than 50% of the boxsize in any dimension ***
-    halo_poss[np.where(sep > 0.5 * boxsize)] += boxsize
+def get_split_shares(totals, weights, groups):
+    """ A function to share an integer total between the members of each group in proportion to their
+    weights. The shares are rounded down and the remainder is given one at a time to the members with
+    the largest fractional parts (ties go to the first member) so each group's shares sum to its total.
+
+    :param totals: The total to share for each member's group.
+    :param weights: The weight of each member.
+    :param groups: The group of each member, members must be sorted by group.
+    :return: The integer share of each member.
+    """
 
-    # Compute the shifted mean position in the dimension ixyz
-    mean_halo_pos = halo_poss.mean(axis=0)
+    if groups.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    group_weights = np.bincount(groups, weights=weights)[groups]
+    quotas = totals * weights / group_weights
+    shares = np.floor(quotas).astype(np.int64)
 
-    # Centre the halos about the mean in the dimension ixyz
-    halo_poss -= mean_halo_pos
+    # Get the number of members in each group receiving an extra particle
+    nremain = totals - np.bincount(groups, weights=shares)[groups].astype(np.int64)
 
-    return halo_poss, mean_halo_pos
+    # Rank the members of each group by decreasing fractional part
+    sinds = np.lexsort((np.arange(groups.size), shares - quotas, groups))
+    _, group_starts, group_counts = np.unique(groups[sinds], return_index=True, return_counts=True)
+    ranks = np.arange(groups.size) - np.repeat(group_starts, group_counts)
+    shares[sinds] += ranks < nremain[sinds]
 
+    return shares
 
-def get_this_snap(halopath, snap):
 
-    # Open the unsplit halo catalogue to get halo data
-    old_hdf = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+def split_snapshot(part_haloids, desc_part_haloids, min_cont=10):
+    """ A function to split every halo in a snapshot with more than one descendant in the (already
+    split) descendant snapshot. Each halo is split into a halo per descendant it gives at least
+    min_cont particles to, holding the particles it shares with that descendant. The remaining
+    (unassociated) particles are shared between the split halos in proportion to their contribution
+    using largest remainder rounding, lowest particle IDs first. Halos with a single descendant keep
+    all their particles and halos without descendants are dropped.
 
-    # Load this snapshots particle halo ID data
-    parthaloids = old_hdf['Halo_IDs'][...]
+    :param part_haloids: The host halo ID of each particle in this snapshot.
+    :param desc_part_haloids: The host halo ID of each particle in the descendant snapshot.
+    :param min_cont: The minimum number of particles given to a descendant to count as a link.
+    :return: new_part_haloids: The split halo ID of each particle (-2 for particles not in a halo).
+             persist: Flag for particles shared with the split halo's descendant.
+             orig_ids: The original halo ID of each split halo.
+             desc_ids: The descendant halo ID of each split halo.
+             desc_conts: The number of particles each split halo gives its descendant.
+    """
 
-    # Store halo realness in array for each halo ID where the ID is the index
-    halos = np.unique(parthaloids)
-    halos = halos[np.where(halos >= 0)]
+    npart = part_haloids.size
+    nhalo = int(part_haloids.max()) + 1 if npart > 0 else 0
+    ndesc = max(int(desc_part_haloids.max()) + 1 if npart > 0 else 0, 1)
 
-    # Extract snapshot '061' halo IDs
-    halos_bound = {}
-    halos_energies = {}
-    halo_partids = {}
-    for ind, halo in enumerate(halos):
+    # Count the particles each halo gives each descendant, links below the threshold are ignored
+    parts = np.where(np.logical_and(part_haloids >= 0, desc_part_haloids >= 0))[0]
+    part_keys = part_haloids[parts] * ndesc + desc_part_haloids[parts]
+    pairs, conts = np.unique(part_keys, return_counts=True)
+    okinds = conts >= min_cont
+    pairs = pairs[okinds]
+    conts = conts[okinds]
 
-        halo = str(halo)
+    # Every (halo, descendant) pair is a split halo, ordered by original halo and then descendant
+    orig_ids = pairs // ndesc
+    desc_ids = pairs % ndesc
+    nsplit = np.bincount(orig_ids, minlength=nhalo)
 
-        print('This snapshot', snap, halo, end='\r')
-        try:
-            halo_partids[halo] = set(old_hdf[str(halo)]['Halo_Part_IDs'][...])
-            halos_bound[halo] = old_hdf[str(halo)].attrs['Real']
-            halos_energies[halo] = {'E': old_hdf[str(halo)].attrs['halo_energy'], 'KE': old_hdf[str(halo)].attrs['KE'],
-                                    'GE': old_hdf[str(halo)].attrs['GE']}
-        except KeyError:
-            halos[ind] = -999
-            continue
+    # Assign the particles shared with each descendant
+    new_part_haloids = np.full(npart, -2, dtype=np.int64)
+    pair_inds = np.searchsorted(pairs, part_keys)
+    okinds = pair_inds < pairs.size
+    okinds[okinds] = pairs[pair_inds[okinds]] == part_keys[okinds]
+    new_part_haloids[parts[okinds]] = pair_inds[okinds]
+    persist = new_part_haloids >= 0
 
-    halos = halos[np.where(halos != -999)]
+    # Get the unassociated particles of halos which are kept
+    part_nsplit = np.zeros(npart, dtype=np.int64)
+    okinds = part_haloids >= 0
+    part_nsplit[okinds] = nsplit[part_haloids[okinds]]
+    unasso = np.logical_and(~persist, part_nsplit > 0)
 
-    old_hdf.close()
+    # Halos with a single descendant keep their unassociated particles
+    first_split = np.cumsum(nsplit) - nsplit
+    okinds = np.logical_and(unasso, part_nsplit == 1)
+    new_part_haloids[okinds] = first_split[part_haloids[okinds]]
+
+    # Share the unassociated particles of split halos between its split halos, both the particles
+    # and the split halos are ordered by original halo so the shares can be laid end to end
+    uparts = np.where(np.logical_and(unasso, part_nsplit > 1))[0]
+    uparts = uparts[np.argsort(part_haloids[uparts], kind='stable')]
+    nunasso = np.bincount(part_haloids[uparts], minlength=nhalo)
 
-    return halos_bound, halos_energies, halo_partids, halos
+    splits = np.where(nsplit[orig_ids] > 1)[0]
+    shares = get_split_shares(nunasso[orig_ids[splits]], conts[splits], orig_ids[splits])
+    new_part_haloids[uparts] = splits[np.searchsorted(np.cumsum(shares), np.arange(uparts.size), side='right')]
+
+    return new_part_haloids, persist, orig_ids, desc_ids, conts
+
+
+def get_halo_particles(part_haloids, nhalo, persist=None):
+    """ A function to group particles by halo.
+
+    :param part_haloids: The halo ID of each particle (negative for particles not in a halo).
+    :param nhalo: The number of halos.
+    :param persist: Optional flags selecting the particles to include.
+    :return: The particle IDs sorted by halo and the start index of each halo's particles
+             (with the end of the last halo appended).
+    """
+
+    okinds = part_haloids >= 0
+    if persist is not None:
+        okinds = np.logical_and(okinds, persist)
+
+    pids = np.where(okinds)[0]
+    pids = pids[np.argsort(part_haloids[pids], kind='stable')]
+    starts = np.searchsorted(part_haloids[pids], np.arange(nhalo + 1))
+
+    return pids, starts
+
+
+def get_halo_energies(halos, pids, starts, pos, vel, boxsize, pmass, redshift, G, h, soft):
+    """ A function to compute the energy of a set of halos from their particles.
+
+    :param halos: The halo IDs.
+    :param pids: The particle IDs sorted by halo (from get_halo_particles).
+    :param starts: The start index of each halo's particles (from get_halo_particles).
+    :return: The total, kinetic and gravitational energies of each halo.
+    """
+
+    energies = np.zeros((len(halos), 3))
+    for ind, halo in enumerate(halos):
 
+        # Extract halo data
+        halo_pids = pids[starts[halo]: starts[halo + 1]]
+        halo_poss = pos[halo_pids, :]  # Positions *** NOTE: these are shifted below ***
+        halo_vels = vel[halo_pids, :]  # Velocities
 
-def get_desc_snap(newhalopath, desc_snap):
+        # Centre the halos
+        halo_poss, mean_halo_pos = utilities.periodic_centre(halo_poss, boxsize)
 
-    # Open the unsplit halo catalogue to get halo particle ID data
-    desc_hdf = h5py.File(newhalopath + 'halos_' + desc_snap + '.hdf5', 'r')
+        energies[ind, :] = halo_energy_calc_exact(halo_poss, halo_vels, halo_pids.size,
+                                                  pmass, redshift, G, h, soft)
 
-    # Load this snapshots particle halo ID data
-    desc_parthaloids = np.int32(desc_hdf['Halo_IDs'][...])
+    return energies[:, 0], energies[:, 1], energies[:, 2]
 
-    # Store halo realness in array for each halo ID where the ID is the index
-    uni_descs = np.unique(desc_parthaloids)
-    uni_descs = uni_descs[np.where(uni_descs >= 0)]
-    all_real_descs = np.full(uni_descs.size, False)
-    desc_partids = {}
-    for desc in uni_descs:
 
-        print('Descendent snapshot', desc_snap, desc, end='\r')
-        try:
-            # Store the real flag
-            all_real_descs[desc] = desc_hdf[str(desc)].attrs['Real']
+def glue_split_halos(halos, orig_ids, desc_conts, energies, pids, starts, pos, vel, boxsize):
+    """ A function to find split halos which should not have been split. Each split halo is compared
+    to the main split halo (the one giving its descendant the most particles) of its original halo
+    and glued to it if either is unbound and they overlap in phase space.
 
-            # Get halo particle IDs
-            desc_partids[str(desc)] = set(desc_hdf[str(desc)]['Halo_Part_IDs'][...])
-        except KeyError:
-            continue
+    :param halos: The original halo IDs of the split halos to check.
+    :param orig_ids: The original halo ID of each split halo (sorted).
+    :param desc_conts: The number of particles each split halo gives its descendant.
+    :param energies: The total energy of each split halo.
+    :param pids: The persistent particle IDs sorted by split halo (from get_halo_particles).
+    :param starts: The start index of each split halo's persistent particles.
+    :return: The glued split halos and the main split halo each is glued to.
+    """
 
-    desc_hdf.close()
+    glued = []
+    mains = []
 
-    return all_real_descs, desc_partids, desc_parthaloids
+    # Get the split halos of each original halo
+    firsts = np.searchsorted(orig_ids, halos, side='left')
+    lasts = np.searchsorted(orig_ids, halos, side='right')
+    for first, last in zip(firsts, lasts):
 
+        splits = np.arange(first, last)
+        main = splits[np.argmax(desc_conts[splits])]
 
-def haloSplitter(current_halo_partIDs, desc_IDs, desc_mass_cont, desc_partids):
+        halo1_pids = pids[starts[main]: starts[main + 1]]
 
-    # Initialise dictionaries for new halos
-    new_halos = {}
-    masses = {}
+        # Loop over the other split halos calculating their overlap with the main split halo
+        for split in splits:
 
-    # Compute contribution fractions
-    cont_fracs = desc_mass_cont / np.sum(desc_mass_cont)
+            if split == main or (energies[main] <= 0 and energies[split] <= 0):
+                continue
 
-    # Get main descendent halo ID
-    main_halo = desc_IDs[np.argmax(cont_fracs)]
+            halo2_pids = pids[starts[split]: starts[split + 1]]
 
-    # Loop through descendants
-    for ind, desc in enumerate(desc_IDs):
+            overlap, voverlap = calc_overlap(pos[halo1_pids], pos[halo2_pids],
+                                             vel[halo1_pids], vel[halo2_pids], boxsize)
 
-        # Extract the particle IDs of this descendant
-        desc_partIDs = desc_partids[str(desc)]
+            if overlap + voverlap < 0.85:
+                glued.append(split)
+                mains.append(main)
 
-        # Remove particles not in common between the descendant and current halo
-        new_halo_partIDs = desc_partIDs.intersection(current_halo_partIDs)
+    return np.array(glued, dtype=np.int64), np.array(mains, dtype=np.int64)
 
-        # Add these to the new halo
-        new_halos[desc] = set(new_halo_partIDs)
 
-        # Remove these particles from the halo part IDs set eventually leaving only unassociated particles
-        current_halo_partIDs = current_halo_partIDs - new_halos[desc]
+def energy_worker(halos):
+    """ A function to compute the energies of a chunk of halos from the snapshot data inherited
+    from the parent process.
 
-    nonpersist_parts = current_halo_partIDs
+    :param halos: The halo IDs.
+    :return: The halo IDs and their total, kinetic and gravitational energies.
+    """
 
-    # Compute the number of unassociated particles
-    unasso_num = len(nonpersist_parts)
+    d = snap_data
 
-    # Loop through mass contribution fractions to assign unassigned particles
-    for frac, desc in zip(cont_fracs, desc_IDs):
+    return (halos,) + get_halo_energies(halos, d['pids'], d['starts'], d['pos'], d['vel'], d['boxsize'],
+                                        d['pmass'], d['redshift'], d['G'], d['h'], d['soft'])
 
-        # Assign the remaining particles to each this halo defined by there contribution fraction
-        # Must convert halo_partIDs from a set to a list and then back again
-        masses[desc] = frac * unasso_num + len(new_halos[desc])
 
-    return new_halos, masses, main_halo
+def glue_worker(halos):
+    """ A function to find the glued split halos of a chunk of original halos from the snapshot
+    data inherited from the parent process.
 
+    :param halos: The original halo IDs.
+    :return: The glued split halos and the main split halo each is glued to.
+    """
 
-def snapHaloSplitterLoop(snap, halopath, newhalopath, all):
+    d = snap_data
 
-    pid, pos, vel, npart, boxsize, redshift, t, rhocrit, pmass, h, linkl = read_sim(snap, PATH='snapshotdata/snapdir_',
-                                                                                    llcoeff=0.2)
+    return glue_split_halos(halos, d['orig_ids'], d['desc_conts'], d['energies'], d['pids'], d['starts'],
+                            d['pos'], d['vel'], d['boxsize'])
 
-    # Sort the simulation data arrays by the particle ID
-    sinds = pid.argsort()
-    pos = pos[sinds, :]
-    vel = vel[sinds, :]
 
-    # Compute the softening length
-    soft = 0.05 * boxsize / npart**(1./3.)
+def map_halos(worker, halos, costs, comm=None, nprocs=1):
+    """ A function to run a worker over halos in parallel. The halos are distributed across MPI
+    ranks and then across a pool of worker processes on each rank balancing their cost, the results
+    of every rank are gathered on all ranks.
 
-    # Define the gravitational constant
-    G = (const.G.to(u.km**3 * u.M_sun**-1 * u.s**-2)).value
+    :param worker: The worker function, called with an array of halo IDs.
+    :param halos: The halo IDs.
+    :param costs: The cost of each halo.
+    :param comm: The MPI communicator (None when running from a single process).
+    :param nprocs: The number of worker processes on each rank, 1 runs the worker without a pool.
+    :return: A list of the worker's results.
+    """
 
-    # Define and convert particle mass to M_sun
-    pmass *= 1e10 * 1 / h
+    halos = np.asarray(halos, dtype=np.int64)
+    costs = np.asarray(costs, dtype=np.int64)
 
-    # Create HDF5 file for this snapshot
-    new_hdf = h5py.File(newhalopath + 'halos_' + snap + '.hdf5', 'w')
-
-    # Write out snapshot metadata
-    new_hdf.attrs['linkingLength'] = linkl  # host halo linking length
-    new_hdf.attrs['rhocrit'] = rhocrit  # critical density parameter
-    new_hdf.attrs['redshift'] = redshift
-    new_hdf.attrs['time'] = t
-
-    new_hdf.close()
-
-    # Compute the progenitor snapshot ID
-    if int(snap) > 8:
-        desc_snap = '0' + str(int(snap) + 1)
+    if comm is None:
+        rank, size = 0, 1
     else:
-        desc_snap = '00' + str(int(snap) + 1)
-
-    # Get descendant snapshot data
-    dstart = time.time()
-    all_real_descs, desc_partids, desc_parthaloids = get_desc_snap(newhalopath, desc_snap)
-    print(f'Descendants loaded in: {time.time()-dstart} seconds')
-
-    # print(sys.getsizeof(all_real_descs))
-    # print(sys.getsizeof(desc_partids))
-    # print(sys.getsizeof(desc_parthaloids))
-
-    # Get this snapshots data
-    thisstart = time.time()
-    halos_bound, halos_energies, halo_partids, halos = get_this_snap(halopath, snap)
-    print(f'Halos loaded in: {time.time() - thisstart} seconds')
-
-    # print(sys.getsizeof(halos_bound))
-    # print(sys.getsizeof(halos_energies))
-    # print(sys.getsizeof(halo_partids))
-    # print(sys.getsizeof(halos))
-
-    # Initialise this snapshot's halo particle ID dictionary to store the data that will be written out
-    snap_halo_pids = {}
-    snap_halo_mass = {}
-    snap_halo_mass_persist = {}
-    split_dict = {}
-    snap_halo_reals = {}
-    snap_halo_Es = {}
-    snap_halo_KEs = {}
-    snap_halo_GEs = {}
-
-    # Initialise the progress counter
-    snap_progress = -1
-    work_start = time.time()
-
-    for num, halo in enumerate(halos):
-
-        halo = str(halo)
-
-        # Compute and print the progress
-        previous_progress = snap_progress
-        snap_progress = int(num / len(halos) * 100)
-        if snap_progress != previous_progress:
-            print('Snapshot ' + snap + ' Progress: ', snap_progress, '%', 'Elapsed time:', time.time() - work_start,
-                  end='\r')
-
-        # Extract the particle IDs of this halo
-        current_halo_partIDs = halo_partids[halo]
-
-        # Find the new descendants in the descendant snapshot which has already been split and only take
-        # the unique values
-        desc_IDs, desc_mass_cont = np.unique(desc_parthaloids[list(current_halo_partIDs), 0], return_counts=True)
-
-        # Remove single particles if they have been found in the descendants
-        desc_mass_cont = desc_mass_cont[np.where(desc_IDs >= 0)]
-        desc_IDs = desc_IDs[np.where(desc_IDs >= 0)]
-
-        # Remove single particles if they have been found in the descendants
-        desc_IDs = desc_IDs[np.where(desc_mass_cont >= 10)]
-        desc_mass_cont = desc_mass_cont[np.where(desc_mass_cont >= 10)]
-
-        # If there is more than one descendant split the halo into halos defined by the mass ratio of descendants
-        if len(desc_IDs) > 1:
-
-            new_halos, masses, main_halo = haloSplitter(current_halo_partIDs, desc_IDs, desc_mass_cont, desc_partids)
-            # print('split', len(new_halos.keys()))
-            split_halos = list(new_halos.keys())
-
-            new_halo_Es = {}
-
-            if not all:
-
-                for key in split_halos:
-
-                    # Get the particle information for this halo
-                    halo_pids = np.array(list(new_halos[key]), dtype=int)
-
-                    if len(halo_pids) < 10:
-                        del new_halos[key]
-                        del masses[key]
-
-                    halo_poss = pos[halo_pids]
-
-                    halo_poss, mean_halo_pos = wrap_halo(halo_poss, boxsize)
-
-                    halo_vels = vel[halo_pids]
-
-                    halo_energy, KE, GE = halo_energy_calc_exact(halo_poss, halo_vels, halo_poss.shape[0],
-                                                                 pmass, redshift, G, h, soft)
-
-                    new_halo_Es[key] = {'E': halo_energy, 'KE': KE, 'GE': GE}
-
-                # print(len(new_halos.keys()), list(new_halos.keys()))
-                glue_start = time.time()
-
-                overlap_halos = {}
-
-                # Assingn the most massive halo to halo1 for comparison with all other halos
-                halo1 = main_halo
+        rank, size = comm.rank, comm.size
 
-                # Loop over halo combinations calculating overlap
-                for halo2 in new_halos.keys():
+    # Get this rank's halos and split them into chunks for the pool, several per process
+    rank_inds, _ = utilities.assign_costs(costs, size)
+    myinds = np.sort(np.array(rank_inds[rank], dtype=np.int64))
+    chunk_inds, _ = utilities.assign_costs(costs[myinds], nprocs * 4)
+    chunks = [halos[myinds[np.sort(inds)]] for inds in chunk_inds if len(inds) > 0]
 
-                    if halo1 == halo2:
-                        continue
-
-                    halo1_energy = new_halo_Es[halo1]['E']
-                    halo2_energy = new_halo_Es[halo2]['E']
-
-                    if halo1_energy > 0 or halo2_energy > 0:
-
-                        halo1_pids = list(new_halos[halo1])
-                        halo2_pids = list(new_halos[halo2])
-
-                        halo1_poss = pos[halo1_pids]
-                        halo2_poss = pos[halo2_pids]
-
-                        halo1_vels = vel[halo1_pids]
-                        halo2_vels = vel[halo2_pids]
-
-                        overlap, voverlap = calc_overlap(halo1_poss, halo2_poss, halo1_vels, halo2_vels, boxsize)
-
-                        if overlap + voverlap < 0.85:
-                            overlap_halos.setdefault(halo1, set()).update({halo2, halo1})
-                            overlap_halos.setdefault(halo2, set()).update({halo1, halo2})
-
-                for sphalo in overlap_halos.keys():
-
-                    for spolhalo in overlap_halos[sphalo]:
-                        overlap_halos[spolhalo].update(overlap_halos[sphalo])
-
-                if len(overlap_halos.keys()) != 0:
-
-                    for olkey in overlap_halos.keys():
-
-                        overlap_halos[olkey] = set(np.sort(list(overlap_halos[olkey])))
-
-                    overlap_arr = [list(x) for x in set(tuple(x) for x in overlap_halos.values())]
-
-                    for overlaps in overlap_arr:
-
-                        key = 1000000 + overlaps[0]
-                        masses[key] = 0
-
-                        for sphalo in overlaps:
-                            new_halos.setdefault(key, set()).update(new_halos[sphalo])
-                            masses[key] += masses[sphalo]
-
-                            del new_halos[sphalo]
-                            del masses[sphalo]
-
-                # print(len(new_halos.keys()), list(new_halos.keys()))
-                #
-                # print('Glue: ', time.time() - glue_start)
-
-            count = 0
-            split_count = 0
-
-            for key in new_halos.keys():
-
-                # Get the particle information for this halo
-                halo_pids = np.array(list(new_halos[key]), dtype=int)
-
-                # Extract halo data
-                halo_poss = pos[halo_pids, :]  # Positions *** NOTE: these are shifted below ***
-                halo_vels = vel[halo_pids, :]  # Velocities *** NOTE: these are shifted below ***
-                persistent_halo_npart = halo_pids.size
-
-                # Compute mean positions and wrap the halos
-                halo_poss, mean_halo_pos = wrap_halo(halo_poss, boxsize)
-
-                # Compute halo's energy
-                if key in new_halo_Es.keys():
-                    halo_energy, KE, GE = new_halo_Es[key]['E'], new_halo_Es[key]['KE'], new_halo_Es[key]['GE']
-                else:
-                    estart = time.time()
-                    halo_energy, KE, GE = halo_energy_calc_exact(halo_poss, halo_vels, persistent_halo_npart,
-                                                                 pmass, redshift, G, h, soft)
-                    # print('Energy: ', halo_energy, persistent_halo_npart, time.time() - estart)
-
-                if halo_energy > 0:
-                    real = False
-                else:
-                    real = True
+    # Fork the workers after the snapshot data is set so they inherit it without copying
+    if nprocs == 1:
+        results = list(map(worker, chunks))
+    else:
+        p = mp.get_context('fork').Pool(processes=nprocs)
+        results = list(p.imap_unordered(worker, chunks))
+        p.close()
+        p.join()
 
-                # Assign this halo's particles to the halo particle dictionary
-                snap_halo_pids[str(halo) + '.' + str(count)] = list(new_halos[key])
-                snap_halo_mass[str(halo) + '.' + str(count)] = masses[key]
-                snap_halo_mass_persist[str(halo) + '.' + str(count)] = len(new_halos[key])
+    if comm is not None:
+        results = [result for rank_results in comm.allgather(results) for result in rank_results]
 
-                # Store realness
-                snap_halo_reals[str(halo) + '.' + str(count)] = real
-                snap_halo_Es[str(halo) + '.' + str(count)] = halo_energy
-                snap_halo_KEs[str(halo) + '.' + str(count)] = KE
-                snap_halo_GEs[str(halo) + '.' + str(count)] = GE
+    return results
 
-                count += 1
-                split_count += 1
 
-            for i in range(count):
+def get_energies(halos, comm, nprocs):
+    """ A function to compute the energies of halos in parallel from the snapshot data.
 
-                # Assign split number
-                split_dict[str(halo) + '.' + str(i)] = split_count
+    :param halos: The halo IDs.
+    :param comm: The MPI communicator (None when running from a single process).
+    :param nprocs: The number of worker processes on each rank.
+    :return: The total, kinetic and gravitational energies of each halo.
+    """
 
-        elif len(desc_IDs) == 1:
+    # The exact energy calculation scales with the square of the number of particles
+    nparts = np.diff(snap_data['starts'])[halos]
+    results = map_halos(energy_worker, halos, nparts ** 2, comm, nprocs)
 
-            # Assign split boolean
-            split_dict[halo] = 1
+    lut = np.full(len(snap_data['starts']) - 1, -1, dtype=np.int64)
+    lut[halos] = np.arange(len(halos))
+    energies = np.zeros((3, len(halos)))
+    for result in results:
+        energies[:, lut[result[0]]] = result[1:]
 
-            # Extract the particle IDs of this descendant
-            desc_partIDs = desc_partids[str(desc_IDs[0])]
+    return energies[0], energies[1], energies[2]
 
-            # Remove particles not in common between the descendant and current halo
-            halo_pids = np.array(list(desc_partIDs.intersection(current_halo_partIDs)), dtype=int)
 
-            # Assign this halo's particles to the halo particle dictionary
-            snap_halo_pids[halo] = list(halo_partids[halo])
-            snap_halo_mass[halo] = len(halo_partids[halo])
-            snap_halo_mass_persist[halo] = len(halo_pids)
+def snapHaloSplitterLoop(snap, desc_snap, halopath, newhalopath, inputpath, llcoeff, all, comm=None, nprocs=1):
+    """ A function to split the halos of a snapshot against its (already split) descendant snapshot
+    and write out the split halo catalogue. The split itself is a single array operation, the
+    energies and gluing of the split halos are distributed across ranks and worker processes.
 
-            # Extract halo data
-            halo_poss = pos[halo_pids, :]  # Positions *** NOTE: these are shifted below ***
-            halo_vels = vel[halo_pids, :]  # Velocities *** NOTE: these are shifted below ***
-            persistent_halo_npart = halo_pids.size
+    :param snap: The snapshot ID.
+    :param desc_snap: The descendant snapshot ID.
+    :param halopath: The filepath of the halo catalogues.
+    :param newhalopath: The filepath of the split halo catalogues.
+    :param inputpath: The filepath of the simulation inputs (see utilities.binary_to_hdf5).
+    :param llcoeff: The host halo linking length coefficient.
+    :param all: Flag to keep every split rather than gluing unbound overlapping split halos.
+    :param comm: The MPI communicator (None when running from a single process).
+    :param nprocs: The number of worker processes on each rank.
+    :return: None
+    """
 
-            # Compute mean positions and wrap the halos
-            halo_poss, mean_halo_pos = wrap_halo(halo_poss, boxsize)
+    global snap_data
 
-            halo_energy, KE, GE = halo_energy_calc_exact(halo_poss, halo_vels, persistent_halo_npart,
-                                                         pmass, redshift, G, h, soft)
+    rank = 0 if comm is None else comm.rank
 
-            # Αssign realness
-            snap_halo_reals[halo] = halos_bound[halo]
-            snap_halo_Es[halo] = halo_energy
-            snap_halo_KEs[halo] = KE
-            snap_halo_GEs[halo] = GE
+    # Read the simulation data (sorted by particle ID)
+    hdf = h5py.File(inputpath + "mega_inputs_" + snap + ".hdf5", 'r')
+    attrs = dict(hdf.attrs)
+    pos = hdf['part_pos'][...]
+    vel = hdf['part_vel'][...]
+    hdf.close()
 
-    print('Snapshot ' + snap + ' Progress: 100%', '\nElapsed time:', time.time() - work_start)
+    npart, boxsize, redshift, h = attrs['npart'], attrs['boxsize'], attrs['redshift'], attrs['h']
 
-    write_start = time.time()
+    # Compute the softening length
+    soft = 0.05 * boxsize / npart**(1./3.)
 
-    # Write out the halos that have been found
-    # Open the root group for the new halo catalogue
-    new_hdf = h5py.File(newhalopath + 'halos_' + snap + '.hdf5', 'r+')
+    # Define the gravitational constant
+    G = (const.G.to(u.km**3 * u.M_sun**-1 * u.s**-2)).value
 
-    # Define snapshots particle halo ID array
-    part_haloids = np.full(npart, -2, dtype=int)
+    # Define and convert particle mass to M_sun
+    pmass = attrs['pmass'] * 1e10 * 1 / h
 
-    newID = -1
+    # Get the particle halo IDs of this snapshot and the split descendant snapshot
+    dstart = time.time()
+    part_haloids, reals = read_part_haloids(halopath, snap)
+    desc_part_haloids, _ = read_part_haloids(newhalopath, desc_snap)
+    if rank == 0:
+        print(f'Halos loaded in: {time.time() - dstart} seconds')
 
-    for key in snap_halo_pids.keys():
+    # Split the halos, this is cheap so every rank does it rather than communicating the result
+    work_start = time.time()
+    new_part_haloids, persist, orig_ids, desc_ids, desc_conts = split_snapshot(part_haloids, desc_part_haloids)
+    nsplit = np.bincount(orig_ids)[orig_ids]
+
+    # Flag the original halos which were split, these stay considered for splitting even if all
+    # their split halos are glued back together
+    considered = np.bincount(orig_ids) > 1
+
+    if rank == 0:
+        print('Snapshot ' + snap + ' split', np.unique(orig_ids[nsplit > 1]).size, 'halos into',
+              np.count_nonzero(nsplit > 1), 'halos in', time.time() - work_start, 'seconds')
+
+    # Compute the energies of every halo from its persistent particles
+    pids, starts = get_halo_particles(new_part_haloids, orig_ids.size, persist)
+    snap_data = {'pos': pos, 'vel': vel, 'pids': pids, 'starts': starts, 'boxsize': boxsize, 'pmass': pmass,
+                 'redshift': redshift, 'G': G, 'h': h, 'soft': soft}
+    energies, KEs, GEs = get_energies(np.arange(orig_ids.size), comm, nprocs)
+
+    # Glue split halos which overlap with their main split halo where either is unbound
+    if not all:
+
+        split_halos, first, counts = np.unique(orig_ids[nsplit > 1], return_index=True, return_counts=True)
+        snap_data.update({'orig_ids': orig_ids, 'desc_conts': desc_conts, 'energies': energies})
+        group_nparts = np.add.reduceat(np.diff(starts)[nsplit > 1], first) if first.size > 0 else first
+        results = map_halos(glue_worker, split_halos, group_nparts, comm, nprocs)
+
+        glued_to = np.arange(orig_ids.size)
+        for glued, mains in results:
+            glued_to[glued] = mains
+        glued = np.where(glued_to != np.arange(orig_ids.size))[0]
+
+        if glued.size > 0:
+
+            # Move the glued halos' particles to the halo they are glued to and remove them
+            okinds = new_part_haloids >= 0
+            new_part_haloids[okinds] = glued_to[new_part_haloids[okinds]]
+            desc_conts = np.bincount(glued_to, weights=desc_conts, minlength=orig_ids.size).astype(np.int64)
+
+            keep = glued_to == np.arange(orig_ids.size)
+            new_ids = np.cumsum(keep) - 1
+            new_part_haloids[okinds] = new_ids[new_part_haloids[okinds]]
+            orig_ids, desc_ids, desc_conts = orig_ids[keep], desc_ids[keep], desc_conts[keep]
+            energies, KEs, GEs = energies[keep], KEs[keep], GEs[keep]
+
+            # Recompute the energies of halos which had halos glued to them
+            recompute = new_ids[np.unique(glued_to[glued])]
+            pids, starts = get_halo_particles(new_part_haloids, orig_ids.size, persist)
+            snap_data.update({'pids': pids, 'starts': starts})
+            energies[recompute], KEs[recompute], GEs[recompute] = get_energies(recompute, comm, nprocs)
+
+            nsplit = np.bincount(orig_ids)[orig_ids]
+
+    snap_data = None
+
+    # Halos considered for splitting are real if they are bound, other halos keep their original realness
+    new_reals = np.where(considered[orig_ids], energies <= 0, reals[orig_ids])
+
+    if rank == 0:
+        write_start = time.time()
+        snap_attrs = {'linkingLength': llcoeff * attrs['mean_sep'], 'rhocrit': attrs['rhocrit'],
+                      'redshift': redshift, 'time': attrs['t']}
+        write_split_halos(newhalopath, snap, new_part_haloids, persist, orig_ids, nsplit, new_reals,
+                          energies, KEs, GEs, snap_attrs)
+        print(snap + ' Writing progress: 100%', '\nElapsed time:', time.time() - write_start)
+
+
+def write_split_halos(newhalopath, snap, new_part_haloids, persist, orig_ids, nsplit, reals,
+                      energies, KEs, GEs, attrs):
+    """ A function to write out the split halo catalogue of a snapshot. Particle halo IDs are stored
+    in the same layout as the halo finder's catalogues (with no subhalos) so the next snapshot can
+    be split against them.
+
+    :param newhalopath: The filepath of the split halo catalogues.
+    :param snap: The snapshot ID.
+    :param new_part_haloids: The split halo ID of each particle.
+    :param persist: Flag for particles shared with the split halo's descendant.
+    :param orig_ids: The original halo ID of each split halo.
+    :param nsplit: The number of halos each split halo's original halo was split into.
+    :param reals: The real flag of each split halo.
+    :param energies: The total energy of each split halo.
+    :param KEs: The kinetic energy of each split halo.
+    :param GEs: The gravitational energy of each split halo.
+    :param attrs: A dictionary of the snapshot attributes.
+    :return: None
+    """
+
+    nhalo = orig_ids.size
+    pids, starts = get_halo_particles(new_part_haloids, nhalo)
+    nparts = np.diff(starts)
+    nparts_persist = np.bincount(new_part_haloids[persist], minlength=nhalo)
 
-        halo_pids = snap_halo_pids[key]
+    new_hdf = h5py.File(newhalopath + 'halos_' + snap + '.hdf5', 'w')
 
-        # Increment the new halo ID
-        newID += 1
+    # Write out snapshot metadata
+    for key, value in attrs.items():
+        new_hdf.attrs[key] = value
 
-        # Assign this halo to the particle halo ID array
-        part_haloids[halo_pids, 0] = newID
+    for newID in range(nhalo):
 
         # Create datasets in the current halo's group in the HDF5 file and assign halo data
         # *** NOTE: this is the minimal data to make the tree currently and can be expanded upon ***
         halo_group = new_hdf.create_group(str(newID))  # create halo group
-        halo_group.create_dataset('Halo_Part_IDs', shape=[len(halo_pids)],
-                                  dtype=int, compression='gzip', data=halo_pids)  # halo particle ids
-        halo_group.attrs['halo_nPart'] = snap_halo_mass[key]
-        halo_group.attrs['halo_nPart_persist'] = snap_halo_mass_persist[key]
-        halo_group.attrs['splitting'] = split_dict[key]
-        halo_group.attrs['Real'] = snap_halo_reals[key]
-        halo_group.attrs['halo_energy'] = snap_halo_Es[key]
-        halo_group.attrs['KE'] = snap_halo_KEs[key]
-        halo_group.attrs['GE'] = snap_halo_GEs[key]
-
-        if '.' in key:
-            halo_group.attrs['originalID'] = key.split('.')[0]
-        else:
-            halo_group.attrs['originalID'] = key
-
-        # Compute and print the progress
-        previous_progress = snap_progress
-        snap_progress = int(newID / len(halos) * 100 + 1)
-        if snap_progress != previous_progress:
-            print('Snapshot ' + snap + ' Writing Progress: ', snap_progress, '%', 'Elapsed time:',
-                  time.time() - write_start, end='\r')
-
-    # Write out the particle halo ID array
-    new_hdf.create_dataset('Halo_IDs', shape=part_haloids.shape, dtype=int, compression='gzip', data=part_haloids)
+        halo_group.create_dataset('Halo_Part_IDs', dtype=int, compression='gzip',
+                                  data=pids[starts[newID]: starts[newID + 1]])  # halo particle ids
+        halo_group.attrs['halo_nPart'] = nparts[newID]
+        halo_group.attrs['halo_nPart_persist'] = nparts_persist[newID]
+        halo_group.attrs['splitting'] = nsplit[newID]
+        halo_group.attrs['Real'] = reals[newID]
+        halo_group.attrs['halo_energy'] = energies[newID]
+        halo_group.attrs['KE'] = KEs[newID]
+        halo_group.attrs['GE'] = GEs[newID]
+        halo_group.attrs['originalID'] = orig_ids[newID]
+
+    # Write out the halo arrays
+    for key, arr in [('halo_IDs', np.arange(nhalo)), ('nparts', nparts), ('nparts_persist', nparts_persist),
+                     ('original_IDs', orig_ids), ('splitting', nsplit), ('real_flag', reals),
+                     ('halo_total_energies', energies), ('halo_kinetic_energies', KEs),
+                     ('halo_gravitational_energies', GEs)]:
+        new_hdf.create_dataset(key, data=arr, compression='gzip')
+
+    # Write out the particle halo IDs, tree halos carry no subhalos
+    part_haloids = np.full((new_part_haloids.size, 2), -2, dtype=np.int32)
+    part_haloids[:, 0] = np.where(new_part_haloids >= 0, new_part_haloids, -2)
+    utilities.write_part_haloids(new_hdf, part_haloids)
 
     new_hdf.close()
 
-    print(snap + ' Writing progress: 100%', '\nElapsed time:', time.time() - write_start)
 
+def mainLumberjack(halopath, newhalopath, inputpath, snaplist, llcoeff=0.2, all=False, comm=None, nprocs=None):
+    """ A function to split the halos of every snapshot into tree halos. Snapshots are split from the
+    present day to the past since each depends on its already split descendant, the work within
+    each snapshot is distributed across MPI ranks and worker processes.
 
-def mainLumberjack(halopath='halo_snapshots/', newhalopath='split_halos/', all=False):
+    :param halopath: The filepath of the halo catalogues.
+    :param newhalopath: The filepath of the split halo catalogues.
+    :param inputpath: The filepath of the simulation inputs (see utilities.binary_to_hdf5).
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param llcoeff: The host halo linking length coefficient.
+    :param all: Flag to keep every split rather than gluing unbound overlapping split halos.
+    :param comm: The MPI communicator (None when running from a single process).
+    :param nprocs: The number of worker processes on each rank (defaults to all but two CPUs when
+                   running from a single process and 1 with MPI).
+    :return: None
+    """
 
-    start = time.time()
-    # Copy the present day snapshot to the new halo catalog
-    copyfile(halopath + 'halos_061.hdf5', newhalopath + 'halos_061.hdf5')
+    rank = 0 if comm is None else comm.rank
 
-    # Create the snapshot list (present day to past) for looping
-    snaplist = []
-    for snap in range(60, -1, -1):
-        if snap < 10:
-            snaplist.append('00' + str(snap))
-        elif snap >= 10:
-            snaplist.append('0' + str(snap))
+    if nprocs is None:
+        nprocs = max(mp.cpu_count() - 2, 1) if comm is None else 1
 
-    print('061: ', time.time() - start)
+    # Copy the present day snapshot to the new halo catalog
+    start = time.time()
+    if rank == 0:
+        copyfile(halopath + 'halos_' + snaplist[-1] + '.hdf5', newhalopath + 'halos_' + snaplist[-1] + '.hdf5')
+        print(snaplist[-1] + ': ', time.time() - start)
 
-    # Loop through snapshots
-    for snap in snaplist:
+    # Loop through snapshots (present day to past)
+    for snap, desc_snap in zip(snaplist[-2::-1], snaplist[:0:-1]):
 
-        # Run the halo splitting loop for this snapshot, looping over all halos in
-        # the snapshot, splitting them and writing them out.
-        start = time.time()
-        snapHaloSplitterLoop(snap, halopath, newhalopath, all)
-        print(snap, ': ', time.time() - start)
+        # The descendant snapshot must be written before it is read
+        if comm is not None:
+            comm.Barrier()
 
+        # Run the halo splitting loop for this snapshot, splitting the halos against the
+        # already split descendant snapshot and writing them out.
+        start = time.time()
+        snapHaloSplitterLoop(snap, desc_snap, halopath, newhalopath, inputpath, llcoeff, all, comm, nprocs)
+        if rank == 0:
+            print(snap, ': ', time.time() - start)
 
-if __name__ == '__main__':
-    mainLumberjack(halopath='halo_snapshots/', newhalopath='all_split_halos/', all=True)
+    if comm is not None:
+        comm.Barrier()
@@ -3,10 +3,13 @@ import kdhalofinder as kd
 import kdhalofinder_mpi as kdmpi
 import mergergraph as mg
 import mergergraph_mpi as mgmpi
+import mergergraph_vec as mgvec
 import build_graph_mpi as bgmpi
+import update_graph
+import build_trees
 from astropy.cosmology import FlatLambdaCDM
-# import mergertrees as mt
-# import lumberjack as ld
+import mergertrees as mt
+import lumberjack as ld
 import time
 import sys
 import utilities
@@ -24,6 +27,9 @@ snap_ind = int(sys.argv[2])
 # Load the snapshot list
 snaplist = list(np.loadtxt(inputs['snapList'], dtype=str))
 
+# The stages working across every snapshot only run in the invocation for the final snapshot
+final_invocation = snap_ind == len(snaplist) - 1
+
 # Initialise the astropy cosmology object
 cosmo = FlatLambdaCDM(H0=cosmology["H0"], Om0=cosmology["Om0"],
                       Tcmb0=cosmology["Tcmb0"], Ob0=cosmology["Ob0"])
@@ -43,7 +49,8 @@ def main_kdmpi(snap):
                          min_vlcoeff=params['min_alpha_v'], decrement=params['decrement'], verbose=flags['verbose'],
                          findsubs=flags['subs'], ncells=params['N_cells'], profile=flags['profile'],
                          profile_path=inputs["profilingPath"],
-                         cosmo=cosmo)
+                         cosmo=cosmo, deep_llcoeffs=params['deep_llcoeffs'],
+                         sub_workers=params['sub_workers'])
 
 
 def main_mg(snap, density_rank):
@@ -58,6 +65,26 @@ def main_mgmpi(snap, prog_snap, desc_snap, density_rank):
                                verbose=flags['verbose'], profile=flags['profile'], profile_path=inputs["profilingPath"])
 
 
+def main_mgdist(snap, prog_snap, desc_snap, density_rank):
+    mgmpi.distributedProgDescWriter(snap, prog_snap, desc_snap, halopath=inputs['haloSavePath'],
+                                    savepath=inputs['directgraphSavePath'], density_rank=density_rank,
+                                    verbose=flags['verbose'], profile=flags['profile'],
+                                    profile_path=inputs["profilingPath"], compact=flags['compactlinking'])
+
+
+def main_mgvec(snap, prog_snap, desc_snap, density_rank):
+    mgvec.directProgDescWriter(snap, prog_snap, desc_snap, halopath=inputs['haloSavePath'],
+                               savepath=inputs['directgraphSavePath'], density_rank=density_rank,
+                               verbose=flags['verbose'], profile=flags['profile'], profile_path=inputs["profilingPath"],
+                               compact=flags['compactlinking'])
+
+
+def main_mgwindow(snaplist, density_rank):
+    mgvec.windowedProgDescWriter(snaplist, halopath=inputs['haloSavePath'], savepath=inputs['directgraphSavePath'],
+                                 density_rank=density_rank, verbose=flags['verbose'], profile=flags['profile'],
+                                 profile_path=inputs["profilingPath"], compact=flags['compactlinking'])
+
+
 def main_mt(snap):
     mt.directProgDescWriter(snap, halopath=inputs['treehaloSavePath'], savepath=inputs['directtreeSavePath'],
                             part_threshold=params['part_threshold'])
@@ -65,6 +92,18 @@ def main_mt(snap):
 
 if flags['useserial']:
 
+    if snap_ind - 1 < 0:
+        prog_snap = None
+    else:
+        prog_snap = snaplist[snap_ind - 1]
+
+    if snap_ind + 1 >= len(snaplist):
+        desc_snap = None
+    else:
+        desc_snap = snaplist[snap_ind + 1]
+
+    # Keep the full snapshot list for the stages working across every snapshot
+    full_snaplist = snaplist
     snaplist = [snaplist[snap_ind], ]
 
     # ===================== Run The Halo Finder =====================
@@ -72,13 +111,28 @@ if flags['useserial']:
         for snap in snaplist:
             main_kd(snap)
 
+    # ===================== Find Direct Progenitors and Descendents For All Snapshots =====================
+    # The windowed linking walks the whole snapshot list in a single run, this is done in the
+    # invocation for the final snapshot once every halo catalog exists
+    if flags['windowedlinking'] and final_invocation:
+        if flags['graphdirect']:
+            main_mgwindow(full_snaplist, 0)
+        if flags['subgraphdirect']:
+            main_mgwindow(full_snaplist, 1)
+
     # ===================== Find Direct Progenitors and Descendents =====================
-    if flags['graphdirect']:
+    if flags['graphdirect'] and not flags['windowedlinking']:
         for snap in snaplist:
-            main_mg(snap, 0)
-    if flags['subgraphdirect']:
+            if flags['vectorlinking']:
+                main_mgvec(snap, prog_snap, desc_snap, 0)
+            else:
+                main_mg(snap, 0)
+    if flags['subgraphdirect'] and not flags['windowedlinking']:
         for snap in snaplist:
-            main_mg(snap, 1)
+            if flags['vectorlinking']:
+                main_mgvec(snap, prog_snap, desc_snap, 1)
+            else:
+                main_mg(snap, 1)
 
     # ===================== Build The Graphs =====================
     if flags['graph']:
@@ -87,14 +141,16 @@ if flags['useserial']:
                              halopath=inputs['haloSavePath'] + '/halos_')
 
     # ===================== Split Graphs Into Trees =====================
-    if flags['treehalos']:
-        ld.mainLumberjack(halopath=inputs['haloSavePath'], newhalopath=inputs['treehaloSavePath'])
+    # Every snapshot is split in a single run, done in the invocation for the final snapshot
+    if flags['treehalos'] and final_invocation:
+        ld.mainLumberjack(halopath=inputs['haloSavePath'], newhalopath=inputs['treehaloSavePath'],
+                          inputpath=inputs['data'], snaplist=full_snaplist, llcoeff=params['llcoeff'])
 
     # ===================== Find Post Splitting Direct Progenitors and Descendents =====================
     if flags['treedirect']:
         for snap in snaplist:
             main_mt(snap)
-        mt.link_cutter(treepath=inputs['directtreeSavePath'] + '/Mtree_')
+        mt.link_cutter(treepath=inputs['directtreeSavePath'] + '/Mtree_', snaplist=full_snaplist)
 
     # ===================== Build The Trees =====================
     if flags['tree']:
@@ -124,7 +180,17 @@ elif flags['usempi']:
         main_kdmpi(snaplist[snap_ind])
 
     # ===================== Find Direct Progenitors and Descendents =====================
-    if flags['graphdirect']:
+    # The windowed linking walks the whole snapshot list in a single run on one process, this is
+    # done in the invocation for the final snapshot once every halo catalog exists
+    if flags['windowedlinking']:
+
+        if rank == 0 and final_invocation:
+            if flags['graphdirect']:
+                main_mgwindow(snaplist, 0)
+            if flags['subgraphdirect']:
+                main_mgwindow(snaplist, 1)
+
+    elif flags['graphdirect']:
 
         snap = snaplist[snap_ind]
 
@@ -138,11 +204,19 @@ elif flags['usempi']:
         else:
             desc_snap = snaplist[snap_ind + 1]
 
-        main_mgmpi(snap, prog_snap, desc_snap, 0)
+        # The distributed linking splits the particles over all ranks, the vectorised
+        # linking runs on a single process
+        if flags['distributedlinking']:
+            main_mgdist(snap, prog_snap, desc_snap, 0)
+        elif flags['vectorlinking']:
+            if rank == 0:
+                main_mgvec(snap, prog_snap, desc_snap, 0)
+        else:
+            main_mgmpi(snap, prog_snap, desc_snap, 0)
 
     comm.barrier()
 
-    if flags['subgraphdirect']:
+    if flags['subgraphdirect'] and not flags['windowedlinking']:
 
         snap = snaplist[snap_ind]
 
@@ -156,14 +230,45 @@ elif flags['usempi']:
         else:
             desc_snap = snaplist[snap_ind + 1]
 
-        main_mgmpi(snap, prog_snap, desc_snap, 1)
+        # The distributed linking splits the particles over all ranks, the vectorised
+        # linking runs on a single process
+        if flags['distributedlinking']:
+            main_mgdist(snap, prog_snap, desc_snap, 1)
+        elif flags['vectorlinking']:
+            if rank == 0:
+                main_mgvec(snap, prog_snap, desc_snap, 1)
+        else:
+            main_mgmpi(snap, prog_snap, desc_snap, 1)
 
     if rank == 0:
         print('Total: ', time.time() - walltime_start)
 
 
-    if flags["graph"]:
+    # Either add the final snapshot to the existing graphs or build every graph
+    if flags["graphupdate"]:
+
+        if rank == 0:
+            update_graph.main_update_graph(treepath=inputs['directgraphSavePath'], graphpath=inputs['graphSavePath'],
+                                           snaplist=snaplist, halopath=inputs['haloSavePath'],
+                                           cache_bytes=params['graph_cache_bytes'])
+
+    elif flags["graph"]:
 
         bgmpi.main_get_graph_members(treepath=inputs['directgraphSavePath'], graphpath=inputs['graphSavePath'],
                                      snaplist=snaplist, verbose=flags['verbose'],
-                                     halopath=inputs['haloSavePath'])
+                                     halopath=inputs['haloSavePath'], cache_bytes=params['graph_cache_bytes'])
+
+    comm.barrier()
+
+    # ===================== Split Halos Into Tree Halos =====================
+    # Snapshots are split one after another with the work in each shared between the ranks, every
+    # snapshot is split in a single run done in the invocation for the final snapshot
+    if flags['treehalos'] and final_invocation:
+        ld.mainLumberjack(halopath=inputs['haloSavePath'], newhalopath=inputs['treehaloSavePath'],
+                          inputpath=inputs['data'], snaplist=snaplist, llcoeff=params['llcoeff'], comm=comm)
+
+    # ===================== Split The Graphs Into Trees =====================
+    # Each rank splits its share of the graphs itself rather than forking workers
+    if flags['tree']:
+        build_trees.main_get_trees(graphpath=inputs['graphSavePath'], treepath=inputs['treeSavePath'],
+                                   comm=comm, nprocs=1)
@@ -14,6 +14,7 @@ import pickle
 import random
 import os
 import gc
+import utilities
 
 
 lock = Lock()
@@ -159,18 +160,21 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
     # =============== Current Snapshot ===============
 
     # Load the current snapshot data
-    hdf_current = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+    hdf_current = h5py.File(halopath + 'halos_' + snapshot + '.hdf5', 'r')
 
     # Extract the halo IDs (group names/keys) contained within this snapshot
     if rank == 0:
         halo_ids = hdf_current['halo_IDs'][...]
-        reals = hdf_current['real_flag'][...]
     else:
         halo_ids = hdf_current['Subhalos']['subhalo_IDs'][...]
-        reals = hdf_current['Subhalos']['real_flag'][...]
 
     hdf_current.close()  # close the root group
 
+    # Get the reality flags including promotions from linking the progenitor snapshot, the
+    # demotions from linking this snapshot are found here
+    reals = utilities.read_real_flags(halopath, snapshot, rank, demotions=False)
+    old_reals = reals.copy()
+
     # Get only the real halo ids
     halo_ids = halo_ids[reals]
 
@@ -190,7 +194,7 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
         hdf_prog = h5py.File(halopath + 'halos_' + prog_snap + '.hdf5', 'r')
 
         # Extract the particle halo ID array and particle ID array
-        prog_snap_haloIDs = hdf_prog['particle_halo_IDs'][:, rank]
+        prog_snap_haloIDs = utilities.read_part_haloids(hdf_prog, rank)
 
         # Get all the unique halo IDs in this snapshot and the number of times they appear
         prog_unique, prog_counts = np.unique(prog_snap_haloIDs, return_counts=True)
@@ -203,14 +207,11 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
         prog_unique = prog_unique[1:]
         prog_counts = prog_counts[1:]
 
-        # Get progenitor snapshot data
-        if rank == 0:
-            prog_reals = hdf_prog['real_flag'][...]
-        else:
-            prog_reals = hdf_prog['Subhalos']['real_flag'][...]
-
         hdf_prog.close()
 
+        # Get progenitor snapshot data
+        prog_reals = utilities.read_real_flags(halopath, prog_snap, rank)
+
     else:
         prog_snap_haloIDs = np.array([])
         prog_reals = np.array([])
@@ -229,7 +230,7 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
         hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r')
 
         # Extract the particle halo ID array and particle ID array
-        desc_snap_haloIDs = hdf_desc['particle_halo_IDs'][:, rank]
+        desc_snap_haloIDs = utilities.read_part_haloids(hdf_desc, rank)
 
         # Get all unique halos in this snapshot
         desc_unique, desc_counts = np.unique(desc_snap_haloIDs, return_counts=True)
@@ -242,18 +243,17 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
         desc_unique = desc_unique[1:]
         desc_counts = desc_counts[1:]
 
-        # Get the reality flag array
-        if rank == 0:
-            desc_reals = hdf_desc['real_flag'][...]
-        else:
-            desc_reals = hdf_desc['Subhalos']['real_flag'][...]
-
         hdf_desc.close()
 
+        # Get the reality flag array, the descendant snapshot has not been linked yet
+        desc_reals = utilities.read_real_flags(halopath, desc_snap, rank, promotions=False, demotions=False)
+        promoted = np.zeros(desc_reals.size, dtype=bool)
+
     else:
         desc_snap_haloIDs = np.array([])
         desc_counts = np.array([])
         desc_reals = np.array([])
+        promoted = None
 
     print(len(prog_reals), len(prog_counts), len(desc_reals), len(desc_counts))
 
@@ -337,8 +337,9 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
                 reals[haloID] = True
 
             # If this halo is real then it's descendents are real
-            if desc_snap != None and reals[haloID]:
+            if promoted is not None and reals[haloID]:
                 desc_reals[desc_haloids] = True
+                promoted[desc_haloids] = True
 
             # # If the halo has neither descendants or progenitors we do not need to store it
             # if nprog == ndesc == -1 or nprog == ndesc == 0:
@@ -424,9 +425,9 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
 
     # Create file to store this snapshots graph results
     if rank == 0:
-        hdf = h5py.File(savepath + 'Mgraph_' + snap + '.hdf5', 'w')
+        hdf = h5py.File(savepath + 'Mgraph_' + snapshot + '.hdf5', 'w')
     else:
-        hdf = h5py.File(savepath + 'SubMgraph_' + snap + '.hdf5', 'w')
+        hdf = h5py.File(savepath + 'SubMgraph_' + snapshot + '.hdf5', 'w')
 
     hdf.create_dataset('halo_IDs', shape=index_haloids.shape, dtype=int, data=index_haloids, compression='gzip')
     hdf.create_dataset('nProgs', shape=nprogs.shape, dtype=int, data=nprogs, compression='gzip')
@@ -448,43 +449,9 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerG
 
     hdf.close()
 
-    if int(desc_snap) <= 61:
-
-        # Load the descendant snapshot
-        hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r+')
-
-        # Set the reality flag in the halo catalog
-        if rank == 0:
-            print("Overwriting descendant real flags")
-            del hdf_desc['real_flag']
-            hdf_desc.create_dataset('real_flag', shape=desc_reals.shape, dtype=bool, data=desc_reals,
-                                    compression='gzip')
-        else:
-            print("Overwriting descendant subhalo real flags")
-            sub_desc = hdf_desc['Subhalos']
-            del sub_desc['real_flag']
-            sub_desc.create_dataset('real_flag', shape=desc_reals.shape, dtype=bool, data=desc_reals,
-                                    compression='gzip')
-
-        hdf_desc.close()
-
-    # Load the descendant snapshot
-    hdf_current = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r+')
-
-    # Set the reality flag in the halo catalog
-    if rank == 0:
-        print("Overwriting current real flags")
-        del hdf_current['real_flag']
-        hdf_current.create_dataset('real_flag', shape=reals.shape, dtype=bool, data=reals,
-                                   compression='gzip')
-    else:
-        print("Overwriting current subhalo real flags")
-        sub_current = hdf_current['Subhalos']
-        del sub_current['real_flag']
-        sub_current.create_dataset('real_flag', shape=reals.shape, dtype=bool, data=reals,
-                                   compression='gzip')
-
-    hdf_current.close()
+    # Write out the reality flag updates to the sidecar files, the halo catalogs are not modified
+    utilities.write_real_flag_updates(halopath, snapshot, desc_snap if promoted is not None else None, rank,
+                                      np.logical_and(old_reals, ~reals), promoted)
 
     print(np.unique(nprogs, return_counts=True))
     print(np.unique(ndescs, return_counts=True))
@@ -4,6 +4,7 @@ import mpi4py
 import pickle
 from mpi4py import MPI
 import utilities
+import mergergraph_vec as mgvec
 import sys
 import time
 mpi4py.rc.recv_mprobe = False
@@ -168,13 +169,14 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
         # Extract the halo IDs (group names/keys) contained within this snapshot
         if density_rank == 0:
             halo_ids = hdf_current['halo_IDs'][...]
-            reals = hdf_current['real_flag'][...]
         else:
             halo_ids = hdf_current['Subhalos']['subhalo_IDs'][...]
-            reals = hdf_current['Subhalos']['real_flag'][...]
 
         hdf_current.close()  # close the root group
 
+        # Get the reality flags including any found by linking the progenitor snapshot
+        reals = utilities.read_real_flags(halopath, snap, density_rank, demotions=False)
+
         # Get only the real halo ids
         real_halo_ids = halo_ids[reals]
 
@@ -243,18 +245,18 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
             hdf_prog = h5py.File(halopath + 'halos_' + prog_snap + '.hdf5', 'r')
 
             # Extract the particle halo ID array and particle ID array
-            prog_haloids = hdf_prog['particle_halo_IDs'][:, density_rank]
+            prog_haloids = utilities.read_part_haloids(hdf_prog, density_rank)
 
             # Get progenitor snapshot data
             if density_rank == 0:
-                prog_reals = hdf_prog['real_flag'][...]
                 prog_npart = hdf_prog['nparts'][...]
             else:
-                prog_reals = hdf_prog['Subhalos']['real_flag'][...]
                 prog_npart = hdf_prog['Subhalos']['nparts'][...]
 
             hdf_prog.close()
 
+            prog_reals = utilities.read_real_flags(halopath, prog_snap, density_rank)
+
         else:
             prog_haloids = np.array([])
             prog_reals = np.array([])
@@ -266,7 +268,7 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
             hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r')
 
             # Extract the particle halo ID array and particle ID array
-            desc_haloids = hdf_desc['particle_halo_IDs'][:, density_rank]
+            desc_haloids = utilities.read_part_haloids(hdf_desc, density_rank)
 
             # Get descendant snapshot data
             if density_rank == 0:
@@ -376,36 +378,25 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
 
         if desc_snap != None:
 
-            # Load the descendant snapshot
-            hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r')
+            # Get the reality flag array, the descendant snapshot has not been linked yet
+            desc_reals = utilities.read_real_flags(halopath, desc_snap, density_rank,
+                                                   promotions=False, demotions=False)
+            promoted = np.zeros(desc_reals.size, dtype=bool)
 
-            # Get the reality flag array
-            if density_rank == 0:
-                desc_reals = hdf_desc['real_flag'][...]
-            else:
-                desc_reals = hdf_desc['Subhalos']['real_flag'][...]
-
-            hdf_desc.close()
         else:
             desc_reals = np.array([False])
+            promoted = None
 
         if prog_snap != None:
 
-            # Load the progenitor snapshot
-            hdf_prog = h5py.File(halopath + 'halos_' + prog_snap + '.hdf5', 'r')
-
             # Get progenitor snapshot data
-            if density_rank == 0:
-                prog_reals = hdf_prog['real_flag'][...]
-            else:
-                prog_reals = hdf_prog['Subhalos']['real_flag'][...]
-
-            hdf_prog.close()
+            prog_reals = utilities.read_real_flags(halopath, prog_snap, density_rank)
 
         else:
             prog_reals = np.array([False])
 
         old_desc_reals = np.copy(desc_reals)
+        old_reals = np.copy(reals)
 
         for num, haloID in enumerate(results):
 
@@ -435,6 +426,7 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
                 # If this halo is real then it's descendents are real
                 if desc_snap != None:
                     desc_reals[desc_haloids] = True
+                    promoted[desc_haloids] = True
 
                 # Write out the data produced
                 nprogs[haloID] = nprog  # number of progenitors
@@ -492,43 +484,9 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
 
         hdf.close()
 
-        if desc_snap != None:
-
-            # Load the descendant snapshot
-            hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r+')
-
-            # Set the reality flag in the halo catalog
-            if density_rank == 0:
-                print("Overwriting descendant real flags")
-                del hdf_desc['real_flag']
-                hdf_desc.create_dataset('real_flag', shape=desc_reals.shape, dtype=bool, data=desc_reals,
-                                        compression='gzip')
-            else:
-                print("Overwriting descendant subhalo real flags")
-                sub_desc = hdf_desc['Subhalos']
-                del sub_desc['real_flag']
-                sub_desc.create_dataset('real_flag', shape=desc_reals.shape, dtype=bool, data=desc_reals,
-                                        compression='gzip')
-
-            hdf_desc.close()
-
-        # Load the descendant snapshot
-        hdf_current = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r+')
-
-        # Set the reality flag in the halo catalog
-        if density_rank == 0:
-            print("Overwriting current real flags")
-            del hdf_current['real_flag']
-            hdf_current.create_dataset('real_flag', shape=reals.shape, dtype=bool, data=reals,
-                                    compression='gzip')
-        else:
-            print("Overwriting current subhalo real flags")
-            sub_current = hdf_current['Subhalos']
-            del sub_current['real_flag']
-            sub_current.create_dataset('real_flag', shape=reals.shape, dtype=bool, data=reals,
-                                    compression='gzip')
-
-        hdf_current.close()
+        # Write out the reality flag updates
+        utilities.write_real_flag_updates(halopath, snap, desc_snap, density_rank,
+                                          np.logical_and(old_reals, ~reals), promoted)
 
         if profile:
             profile_dict["Writing"]["Start"].append(write_start)
@@ -544,3 +502,354 @@ def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
 
         with open(profile_path + "Graph_" + str(rank) + '_' + snap + '.pck', 'wb') as pfile:
             pickle.dump(profile_dict, pfile)
+
+
+def read_pid_slice(hdf, density_rank):
+    """ A helper function to read this rank's slice of the particle halo ID array. Particle IDs
+    are split into contiguous ranges of (almost) equal size, one per rank, and only this rank's
+    range is read from the file using a hyperslab.
+
+    :param hdf: The open halo catalog HDF5 file.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :return: The halo IDs of the particles in this rank's particle ID range.
+    """
+
+    npart = utilities.read_part_haloids_npart(hdf)
+    low = npart * rank // size
+    high = npart * (rank + 1) // size
+
+    return utilities.read_part_haloids(hdf, density_rank, low, high)
+
+
+def exchange_rows(sendbuf, sendcounts, max_count=2 ** 31 - 1):
+    """ A function to exchange the rows of a 2D int64 array between all ranks. MPI counts and
+    displacements are C ints, so the exchange is done in rounds each moving at most max_count
+    values to or from each rank.
+
+    :param sendbuf: The rows to send, sorted by destination rank.
+    :param sendcounts: The number of rows to send to each rank.
+    :param max_count: The maximum number of values moved to or from a rank in a single round.
+    :return: The rows received from every rank in rank order.
+    """
+
+    ncol = sendbuf.shape[1]
+
+    # Communicate how many rows each rank will receive
+    sendcounts = np.asarray(sendcounts, dtype=np.int64)
+    recvcounts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(sendcounts, recvcounts)
+
+    send_starts = np.cumsum(sendcounts) - sendcounts
+    recv_starts = np.cumsum(recvcounts) - recvcounts
+
+    # Get the number of rows exchanged with each rank in a round and the number of rounds
+    chunk = max(max_count // (ncol * size), 1)
+    nround = comm.allreduce(int(-(-max(sendcounts.max(), recvcounts.max()) // chunk)), op=MPI.MAX)
+
+    recvbuf = np.empty((np.sum(recvcounts), ncol), dtype=np.int64)
+    for ind in range(nround):
+
+        # Get the rows exchanged with each rank in this round
+        low = ind * chunk
+        round_sendcounts = np.clip(sendcounts - low, 0, chunk)
+        round_recvcounts = np.clip(recvcounts - low, 0, chunk)
+        round_sendbuf = np.concatenate([sendbuf[start + low: start + low + n]
+                                        for start, n in zip(send_starts, round_sendcounts)])
+        round_recvbuf = np.empty((np.sum(round_recvcounts), ncol), dtype=np.int64)
+
+        sdispls = (np.cumsum(round_sendcounts) - round_sendcounts) * ncol
+        rdispls = (np.cumsum(round_recvcounts) - round_recvcounts) * ncol
+        comm.Alltoallv([round_sendbuf, ((round_sendcounts * ncol).astype(np.int32), sdispls.astype(np.int32)),
+                        MPI.INT64_T],
+                       [round_recvbuf, ((round_recvcounts * ncol).astype(np.int32), rdispls.astype(np.int32)),
+                        MPI.INT64_T])
+
+        # Place the received rows after those received from the same rank in earlier rounds
+        round_starts = np.cumsum(round_recvcounts) - round_recvcounts
+        for start, round_start, n in zip(recv_starts, round_starts, round_recvcounts):
+            recvbuf[start + low: start + low + n] = round_recvbuf[round_start: round_start + n]
+
+    return recvbuf
+
+
+def reduce_links(halos, linked, counts, bounds, nlinked, linked_reals=None):
+    """ A function to redistribute partial (current halo, linked halo, count) triples so that each
+    rank holds every partial link of the current halos it owns (the halos from bounds[rank] up to
+    bounds[rank + 1]) and then sum the partial counts and apply the linking criteria.
+
+    :param halos: The current halo ID of each partial link found on this rank.
+    :param linked: The linked halo ID of each partial link found on this rank.
+    :param counts: The number of particles shared by each partial link found on this rank.
+    :param bounds: The first halo ID owned by each rank followed by the number of halos.
+    :param nlinked: The number of halos in the linked snapshot.
+    :param linked_reals: The reality flag array of the linked snapshot, if provided links to halos
+                         which are not real are removed.
+    :return: The links of the halos owned by this rank.
+    """
+
+    # Sort the partial links by the rank that owns their current halo
+    dest = np.searchsorted(bounds, halos, side='right') - 1
+    sinds = np.argsort(dest, kind='stable')
+    sendbuf = np.ascontiguousarray(np.stack((halos, linked, counts), axis=1)[sinds], dtype=np.int64)
+
+    # Exchange the partial links
+    recvbuf = exchange_rows(sendbuf, np.bincount(dest, minlength=size))
+
+    return mgvec.sum_links(recvbuf[:, 0], recvbuf[:, 1], recvbuf[:, 2], nlinked,
+                           linked_reals=linked_reals)
+
+
+def write_distributed_links(snap, desc_snap, halopath, savepath, density_rank, results, demoted, promoted,
+                            bounds, compact=False):
+    """ A function to write out the Merger Graph arrays for a snapshot where each rank holds the results
+    of its own halo range (see mgvec.link_snapshot). Each rank writes its halos and links to its own
+    slice of every dataset (in rank order) with the ranks taking it in turns to write, the start
+    indices are shifted to point into the full link datasets.
+
+    :param snap: The snapshot ID.
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param results: The dictionary of Merger Graph arrays of this rank's halos.
+    :param demoted: The halos in this snapshot found to not be real (every halo).
+    :param promoted: The halos in the descendant snapshot found to be real.
+    :param bounds: The first halo ID owned by each rank followed by the number of halos.
+    :param compact: Whether to write narrow integer types without compressing small arrays
+                    (see utilities.write_compact_dataset).
+    :return: None
+    """
+
+    # Get the offset of this rank's links in the full link datasets
+    nlinks = np.array([len(results['Prog_haloIDs']), len(results['Desc_haloIDs'])], dtype=np.int64)
+    all_nlinks = np.array(comm.allgather(nlinks))
+    link_offsets = np.sum(all_nlinks[:rank], axis=0)
+    link_totals = np.sum(all_nlinks, axis=0)
+
+    # Shift the start indices of halos with links to point into the full link datasets
+    results = dict(results)
+    for key, offset in [('prog_start_index', link_offsets[0]), ('desc_start_index', link_offsets[1])]:
+        arr = results[key]
+        results[key] = np.where(np.logical_and(arr >= 0, arr != 2 ** 30), arr + offset, arr)
+
+    # Get the slice of each dataset written by this rank, the reality flags of the linked
+    # snapshots cover every halo so are written by the first rank
+    offsets = {}
+    totals = {}
+    for key in results:
+        if key.startswith('Prog_'):
+            offsets[key], totals[key] = link_offsets[0], link_totals[0]
+        elif key.startswith('Desc_'):
+            offsets[key], totals[key] = link_offsets[1], link_totals[1]
+        elif key in ('prog_real_flag', 'desc_real_flag'):
+            offsets[key], totals[key] = 0, results[key].size
+            if rank != 0:
+                results[key] = results[key][:0]
+        else:
+            offsets[key], totals[key] = bounds[rank], bounds[-1]
+
+    # Get the type of each dataset, compact types must hold the values of every rank
+    dtypes = {}
+    for key, arr in results.items():
+        if key.endswith('real_flag'):
+            dtypes[key] = np.dtype(bool)
+        elif compact:
+            lims = comm.allgather([arr.min(), arr.max()] if arr.size > 0 else [])
+            dtypes[key] = utilities.get_compact_dtype(np.array(sum(lims, []), dtype=np.int64))
+        else:
+            dtypes[key] = np.dtype(int)
+
+    if density_rank == 0:
+        graphpath = savepath + 'Mgraph_' + snap + '.hdf5'
+    else:
+        graphpath = savepath + 'SubMgraph_' + snap + '.hdf5'
+
+    # Create file to store this snapshots graph results
+    if rank == 0:
+        hdf = h5py.File(graphpath, 'w')
+        for key in results:
+            compress = totals[key] > 0 and (not compact or totals[key] * dtypes[key].itemsize > 2 ** 24)
+            if compress:
+                hdf.create_dataset(key, shape=(totals[key],), dtype=dtypes[key], chunks=True, compression='gzip')
+            else:
+                hdf.create_dataset(key, shape=(totals[key],), dtype=dtypes[key])
+        hdf.close()
+
+    for r in range(size):
+
+        comm.Barrier()
+
+        if r == rank:
+            hdf = h5py.File(graphpath, 'r+')
+            for key, arr in results.items():
+                if arr.size > 0:
+                    hdf[key][offsets[key]: offsets[key] + arr.size] = arr
+            hdf.close()
+
+    comm.Barrier()
+
+    # Write out the reality flag updates
+    if rank == 0:
+        utilities.write_real_flag_updates(halopath, snap, desc_snap, density_rank, demoted, promoted)
+
+
+def distributedProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
+                              density_rank, verbose, profile, profile_path, compact=False):
+    """ A function which finds and writes out the direct progenitor and descendant data for all
+    halos in a snapshot with the particle halo ID arrays distributed over all ranks. Each rank
+    owns a particle ID range and only reads that slice of the progenitor, current and
+    descendant particle halo ID arrays, so the memory used by each rank scales as npart / nranks.
+    The links are then reduced onto the rank owning each current halo (a contiguous range of halo
+    IDs per rank) which applies the reality criteria to its halos and writes them out.
+
+    :param snap: The snapshot ID.
+    :param prog_snap: The progenitor snapshot ID (None if this is the first snapshot).
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param verbose: Flag for verbose progress outputs.
+    :param profile: Flag for producing profiling outputs.
+    :param profile_path: The filepath to the directory where profiling outputs are written.
+    :param compact: Whether to write the compact Merger Graph format.
+    :return: None
+    """
+
+    if rank == 0:
+        print("---------------------------------------------------")
+        print("Progenitor snapshot:", prog_snap)
+        print("Current snapshot:", snap)
+        print("Descendant snapshot:", desc_snap)
+
+    if profile:
+        profile_dict = {}
+        profile_dict["START"] = time.time()
+        profile_dict["Reading"] = {"Start": [], "End": []}
+        profile_dict["Linking"] = {"Start": [], "End": []}
+        profile_dict["Communication"] = {"Start": [], "End": []}
+        profile_dict["Writing"] = {"Start": [], "End": []}
+    else:
+        profile_dict = None
+
+    # =============== Read This Rank's Slice Of Each Snapshot ===============
+
+    read_start = time.time()
+
+    hdf_current = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+    halo_ids, _ = mgvec.read_linking_data(hdf_current, density_rank)
+    current_haloids = read_pid_slice(hdf_current, density_rank)
+    hdf_current.close()
+
+    # Reality flag updates are only taken from snapshots linked before this one
+    reals = utilities.read_real_flags(halopath, snap, density_rank, demotions=False)
+
+    if prog_snap != None:
+        hdf_prog = h5py.File(halopath + 'halos_' + prog_snap + '.hdf5', 'r')
+        _, prog_npart = mgvec.read_linking_data(hdf_prog, density_rank)
+        prog_haloids = read_pid_slice(hdf_prog, density_rank)
+        hdf_prog.close()
+        prog_reals = utilities.read_real_flags(halopath, prog_snap, density_rank)
+    else:
+        prog_reals = np.array([False])
+        prog_npart = None
+
+    if desc_snap != None:
+        hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r')
+        _, desc_npart = mgvec.read_linking_data(hdf_desc, density_rank)
+        desc_haloids = read_pid_slice(hdf_desc, density_rank)
+        hdf_desc.close()
+        desc_reals = utilities.read_real_flags(halopath, desc_snap, density_rank,
+                                               promotions=False, demotions=False)
+    else:
+        desc_reals = np.array([False])
+        desc_npart = None
+
+    if verbose:
+        print("Rank", rank, "data reading took", time.time() - read_start, "seconds")
+
+    if profile:
+        profile_dict["Reading"]["Start"].append(read_start)
+        profile_dict["Reading"]["End"].append(time.time())
+
+    # =============== Count The Partial Links In This Rank's Particle ID Range ===============
+
+    link_start = time.time()
+
+    # Get this rank's contribution to the number of particles in each halo
+    part_npart = np.bincount(current_haloids[current_haloids >= 0], minlength=halo_ids.size)
+
+    # Partial links are kept regardless of count since the link threshold applies to the total
+    if prog_snap != None:
+        partial_prog_links = mgvec.count_links(current_haloids, prog_haloids, prog_reals.size,
+                                               link_threshold=1)
+    if desc_snap != None:
+        partial_desc_links = mgvec.count_links(current_haloids, desc_haloids, desc_reals.size,
+                                               link_threshold=1)
+
+    if profile:
+        profile_dict["Linking"]["Start"].append(link_start)
+        profile_dict["Linking"]["End"].append(time.time())
+
+    # =============== Reduce The Partial Links Onto The Ranks Owning Each Halo ===============
+
+    comm_start = time.time()
+
+    # Each rank owns a contiguous range of the current halos
+    bounds = halo_ids.size * np.arange(size + 1, dtype=np.int64) // size
+    low, high = bounds[rank], bounds[rank + 1]
+
+    npart = np.zeros_like(part_npart)
+    comm.Allreduce(part_npart, npart, op=MPI.SUM)
+
+    # Get the links of this rank's halos with the halo IDs relative to the start of its range
+    if prog_snap != None:
+        prog_halos, progs, prog_counts = reduce_links(*partial_prog_links, bounds, prog_reals.size,
+                                                      linked_reals=prog_reals)
+        prog_links = (prog_halos - low, progs, prog_counts)
+    else:
+        prog_links = None
+
+    if desc_snap != None:
+        desc_halos, descs, desc_counts = reduce_links(*partial_desc_links, bounds, desc_reals.size)
+        desc_links = (desc_halos - low, descs, desc_counts)
+    else:
+        desc_links = None
+
+    if verbose and rank == 0:
+        print("Reducing the links took", time.time() - comm_start, "seconds")
+
+    if profile:
+        profile_dict["Communication"]["Start"].append(comm_start)
+        profile_dict["Communication"]["End"].append(time.time())
+
+    # =============== Apply The Reality Criteria And Write Out ===============
+
+    write_start = time.time()
+
+    results, notreal, promoted = mgvec.link_snapshot(halo_ids[low:high], reals[low:high], npart[low:high],
+                                                     prog_links, desc_links, prog_reals, desc_reals,
+                                                     prog_npart, desc_npart)
+
+    # Combine the reality flag updates of every rank
+    demoted = np.zeros(halo_ids.size, dtype=bool)
+    demoted[low:high] = notreal
+    comm.Allreduce(MPI.IN_PLACE, demoted, op=MPI.LOR)
+    if promoted is not None:
+        comm.Allreduce(MPI.IN_PLACE, promoted, op=MPI.LOR)
+        desc_reals[promoted] = True
+
+    write_distributed_links(snap, desc_snap, halopath, savepath, density_rank, results, demoted, promoted,
+                            bounds, compact=compact)
+
+    if profile:
+        profile_dict["Writing"]["Start"].append(write_start)
+        profile_dict["Writing"]["End"].append(time.time())
+
+    if rank == 0:
+        print("Not real halos", np.sum(demoted), 'of', halo_ids.size)
+
+    if profile:
+        profile_dict["END"] = time.time()
+
+        with open(profile_path + "Graph_" + str(rank) + '_' + snap + '.pck', 'wb') as pfile:
+            pickle.dump(profile_dict, pfile)
@@ -0,0 +1,509 @@
+import numpy as np
+import h5py
+import pickle
+import time
+import utilities
+
+
+def filter_links(halos, linked, counts, linked_reals=None, link_threshold=10):
+    """ A function to apply the linking criteria to (current halo, linked halo, count) triples and sort
+    the surviving links by current halo ID and then by contribution (largest first).
+
+    :param halos: The current halo ID of each link.
+    :param linked: The linked halo ID of each link.
+    :param counts: The number of particles shared by each link.
+    :param linked_reals: The reality flag array of the linked snapshot, if provided links to halos
+                         which are not real are removed.
+    :param link_threshold: The minimum number of particles two halos must have in common to be linked.
+    :return: The filtered and sorted current halo IDs, linked halo IDs and counts.
+    """
+
+    # Halos are only linked if they have link_threshold or more particles in common
+    okinds = counts >= link_threshold
+
+    # Get only real linked halos
+    if linked_reals is not None:
+        okinds[okinds] = linked_reals[linked[okinds]]
+
+    halos = halos[okinds]
+    linked = linked[okinds]
+    counts = counts[okinds]
+
+    # Sort the links by halo and then by their contribution to the halo, ties are
+    # broken by the largest halo ID first to match the per halo ordering
+    sinds = np.lexsort((-linked, -counts, halos))
+
+    return halos[sinds], linked[sinds], counts[sinds]
+
+
+def count_links(current_haloids, linked_haloids, nlinked, linked_reals=None, link_threshold=10):
+    """ A function to count the number of particles shared between every halo in the current snapshot
+    and every halo in a linked (progenitor or descendant) snapshot in a single pass.
+
+    Particles are paired by particle ID (the index into the particle halo ID arrays), each
+    (current, linked) pair is encoded as a single 64 bit key and the keys are counted with np.unique.
+
+    :param current_haloids: The halo ID of each particle in the current snapshot (-2 if not in a halo).
+    :param linked_haloids: The halo ID of each particle in the linked snapshot (-2 if not in a halo).
+    :param nlinked: The number of halos in the linked snapshot.
+    :param linked_reals: The reality flag array of the linked snapshot, if provided links to halos
+                         which are not real are removed.
+    :param link_threshold: The minimum number of particles two halos must have in common to be linked.
+    :return: Arrays of the current halo ID, linked halo ID and number of shared particles for each link,
+             sorted by current halo ID and then by contribution (largest first).
+    """
+
+    # Remove particles which are not in a halo in either snapshot
+    okinds = np.logical_and(current_haloids >= 0, linked_haloids >= 0)
+
+    # Combine the current and linked halo IDs into a single key
+    keys = current_haloids[okinds].astype(np.int64) * nlinked + linked_haloids[okinds]
+
+    # Count the number of times each (current, linked) pair appears
+    unikeys, counts = np.unique(keys, return_counts=True)
+
+    return filter_links(unikeys // nlinked, unikeys % nlinked, counts,
+                        linked_reals=linked_reals, link_threshold=link_threshold)
+
+
+def sum_links(halos, linked, counts, nlinked, linked_reals=None, link_threshold=10):
+    """ A function to combine partial (current halo, linked halo, count) triples, for example those
+    counted on different particle ID ranges, by summing the counts of repeated links before
+    applying the linking criteria.
+
+    :param halos: The current halo ID of each partial link.
+    :param linked: The linked halo ID of each partial link.
+    :param counts: The number of particles shared by each partial link.
+    :param nlinked: The number of halos in the linked snapshot.
+    :param linked_reals: The reality flag array of the linked snapshot, if provided links to halos
+                         which are not real are removed.
+    :param link_threshold: The minimum number of particles two halos must have in common to be linked.
+    :return: The filtered and sorted current halo IDs, linked halo IDs and total counts.
+    """
+
+    # Combine the current and linked halo IDs into a single key
+    keys = halos.astype(np.int64) * nlinked + linked
+
+    # Sum the counts of each (current, linked) pair
+    unikeys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts, minlength=unikeys.size).astype(np.int64)
+
+    return filter_links(unikeys // nlinked, unikeys % nlinked, counts,
+                        linked_reals=linked_reals, link_threshold=link_threshold)
+
+
+def get_start_index(halos, nhalo):
+    """ A function to compute the number of links and the index of each halo's first link in the
+    concatenated link arrays produced by count_links.
+
+    :param halos: The (sorted) current halo ID of each link.
+    :param nhalo: The number of halos in the current snapshot.
+    :return: The number of links and start index for each halo.
+    """
+
+    nlinks = np.bincount(halos, minlength=nhalo)
+    start_index = np.zeros(nhalo, dtype=np.int64)
+    start_index[1:] = np.cumsum(nlinks)[:-1]
+
+    return nlinks, start_index
+
+
+def read_linking_data(hdf, density_rank):
+    """ A helper function to read the halo IDs and number of particles from a halo catalog
+    for hosts (density_rank=0) or subhalos (density_rank=1).
+
+    :param hdf: The open halo catalog HDF5 file.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :return: The halo IDs and number of particles in each halo.
+    """
+
+    if density_rank == 0:
+        root = hdf
+        halo_ids = root['halo_IDs'][...]
+    else:
+        root = hdf['Subhalos']
+        halo_ids = root['subhalo_IDs'][...]
+
+    return halo_ids, root['nparts'][...]
+
+
+def link_snapshot(halo_ids, reals, npart, prog_links, desc_links, prog_reals, desc_reals,
+                  prog_npart, desc_npart):
+    """ A function to apply the reality criteria to the links of every halo in a snapshot
+    and build the arrays stored in the Merger Graph file.
+
+    :param halo_ids: The halo IDs of the current snapshot.
+    :param reals: The reality flags of the current snapshot (updated in place).
+    :param npart: The number of particles in each halo in the current snapshot.
+    :param prog_links: The (halo, progenitor, count) link arrays, None if there is no progenitor snapshot.
+    :param desc_links: The (halo, descendant, count) link arrays, None if there is no descendant snapshot.
+    :param prog_reals: The reality flags of the progenitor snapshot.
+    :param desc_reals: The reality flags of the descendant snapshot (updated in place).
+    :param prog_npart: The number of particles in each progenitor snapshot halo.
+    :param desc_npart: The number of particles in each descendant snapshot halo.
+    :return: A dictionary of the Merger Graph arrays, the halos found to not be real and the
+             descendant halos found to be real (None if there is no descendant snapshot).
+    """
+
+    nhalo = halo_ids.size
+
+    if prog_links is not None:
+        prog_halos, progs, prog_mass_conts = prog_links
+        nprog, _ = get_start_index(prog_halos, nhalo)
+    else:
+        prog_halos = progs = prog_mass_conts = np.array([], dtype=np.int64)
+        nprog = np.full(nhalo, -1, dtype=np.int64)
+
+    if desc_links is not None:
+        desc_halos, descs, desc_mass_conts = desc_links
+        ndesc, _ = get_start_index(desc_halos, nhalo)
+    else:
+        desc_halos = descs = desc_mass_conts = np.array([], dtype=np.int64)
+        ndesc = np.full(nhalo, -1, dtype=np.int64)
+
+    # If this halo has no real progenitors and is less than 20 particle it is by definition not
+    # a halo
+    notreal = np.logical_and(nprog == 0, npart < 20)
+
+    # If the halo has neither descendants or progenitors we do not need to store it
+    notreal = np.logical_or(notreal, np.logical_and(nprog == ndesc, nprog <= 0))
+
+    # Only halos which were real on input are linked
+    notreal = np.logical_and(notreal, reals)
+    reals[notreal] = False
+
+    # If this halo is real then it's descendents are real
+    if desc_links is not None:
+        promoted = np.zeros(desc_reals.size, dtype=bool)
+        promoted[descs[reals[desc_halos]]] = True
+        desc_reals[promoted] = True
+    else:
+        promoted = None
+
+    # Remove the links of halos which are not stored
+    okinds = reals[prog_halos]
+    prog_halos, progs, prog_mass_conts = prog_halos[okinds], progs[okinds], prog_mass_conts[okinds]
+    okinds = reals[desc_halos]
+    desc_halos, descs, desc_mass_conts = desc_halos[okinds], descs[okinds], desc_mass_conts[okinds]
+
+    # Set up arrays to store host results
+    halo_nparts = np.full(nhalo, -2, dtype=int)
+    nprogs = np.full(nhalo, -2, dtype=int)
+    ndescs = np.full(nhalo, -2, dtype=int)
+    prog_start_index = np.full(nhalo, -2, dtype=int)
+    desc_start_index = np.full(nhalo, -2, dtype=int)
+
+    _, prog_starts = get_start_index(prog_halos, nhalo)
+    _, desc_starts = get_start_index(desc_halos, nhalo)
+
+    halo_nparts[reals] = npart[reals]
+    nprogs[reals] = nprog[reals]
+    ndescs[reals] = ndesc[reals]
+    prog_start_index[reals] = np.where(nprog[reals] > 0, prog_starts[reals], 2 ** 30)
+    desc_start_index[reals] = np.where(ndesc[reals] > 0, desc_starts[reals], 2 ** 30)
+
+    # Assign the number of particles in each linked halo
+    if prog_links is not None:
+        prog_nparts = prog_npart[progs]
+    else:
+        prog_nparts = np.array([], dtype=int)
+    if desc_links is not None:
+        desc_nparts = desc_npart[descs]
+    else:
+        desc_nparts = np.array([], dtype=int)
+
+    results = {'halo_IDs': halo_ids.copy(), 'nProgs': nprogs, 'nDescs': ndescs, 'nparts': halo_nparts,
+               'prog_start_index': prog_start_index, 'desc_start_index': desc_start_index,
+               'Prog_haloIDs': progs, 'Desc_haloIDs': descs,
+               'Prog_Mass_Contribution': prog_mass_conts, 'Desc_Mass_Contribution': desc_mass_conts,
+               'Prog_nPart': prog_nparts, 'Desc_nPart': desc_nparts,
+               'prog_real_flag': prog_reals, 'real_flag': reals, 'desc_real_flag': desc_reals}
+
+    return results, notreal, promoted
+
+
+def write_links(snap, desc_snap, halopath, savepath, density_rank, results, demoted, promoted, compact=False):
+    """ A function to write out the Merger Graph arrays for a snapshot and the reality flag
+    updates for the current and descendant snapshots. The halo catalogs are not modified,
+    updates are written to small sidecar files (see utilities.get_realness_paths).
+
+    :param snap: The snapshot ID.
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param results: The dictionary of Merger Graph arrays produced by link_snapshot.
+    :param demoted: The halos in this snapshot found to not be real.
+    :param promoted: The halos in the descendant snapshot found to be real.
+    :param compact: Whether to write narrow integer types without compressing small arrays
+                    (see utilities.write_compact_dataset).
+    :return: None
+    """
+
+    # Create file to store this snapshots graph results
+    if density_rank == 0:
+        hdf = h5py.File(savepath + 'Mgraph_' + snap + '.hdf5', 'w')
+    else:
+        hdf = h5py.File(savepath + 'SubMgraph_' + snap + '.hdf5', 'w')
+
+    for key, arr in results.items():
+        if compact:
+            utilities.write_compact_dataset(hdf, key, arr)
+        elif key.endswith('real_flag'):
+            hdf.create_dataset(key, shape=arr.shape, dtype=bool, data=arr, compression='gzip')
+        else:
+            hdf.create_dataset(key, shape=arr.shape, dtype=int, data=arr, compression='gzip')
+
+    hdf.close()
+
+    # Write out the reality flag updates
+    utilities.write_real_flag_updates(halopath, snap, desc_snap, density_rank, demoted, promoted)
+
+
+def read_snapshot(halopath, snap, density_rank, promotions=True, demotions=True):
+    """ A function to read everything the linking needs from a snapshot's halo catalog.
+
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param snap: The snapshot ID.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param promotions: Whether to include reality flag updates from linking the progenitor snapshot.
+    :param demotions: Whether to include reality flag updates from linking this snapshot.
+    :return: A dictionary containing the halo IDs, reality flags, number of particles in each halo
+             and the halo ID of each particle, and the number of bytes these arrays occupy in memory
+             (which differs from the bytes read from disk for compact or memory mapped datasets).
+    """
+
+    hdf = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+    halo_ids, nparts = read_linking_data(hdf, density_rank)
+    part_haloids = utilities.read_part_haloids(hdf, density_rank)
+    hdf.close()
+
+    reals = utilities.read_real_flags(halopath, snap, density_rank, promotions=promotions, demotions=demotions)
+
+    data = {'halo_ids': halo_ids, 'reals': reals, 'nparts': nparts, 'part_haloids': part_haloids}
+
+    return data, sum(arr.nbytes for arr in data.values())
+
+
+def link_and_write(snap, prog_snap, desc_snap, current, prog, desc, halopath, savepath,
+                   density_rank, verbose, profile_dict, compact=False):
+    """ A function to link the halos of the current snapshot to those in the progenitor and descendant
+    snapshots and write out the results. The reality flags in the current and descendant data
+    dictionaries are updated in place.
+
+    :param snap: The snapshot ID.
+    :param prog_snap: The progenitor snapshot ID (None if this is the first snapshot).
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param current: The current snapshot data dictionary from read_snapshot.
+    :param prog: The progenitor snapshot data dictionary from read_snapshot (None if prog_snap is None).
+    :param desc: The descendant snapshot data dictionary from read_snapshot (None if desc_snap is None).
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param verbose: Flag for verbose progress outputs.
+    :param profile_dict: The profiling dictionary (None if not profiling).
+    :param compact: Whether to write the compact Merger Graph format.
+    :return: None
+    """
+
+    print("---------------------------------------------------")
+    print("Progenitor snapshot:", prog_snap)
+    print("Current snapshot:", snap)
+    print("Descendant snapshot:", desc_snap)
+
+    # =============== Find all Direct Progenitors And Descendant Of Halos In This Snapshot ===============
+
+    link_start = time.time()
+
+    halo_ids = current['halo_ids']
+    reals = current['reals']
+    current_haloids = current['part_haloids']
+
+    # Get the number of particles in each halo
+    npart = np.bincount(current_haloids[current_haloids >= 0], minlength=halo_ids.size)
+
+    # Count the particles shared with each progenitor, only real progenitors are linked
+    if prog_snap != None:
+        prog_reals = prog['reals']
+        prog_npart = prog['nparts']
+        prog_links = count_links(current_haloids, prog['part_haloids'], prog_reals.size,
+                                 linked_reals=prog_reals)
+    else:
+        prog_reals = np.array([False])
+        prog_npart = None
+        prog_links = None
+
+    # Count the particles shared with each descendant
+    if desc_snap != None:
+        desc_reals = desc['reals']
+        desc_npart = desc['nparts']
+        desc_links = count_links(current_haloids, desc['part_haloids'], desc_reals.size)
+    else:
+        desc_reals = np.array([False])
+        desc_npart = None
+        desc_links = None
+
+    if verbose:
+        print("Linking took", time.time() - link_start, "seconds")
+
+    if profile_dict is not None:
+        profile_dict["Linking"]["Start"].append(link_start)
+        profile_dict["Linking"]["End"].append(time.time())
+
+    # =============== Apply The Reality Criteria And Write Out ===============
+
+    write_start = time.time()
+
+    results, demoted, promoted = link_snapshot(halo_ids, reals, npart, prog_links, desc_links, prog_reals,
+                                               desc_reals, prog_npart, desc_npart)
+
+    write_links(snap, desc_snap, halopath, savepath, density_rank, results, demoted, promoted, compact=compact)
+
+    if profile_dict is not None:
+        profile_dict["Writing"]["Start"].append(write_start)
+        profile_dict["Writing"]["End"].append(time.time())
+
+    if verbose:
+        print("Number of progenitors:", np.unique(results['nProgs'], return_counts=True))
+        print("Number of descendants:", np.unique(results['nDescs'], return_counts=True))
+    print("Not real halos", np.sum(demoted), 'of', halo_ids.size)
+
+
+def directProgDescWriter(snap, prog_snap, desc_snap, halopath, savepath,
+                         density_rank, verbose, profile, profile_path, compact=False):
+    """ A function which finds and writes out the direct progenitor and descendant data for
+    all halos in a snapshot at once using array operations. This produces the same outputs
+    as mergergraph_mpi.directProgDescWriter on a single process.
+
+    :param snap: The snapshot ID.
+    :param prog_snap: The progenitor snapshot ID (None if this is the first snapshot).
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param verbose: Flag for verbose progress outputs.
+    :param profile: Flag for producing profiling outputs.
+    :param profile_path: The filepath to the directory where profiling outputs are written.
+    :param compact: Whether to write the compact Merger Graph format.
+    :return: None
+    """
+
+    if profile:
+        profile_dict = {}
+        profile_dict["START"] = time.time()
+        profile_dict["Reading"] = {"Start": [], "End": []}
+        profile_dict["Linking"] = {"Start": [], "End": []}
+        profile_dict["Writing"] = {"Start": [], "End": []}
+    else:
+        profile_dict = None
+
+    # =============== Read Current, Progenitor and Descendant Snapshots ===============
+
+    read_start = time.time()
+
+    # Reality flag updates are only taken from snapshots linked before this one
+    current, _ = read_snapshot(halopath, snap, density_rank, demotions=False)
+
+    if prog_snap != None:
+        prog, _ = read_snapshot(halopath, prog_snap, density_rank)
+    else:
+        prog = None
+
+    if desc_snap != None:
+        desc, _ = read_snapshot(halopath, desc_snap, density_rank, promotions=False, demotions=False)
+    else:
+        desc = None
+
+    if verbose:
+        print("Data reading took", time.time() - read_start, "seconds")
+
+    if profile:
+        profile_dict["Reading"]["Start"].append(read_start)
+        profile_dict["Reading"]["End"].append(time.time())
+
+    link_and_write(snap, prog_snap, desc_snap, current, prog, desc, halopath, savepath,
+                   density_rank, verbose, profile_dict, compact=compact)
+
+    if profile:
+        profile_dict["END"] = time.time()
+
+        with open(profile_path + "Graph_0_" + snap + '.pck', 'wb') as pfile:
+            pickle.dump(profile_dict, pfile)
+
+
+def windowedProgDescWriter(snaplist, halopath, savepath, density_rank, verbose, profile, profile_path,
+                           compact=False):
+    """ A function which finds and writes out the direct progenitor and descendant data for every
+    snapshot in the snapshot list in a single pass. A three snapshot window (progenitor, current
+    and descendant) is kept in memory and advanced along the snapshot list, evicting the oldest
+    snapshot, so each halo catalog is read exactly once. Reality flags are carried forward in
+    memory from one snapshot to the next, so any existing reality flag updates are ignored.
+
+    :param snaplist: The list of snapshot IDs in ascending time order.
+    :param halopath: The filepath to the halo finder HDF5 file.
+    :param savepath: The filepath to the directory where the Merger Graph should be written out to.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param verbose: Flag for verbose progress outputs.
+    :param profile: Flag for producing profiling outputs.
+    :param profile_path: The filepath to the directory where profiling outputs are written.
+    :param compact: Whether to write the compact Merger Graph format.
+    :return: A dictionary of the number of bytes held in memory for each snapshot.
+    """
+
+    window = {}
+    bytes_in_memory = {}
+
+    for ind, snap in enumerate(snaplist):
+
+        if profile:
+            profile_dict = {}
+            profile_dict["START"] = time.time()
+            profile_dict["Reading"] = {"Start": [], "End": []}
+            profile_dict["Linking"] = {"Start": [], "End": []}
+            profile_dict["Writing"] = {"Start": [], "End": []}
+        else:
+            profile_dict = None
+
+        if ind - 1 < 0:
+            prog_snap = None
+        else:
+            prog_snap = snaplist[ind - 1]
+
+        if ind + 1 >= len(snaplist):
+            desc_snap = None
+        else:
+            desc_snap = snaplist[ind + 1]
+
+        # =============== Advance The Window ===============
+
+        read_start = time.time()
+
+        # Evict snapshots which have left the window
+        for key in list(window.keys()):
+            if key not in (prog_snap, snap, desc_snap):
+                del window[key]
+
+        # Read any snapshots which have entered the window
+        for key in (prog_snap, snap, desc_snap):
+            if key != None and key not in window:
+                window[key], bytes_in_memory[key] = read_snapshot(halopath, key, density_rank,
+                                                                  promotions=False, demotions=False)
+                print("Loaded", bytes_in_memory[key], "bytes into memory from snapshot", key)
+
+        if verbose:
+            print("Data reading took", time.time() - read_start, "seconds")
+
+        if profile:
+            profile_dict["Reading"]["Start"].append(read_start)
+            profile_dict["Reading"]["End"].append(time.time())
+
+        link_and_write(snap, prog_snap, desc_snap, window[snap], window.get(prog_snap), window.get(desc_snap),
+                       halopath, savepath, density_rank, verbose, profile_dict, compact=compact)
+
+        if profile:
+            profile_dict["END"] = time.time()
+
+            with open(profile_path + "Graph_0_" + snap + '.pck', 'wb') as pfile:
+                pickle.dump(profile_dict, pfile)
+
+    return bytes_in_memory
@@ -13,6 +13,7 @@ import sys
 import pickle
 import os
 import seaborn as sns
+import utilities
 
 
 sns.set_style('whitegrid')
@@ -185,10 +186,7 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerT
     hdf_current = h5py.File(halopath + 'halos_' + snapshot + '.hdf5', 'r')
 
     # Extract the halo IDs (group names/keys) contained within this snapshot
-    if len(hdf_current['Halo_IDs'][...].shape) == 2:
-        halo_ids = np.unique(hdf_current['Halo_IDs'][...])
-    else:
-        halo_ids = np.unique(hdf_current['Halo_IDs'][...])
+    halo_ids = np.unique(utilities.read_part_haloids(hdf_current, 0))
     halo_ids = np.array(halo_ids[np.where(halo_ids >= 0)], dtype=str)
 
     hdf_current.close()  # close the root group to reduce overhead when looping
@@ -208,7 +206,7 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerT
         hdf_prog = h5py.File(halopath + 'halos_' + prog_snap + '.hdf5', 'r')
 
         # Extract the particle halo ID array and particle ID array
-        prog_snap_haloIDs = hdf_prog['Halo_IDs'][...]
+        prog_snap_haloIDs = utilities.read_part_haloids(hdf_prog, 0)
 
         # Get all the unique halo IDs in this snapshot and the number of times they appear
         prog_unique, prog_counts = np.unique(prog_snap_haloIDs, return_counts=True)
@@ -247,10 +245,7 @@ def directProgDescWriter(snapshot, halopath='halo_snapshots/', savepath='MergerT
         hdf_desc = h5py.File(halopath + 'halos_' + desc_snap + '.hdf5', 'r')
 
         # Extract the particle -> halo ID array and particle ID array
-        if len(hdf_desc['Halo_IDs'][...].shape) == 2:
-            desc_snap_haloIDs = hdf_desc['Halo_IDs'][...]
-        else:
-            desc_snap_haloIDs = hdf_desc['Halo_IDs'][...]
+        desc_snap_haloIDs = utilities.read_part_haloids(hdf_desc, 0)
         hdf_desc.close()
 
         # Get all unique halos in this snapshot
@@ -751,15 +746,51 @@ def root_walker(root, treepath):
     return forest_dict
 
 
-def link_cutter_worker(snap, treepath):
+def read_tree_links(hdf, link):
+    """ A function to read the progenitor or descendant links of every halo in a tree linking file
+    (one group per halo, see directProgDescWriter) into flat arrays.
+
+    :param hdf: The open tree linking HDF5 file.
+    :param link: 'prog' or 'desc'.
+    :return: halos: The halo IDs with a group in the file (sorted).
+             nlinks: The number of links of each halo.
+             arrays: A dictionary of the concatenated link datasets in halo order.
+    """
 
-    # Compute the progenitor snapshot ID
-    if int(snap) > 10:
-        prog_snap = '0' + str(int(snap) - 1)
+    if link == 'prog':
+        keys = ['Prog_haloIDs', 'Prog_nPart', 'prog_mass_contribution']
     else:
-        prog_snap = '00' + str(int(snap) - 1)
+        keys = ['Desc_haloIDs', 'Desc_nPart', 'desc_mass_contribution']
+
+    halos = np.sort(np.array([int(halo) for halo in hdf.keys()], dtype=np.int64))
+
+    arrays = {key: [] for key in keys}
+    nlinks = np.zeros(halos.size, dtype=np.int64)
+    for ind, halo in enumerate(halos):
+        group = hdf[str(halo)]
+        for key in keys:
+            arrays[key].append(group[key][...])
+        nlinks[ind] = arrays[keys[0]][-1].size
+
+    arrays = {key: np.concatenate(arrs).astype(np.int64) if len(arrs) > 0 else np.array([], dtype=np.int64)
+              for key, arrs in arrays.items()}
+
+    return halos, nlinks, arrays
+
+
+def link_cutter_worker(snap, prog_snap, treepath):
+    """ A function to find the progenitor links of a snapshot to keep in the trees, a progenitor is
+    only kept if this halo is its main (first) descendant. Each snapshot's and progenitor snapshot's
+    linking files are opened once and every halo is handled at once, nothing is written here so
+    snapshots can be processed in parallel without touching each other's files.
+
+    :param snap: The snapshot ID.
+    :param prog_snap: The progenitor snapshot ID.
+    :param treepath: The filepath and basename of the tree linking files.
+    :return: A dictionary of the pruned progenitor datasets keyed by the halos with cut links (None
+             if no link was cut or a file is missing).
+    """
 
-    # Open the snapshot root group
     try:
         hdf = h5py.File(treepath + snap + '.hdf5', 'r')
     except OSError:
@@ -767,113 +798,105 @@ def link_cutter_worker(snap, treepath):
         return
 
     try:
-        # Open the snapshot root group
         prog_hdf = h5py.File(treepath + prog_snap + '.hdf5', 'r')
     except OSError:
         print(prog_snap, 'does not exist...')
+        hdf.close()
         return
 
-    previous_progress = -1
-    count = 0
-    size = len(hdf.keys())
-    halos = list(hdf.keys())
+    halos, nprogs, prog_arrays = read_tree_links(hdf, 'prog')
+    hdf.close()
 
-    # Loop over halos in this snapshot
-    for halo in halos:
+    prog_halos, ndescs, desc_arrays = read_tree_links(prog_hdf, 'desc')
+    prog_hdf.close()
 
-        # Compute and print the progress
-        progress = int(count/size*100)
-        if progress != previous_progress:  # only print if the integer progress differs from the last printed value
-            print('Breaking Incorrect Links... ' + snap + ' %.2f' % progress)
-        previous_progress = progress
-        count += 1
+    # Get the main (first) descendant of every halo in the progenitor snapshot (-1 if it has none)
+    desc_start_index = np.cumsum(ndescs) - ndescs
+    prog_main_descs = np.full(prog_halos.size, -1, dtype=np.int64)
+    okinds = ndescs > 0
+    prog_main_descs[okinds] = desc_arrays['Desc_haloIDs'][desc_start_index[okinds]]
 
-        hdf = h5py.File(treepath + snap + '.hdf5', 'r')
+    # Get the halo each progenitor link belongs to and the main descendant of the progenitor,
+    # progenitors without a group in the progenitor file have no main descendant
+    link_halos = np.repeat(halos, nprogs)
+    progs = prog_arrays['Prog_haloIDs']
+    inds = np.minimum(np.searchsorted(prog_halos, progs), max(prog_halos.size - 1, 0))
+    main_descs = np.full(progs.size, -1, dtype=np.int64)
+    if prog_halos.size > 0:
+        found = prog_halos[inds] == progs
+        main_descs[found] = prog_main_descs[inds[found]]
 
-        # Get the old progs
-        progs = hdf[halo]['Prog_haloIDs'][...]
-        prog_masses = hdf[halo]['Prog_nPart'][...]
-        prog_conts = hdf[halo]['prog_mass_contribution'][...]
-        nProgs = len(progs)
+    keep = main_descs == link_halos
 
-        hdf.close()
+    print('Breaking Incorrect Links... ' + snap, np.sum(~keep), 'of', keep.size)
 
-        prog_hdf = h5py.File(treepath + prog_snap + '.hdf5', 'r')
+    if keep.all():
+        return
 
-        # Loop over progenitors
-        new_progs = np.zeros_like(progs)
-        new_prog_masses = np.zeros_like(progs)
-        new_progs_cont = np.zeros_like(progs)
-        for ind, (prog, mass, cont) in enumerate(zip(progs, prog_masses, prog_conts)):
+    # Get the pruned datasets of each halo which lost a link
+    link_start_index = np.cumsum(nprogs) - nprogs
+    cut_halos = np.unique(np.searchsorted(halos, link_halos[~keep]))
+    results = {}
+    for ind in cut_halos:
+        start = link_start_index[ind]
+        end = start + nprogs[ind]
+        this_keep = keep[start: end]
+        results[str(halos[ind])] = {key: arr[start: end][this_keep] for key, arr in prog_arrays.items()}
 
-            descs = prog_hdf[str(prog)]['Desc_haloIDs'][...]
+    return results
 
-            if int(descs[0]) == int(halo):
-                new_progs[ind] = prog
-                new_prog_masses[ind] = mass
-                new_progs_cont[ind] = cont
-            else:
-                new_progs[ind] = -999
-                new_prog_masses[ind] = -999
-                new_progs_cont[ind] = -999
 
-        prog_hdf.close()
+def link_cutter_writer(snap, results, treepath):
+    """ A function to replace the progenitor datasets of the halos which lost links in a snapshot's
+    tree linking file with their pruned versions, opening the file once.
 
-        if -999 in new_progs:
+    :param snap: The snapshot ID.
+    :param results: The pruned datasets from link_cutter_worker.
+    :param treepath: The filepath and basename of the tree linking files.
+    :return: None
+    """
 
-            hdf = h5py.File(treepath + snap + '.hdf5', 'r+')
+    if results is None:
+        return
 
-            del hdf[halo]['Prog_haloIDs']
-            del hdf[halo]['Prog_nPart']
-            del hdf[halo]['prog_mass_contribution']
-            new_nprogs = len(new_progs)
+    hdf = h5py.File(treepath + snap + '.hdf5', 'r+')
 
-            prog_haloids = new_progs[np.where(new_progs != -999)]
-            prog_npart = new_prog_masses[np.where(new_progs != -999)]
-            prog_mass_contribution = new_progs_cont[np.where(new_progs != -999)]
-            new_nprogs = len(prog_haloids)
+    for halo, arrays in results.items():
 
-            halohdf = hdf[halo]
-            halohdf.create_dataset('prog_mass_contribution', data=prog_mass_contribution, dtype=int,
-                                   compression='gzip')  # Mass contribution
-            halohdf.create_dataset('Prog_nPart', data=prog_npart, dtype=int,
-                                   compression='gzip')  # number of particles in each progenitor
-            halohdf.create_dataset('Prog_haloIDs', data=prog_haloids, dtype=int,
-                                   compression='gzip')  # progenitor IDs
-            halohdf.attrs['nProg'] = new_nprogs
+        halohdf = hdf[halo]
+        for key, arr in arrays.items():
+            del halohdf[key]
+            halohdf.create_dataset(key, data=arr, dtype=int, compression='gzip')
+        halohdf.attrs['nProg'] = arrays['Prog_haloIDs'].size
 
-            hdf.close()
+    hdf.close()
 
 
-def link_cutter(treepath='MergerGraphs/Mgraph_'):
+def link_cutter(treepath='MergerGraphs/Mgraph_', snaplist=None, nprocs=None):
+    """ A function to cut the progenitor links of every snapshot which do not follow a progenitor's
+    main descendant. The links of all snapshots are found in parallel (only reading files) and then
+    each snapshot's file is rewritten once in parallel, so no file is read while another process
+    writes it.
 
-    # Create a snapshot list (past to present day) for looping
-    even_snaplist = []
-    for snap in range(0, 62):
-        if snap % 2 != 0:
-            continue
-        if snap < 10:
-            even_snaplist.append('00' + str(snap))
-        elif snap >= 10:
-            even_snaplist.append('0' + str(snap))
+    :param treepath: The filepath and basename of the tree linking files.
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present), defaults to
+                     the 62 snapshots 000 to 061.
+    :param nprocs: The number of worker processes (defaults to all but two CPUs).
+    :return: None
+    """
 
-    pool = mp.Pool(int(mp.cpu_count() - 2))
-    pool.map(partial(link_cutter_worker, treepath=treepath), even_snaplist)
-    pool.close()
-    pool.join()
+    if snaplist is None:
+        snaplist = ['%03d' % snap for snap in range(0, 62)]
 
-    # Create a snapshot list (past to present day) for looping
-    odd_snaplist = []
-    for snap in range(0, 62):
-        if snap % 2 == 0:
-            continue
-        if snap < 10:
-            odd_snaplist.append('00' + str(snap))
-        elif snap >= 10:
-            odd_snaplist.append('0' + str(snap))
+    if nprocs is None:
+        nprocs = max(mp.cpu_count() - 2, 1)
 
-    pool = mp.Pool(int(mp.cpu_count() - 2))
-    pool.map(partial(link_cutter_worker, treepath=treepath), odd_snaplist)
+    snaps = list(snaplist[1:])
+    prog_snaps = list(snaplist[:-1])
+
+    pool = mp.Pool(nprocs)
+    results = pool.starmap(partial(link_cutter_worker, treepath=treepath), zip(snaps, prog_snaps))
+    pool.starmap(partial(link_cutter_writer, treepath=treepath), zip(snaps, results))
     pool.close()
     pool.join()
 
@@ -0,0 +1,658 @@
+import h5py
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import build_graph_mpi as bgmpi
+import graph_io
+import utilities
+
+
+NO_DATA = 2 ** 30
+
+# The per halo datasets of each level of the hierarchy (without the "sub_" prefix)
+LEVEL_KEYS = {'': graph_io.HALO_KEYS,
+              'sub_': [key[4:] if key.startswith('sub_') else key for key in graph_io.SUB_HALO_KEYS]}
+ID_KEYS = {'': 'halo_catalog_halo_ids', 'sub_': 'subhalo_catalog_halo_ids'}
+
+
+def get_file_key(pre, key):
+    """ Get the graph file dataset name of a per halo or per link key at a level of the hierarchy. """
+
+    if key in ['subhalo_catalog_halo_ids', 'host_halos']:
+        return key
+
+    return pre + key
+
+
+def prepare_graph_file(graphpath):
+    """ A function to make a graph file ready to be updated, its datasets are made resizable and the
+    link counts, extension indices and superseded flags are added if the file does not have them.
+
+    :param graphpath: The filepath and basename of the graph file.
+    :return: None
+    """
+
+    graph_io.make_graph_file_resizable(graphpath)
+
+    hdf = h5py.File(graphpath + '.hdf5', 'r+')
+    ngraph = hdf['nhalos_in_graph'].shape[0]
+
+    for pre in ['', 'sub_']:
+
+        # Older files only store the start of each graph's links
+        for link, link_key in [('prog', 'direct_prog_ids'), ('desc', 'direct_desc_ids')]:
+            if pre + 'graph_n' + link + '_links' not in hdf:
+                starts = hdf[pre + 'graph_' + link + '_start_index'][...]
+                ends = np.append(starts[1:], hdf[pre + link_key].shape[0])
+                graph_io.append_dataset(hdf, pre + 'graph_n' + link + '_links', ends - starts)
+
+        if pre + 'graph_extension_index' not in hdf:
+            graph_io.append_dataset(hdf, pre + 'graph_extension_index', np.full(ngraph, NO_DATA))
+
+    if 'superseded' not in hdf:
+        graph_io.append_dataset(hdf, 'superseded', np.zeros(ngraph, dtype=bool))
+
+    hdf.close()
+
+
+def read_graph_tables(hdf, pre):
+    """ A function to read the per graph and per extension datasets of a level of the hierarchy.
+
+    :param hdf: The open graph file.
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :return: A dictionary of the tables keyed by dataset name.
+    """
+
+    keys = [pre + key for key in graph_io.GRAPH_KEYS + ['graph_extension_index'] + graph_io.EXTENSION_KEYS]
+    tables = {key: hdf[key][...] for key in keys if key in hdf}
+    tables['superseded'] = hdf['superseded'][...]
+
+    return tables
+
+
+def get_prev_nodes(hdf, tables, pre, nprev):
+    """ A function to find the halos in the final generation of every graph reaching the previous
+    snapshot. Only the final generation of these graphs is read from the file.
+
+    :param hdf: The open graph file.
+    :param tables: The tables of this level from read_graph_tables.
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :param nprev: The number of halos in the previous snapshot.
+    :return: The graph, the ID within the graph and the position in the halo datasets of each halo in
+             the previous snapshot (-1 for halos in no graph).
+    """
+
+    gen_start = tables[pre + 'generation_start_index'][:, -1]
+    gen_len = tables[pre + 'generation_length'][:, -1]
+    active = np.where((gen_len != NO_DATA) & ~tables['superseded'])[0]
+
+    prev_graph = np.full(nprev, -1, dtype=np.int64)
+    prev_local = np.full(nprev, -1, dtype=np.int64)
+    prev_pos = np.full(nprev, -1, dtype=np.int64)
+    for graph_id in active:
+
+        segments = graph_io.get_graph_segments(tables, graph_id, pre)
+        local_ids = gen_start[graph_id] + np.arange(gen_len[graph_id], dtype=np.int64)
+        pos = graph_io.get_halo_positions(segments, local_ids)
+
+        # A generation is always contiguous within one segment
+        halos = hdf[ID_KEYS[pre]][pos[0]: pos[-1] + 1]
+        prev_graph[halos] = graph_id
+        prev_local[halos] = local_ids
+        prev_pos[halos] = pos
+
+    return prev_graph, prev_local, prev_pos
+
+
+def get_update_targets(prev_graph, ngraph, new_reals, data_dict, prev_snap, new_snap):
+    """ A function to find the graph each halo in the new snapshot belongs to. The new halos and the
+    existing graphs are linked by the new links and the connected components containing real new halos
+    are found. A component containing a single existing graph extends it, all other components
+    (joining several graphs or containing no existing graph) become new graphs.
+
+    :param prev_graph: The graph of each halo in the previous snapshot from get_prev_nodes.
+    :param ngraph: The number of graphs in the file.
+    :param new_reals: The real flag of each halo in the new snapshot.
+    :param data_dict: The data dictionary containing the previous and new snapshot.
+    :param prev_snap: The previous snapshot ID.
+    :param new_snap: The new snapshot ID.
+    :return: The target graph of each new halo and of each existing graph (-1 for those in no target),
+             targets >= ngraph are new graphs.
+    """
+
+    nnew = new_reals.size
+
+    halos, progs = utilities.get_link_edges(data_dict['prog_start_index'][new_snap],
+                                            data_dict['nprogs'][new_snap], data_dict['progs'][new_snap])
+    prev_halos, descs = utilities.get_link_edges(data_dict['desc_start_index'][prev_snap],
+                                                 data_dict['ndescs'][prev_snap], data_dict['descs'][prev_snap])
+
+    # Each existing graph is a single node after the new halos
+    rows = np.concatenate([halos, descs])
+    cols = prev_graph[np.concatenate([progs, prev_halos])]
+    okinds = cols >= 0
+
+    adjacency = coo_matrix((np.ones(np.sum(okinds), dtype=np.int8), (rows[okinds], nnew + cols[okinds])),
+                           shape=(nnew + ngraph, nnew + ngraph))
+    ncomp, labels = connected_components(adjacency, directed=False)
+
+    new_labels = labels[:nnew]
+    old_labels = labels[nnew:]
+
+    is_root = np.zeros(ncomp, dtype=bool)
+    is_root[new_labels[new_reals]] = True
+    comp_ngraph = np.bincount(old_labels, minlength=ncomp)
+
+    # Components holding a single existing graph extend it, the rest become new graphs
+    comp_target = np.full(ncomp, -1, dtype=np.int64)
+    extended = np.where((is_root & (comp_ngraph == 1))[old_labels])[0]
+    comp_target[old_labels[extended]] = extended
+    new_comps = np.where(is_root & (comp_ngraph != 1))[0]
+    comp_target[new_comps] = ngraph + np.arange(new_comps.size)
+
+    return comp_target[new_labels], comp_target[old_labels]
+
+
+def concatenate_graphs(views, pre):
+    """ A function to concatenate graphs of one level of the hierarchy, the IDs within each graph are
+    offset by the size of the graphs before it.
+
+    :param views: A list of graph dictionaries from get_graph_view.
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :return: The concatenated graph dictionary and the offset of each graph's halos.
+    """
+
+    nhalos = np.array([len(view['nparts']) for view in views], dtype=np.int64)
+    shifts = {'direct_prog_ids': nhalos, 'direct_desc_ids': nhalos,
+              'prog_start_index': np.array([len(view['direct_prog_ids']) for view in views], dtype=np.int64),
+              'desc_start_index': np.array([len(view['direct_desc_ids']) for view in views], dtype=np.int64)}
+    shifts = {key: np.cumsum(n) - n for key, n in shifts.items()}
+
+    graph = {}
+    for key in LEVEL_KEYS[pre] + graph_io.PROG_KEYS + graph_io.DESC_KEYS:
+        arrs = []
+        for ind, view in enumerate(views):
+            arr = np.array(view[key])
+            if key in shifts:
+                arr = np.where(arr != NO_DATA, arr + shifts[key][ind], arr)
+            arrs.append(arr)
+        if len(arrs) == 0:
+            file_key = get_file_key(pre, key)
+            arrs.append(np.zeros((0, 3) if key in ['mean_pos', 'mean_vel'] else 0,
+                                 dtype=graph_io.DTYPES.get(file_key, np.int32)))
+        graph[key] = np.concatenate(arrs)
+
+    return graph, np.cumsum(nhalos) - nhalos
+
+
+def reorder_graph(graph, order, pre):
+    """ A function to reorder the halos of a graph, rearranging their links to match.
+
+    :param graph: The graph dictionary.
+    :param order: The old ID of each halo in the new order.
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :return: The reordered graph dictionary and the new ID of each old halo.
+    """
+
+    inv = np.empty(order.size, dtype=np.int64)
+    inv[order] = np.arange(order.size)
+
+    new = {key: graph[key][order] for key in LEVEL_KEYS[pre]}
+    for link in ['prog', 'desc']:
+
+        nlinks = np.maximum(new['n' + link], 0).astype(np.int64)
+        first = np.cumsum(nlinks) - nlinks
+        pos = (np.repeat(new[link + '_start_index'].astype(np.int64) - first, nlinks)
+               + np.arange(np.sum(nlinks), dtype=np.int64))
+
+        new['direct_' + link + '_ids'] = inv[graph['direct_' + link + '_ids'][pos]]
+        new['direct_' + link + '_contribution'] = graph['direct_' + link + '_contribution'][pos]
+        new[link + '_start_index'] = np.where(nlinks > 0, first, NO_DATA)
+
+    return new, inv
+
+
+def get_subhalo_pointers(host_halos, nhost, sub_ids):
+    """ A function to get the first subhalo and number of subhalos of each host.
+
+    :param host_halos: The host of each subhalo (NO_DATA for subhalos without a host in the graph),
+                       subhalos must be sorted by host.
+    :param nhost: The number of hosts.
+    :param sub_ids: The ID within the graph of each subhalo.
+    :return: The subhalo start index and number of subhalos of each host.
+    """
+
+    okinds = host_halos != NO_DATA
+    nsubhalos = np.bincount(host_halos[okinds], minlength=nhost)
+    subhalo_start_index = np.full(nhost, NO_DATA, dtype=np.int64)
+    hosts_with_subs, first = np.unique(host_halos[okinds], return_index=True)
+    subhalo_start_index[hosts_with_subs] = sub_ids[np.where(okinds)[0][first]]
+
+    return subhalo_start_index, nsubhalos
+
+
+def get_generation_tables(snapshots, snap_ints):
+    """ A function to get the generation tables of a graph whose halos are sorted by generation.
+
+    :param snapshots: The snapshot of each halo.
+    :param snap_ints: The snapshot IDs (as integers) in ascending time order.
+    :return: The generation start index, generation length and generation ID rows.
+    """
+
+    nsnap = snap_ints.size
+    gen = np.searchsorted(snap_ints, snapshots)
+    length = np.bincount(gen, minlength=nsnap)
+    start = np.full(nsnap, NO_DATA, dtype=np.int64)
+    ugen, first = np.unique(gen, return_index=True)
+    start[ugen] = first
+
+    return start, np.where(length > 0, length, NO_DATA), np.where(length > 0, np.arange(nsnap), NO_DATA)
+
+
+def get_merged_graphs(columns, old_target, ngraph, nmerged, snap_ints):
+    """ A function to build the new graphs joining several existing graphs. The existing graphs are
+    concatenated and reordered by generation and mass (by host and mass for subhalos).
+
+    :param columns: The graph file datasets (with the tables of each level in memory).
+    :param old_target: The target graph of each existing graph.
+    :param ngraph: The number of graphs in the file.
+    :param nmerged: The number of new graphs.
+    :param snap_ints: The snapshot IDs (as integers) of the existing generations.
+    :return: A dictionary for each level containing the list of merged graph dictionaries, the new ID
+             of each old halo (concatenated over merged graphs), the start of each merged graph in it
+             and the offset of each existing graph within its merged graph.
+    """
+
+    sinds = np.argsort(old_target, kind='stable')
+    bounds = np.searchsorted(old_target[sinds], ngraph + np.arange(nmerged + 1))
+
+    out = {pre: {'graphs': [], 'inv': [], 'offset': np.zeros(ngraph, dtype=np.int64)} for pre in ['', 'sub_']}
+    for ind in range(nmerged):
+
+        graph_ids = sinds[bounds[ind]: bounds[ind + 1]]
+
+        host, host_offsets = concatenate_graphs([graph_io.get_graph_view(columns, g) for g in graph_ids], '')
+        sub, sub_offsets = concatenate_graphs([graph_io.get_graph_view(columns, g, sub=True)
+                                               for g in graph_ids], 'sub_')
+        out['']['offset'][graph_ids] = host_offsets
+        out['sub_']['offset'][graph_ids] = sub_offsets
+
+        # Subhalo hosts are relative to their own host graph
+        host_shift = np.repeat(host_offsets, [columns['sub_nhalos_in_graph'][g] for g in graph_ids])
+        sub['host_halos'] = np.where(sub['host_halos'] != NO_DATA, sub['host_halos'] + host_shift, NO_DATA)
+
+        host, host_inv = reorder_graph(host, np.lexsort((-host['nparts'],
+                                                         np.searchsorted(snap_ints, host['snapshots']))), '')
+
+        sub['host_halos'] = np.where(sub['host_halos'] != NO_DATA,
+                                     host_inv[np.minimum(sub['host_halos'], host_inv.size - 1)], NO_DATA)
+        sub, sub_inv = reorder_graph(sub, np.lexsort((-sub['nparts'], sub['host_halos'],
+                                                      np.searchsorted(snap_ints, sub['snapshots']))), 'sub_')
+
+        host['subhalo_start_index'], host['nsubhalos'] = get_subhalo_pointers(
+            sub['host_halos'], host['nparts'].size, np.arange(sub['nparts'].size))
+
+        out['']['graphs'].append(host)
+        out['']['inv'].append(host_inv)
+        out['sub_']['graphs'].append(sub)
+        out['sub_']['inv'].append(sub_inv)
+
+    for pre in out:
+        ninv = np.array([inv.size for inv in out[pre]['inv']], dtype=np.int64)
+        out[pre]['inv_start'] = np.cumsum(ninv) - ninv
+        out[pre]['inv'] = np.concatenate(out[pre]['inv']) if nmerged > 0 else np.array([], dtype=np.int64)
+
+    return out
+
+
+def get_new_generation(halos, target, prev_target, prev_local, base, data_dict, prev_snap, new_snap,
+                       sort_key=None):
+    """ A function to get the halos of the new snapshot and their links in each target graph. New
+    halos are given IDs after the existing halos of their graph in order of decreasing mass. Only links
+    between halos of the same graph are kept.
+
+    :param halos: The new snapshot halos in a target graph.
+    :param target: The target graph of each of these halos.
+    :param prev_target: The target graph of each previous snapshot halo (-1 for those in none).
+    :param prev_local: The ID within its target graph of each previous snapshot halo.
+    :param base: A dictionary of the number of halos, progenitor links and descendant links already
+                 in each target graph.
+    :param data_dict: The data dictionary containing the previous and new snapshot.
+    :param prev_snap: The previous snapshot ID.
+    :param new_snap: The new snapshot ID.
+    :param sort_key: A key to sort halos by before mass within each graph (the host for subhalos).
+    :return: A dictionary of the new halos' columns, a dictionary of their progenitor links and a
+             dictionary of the descendant links of the previous snapshot halos.
+    """
+
+    nnew = len(data_dict['nparts'][new_snap])
+    ntarget = base['nhalos'].size
+    mass = np.asarray(data_dict['nparts'][new_snap][halos], dtype=np.int64)
+    if sort_key is None:
+        sort_key = np.zeros(halos.size, dtype=np.int64)
+
+    # Sort by graph then mass, each graph's new halos follow its existing halos
+    sinds = np.lexsort((-mass, sort_key, target))
+    halos = halos[sinds]
+    target = target[sinds]
+    mass = mass[sinds]
+    counts = np.bincount(target, minlength=ntarget)
+    local = base['nhalos'][target] + np.arange(halos.size) - (np.cumsum(counts) - counts)[target]
+
+    new_target = np.full(nnew, -1, dtype=np.int64)
+    new_target[halos] = target
+    new_local = np.full(nnew, -1, dtype=np.int64)
+    new_local[halos] = local
+
+    nodes = {'halo_ids': halos, 'target': target, 'local': local, 'nparts': mass,
+             'redshifts': np.full(halos.size, data_dict['redshift'][new_snap], dtype=float),
+             'snapshots': np.full(halos.size, int(new_snap), dtype=np.int64),
+             'ndesc': np.minimum(data_dict['ndescs'][new_snap][halos], 0),
+             'desc_start_index': np.full(halos.size, NO_DATA, dtype=np.int64)}
+    for key, data_key in bgmpi.PROP_KEYS.items():
+        nodes[key] = data_dict[data_key][new_snap][halos]
+
+    # Get the progenitor links of the new halos and the descendant links of the previous halos
+    prev_halos = np.where(prev_target >= 0)[0]
+    prev_halos = prev_halos[np.lexsort((prev_local[prev_halos], prev_target[prev_halos]))]
+
+    links = {}
+    for link, snap, link_halos, link_target, linked_target, linked_local in [
+            ('prog', new_snap, halos, target, prev_target, prev_local),
+            ('desc', prev_snap, prev_halos, prev_target[prev_halos], new_target, new_local)]:
+
+        n = np.maximum(data_dict['n' + link + 's'][snap][link_halos], 0).astype(np.int64)
+        first = np.cumsum(n) - n
+        pos = (np.repeat(data_dict[link + '_start_index'][snap][link_halos].astype(np.int64) - first, n)
+               + np.arange(np.sum(n), dtype=np.int64))
+        src = np.repeat(np.arange(link_halos.size), n)
+        linked = np.asarray(data_dict[link + 's'][snap][pos], dtype=np.int64)
+
+        # Drop links leaving the graph
+        okinds = linked_target[linked] == link_target[src]
+        nkept = np.bincount(src[okinds], minlength=link_halos.size)
+        target_nkept = np.bincount(link_target, weights=nkept, minlength=ntarget).astype(np.int64)
+        start = (base['n' + link + '_links'][link_target] + np.cumsum(nkept) - nkept
+                 - (np.cumsum(target_nkept) - target_nkept)[link_target])
+
+        links[link] = {'halo_ids': link_halos, 'target': link_target, 'n' + link: nkept,
+                       link + '_start_index': np.where(nkept > 0, start, NO_DATA), 'nlinks': target_nkept,
+                       'direct_' + link + '_ids': linked_local[linked[okinds]],
+                       'direct_' + link + '_contribution': data_dict[link + '_conts'][snap][pos[okinds]]}
+
+    nodes['nprog'] = links['prog']['nprog']
+    nodes['prog_start_index'] = links['prog']['prog_start_index']
+
+    return nodes, links['prog'], links['desc']
+
+
+def append_extensions(hdf, tables, pre, nodes, progs, descs, ngraph):
+    """ A function to append the new halos and links of extended graphs as extension segments.
+
+    :param hdf: The open graph file.
+    :param tables: The tables of this level from read_graph_tables (updated in place).
+    :param pre: The dataset prefix ("sub_" for subhalos).
+    :param nodes: The new halos from get_new_generation.
+    :param progs: The progenitor links from get_new_generation.
+    :param descs: The descendant links from get_new_generation.
+    :param ngraph: The number of graphs in the file.
+    :return: None
+    """
+
+    nhalos = np.bincount(nodes['target'], minlength=ngraph)[:ngraph]
+    nprog_links = progs['nlinks'][:ngraph]
+    ndesc_links = descs['nlinks'][:ngraph]
+
+    # The new halos and links of extended graphs come first
+    nnode = np.sum(nhalos)
+    starts = {'': graph_io.append_dataset(hdf, get_file_key(pre, LEVEL_KEYS[pre][0]),
+                                                nodes[LEVEL_KEYS[pre][0]][:nnode])}
+    for key in LEVEL_KEYS[pre][1:]:
+        graph_io.append_dataset(hdf, get_file_key(pre, key), nodes[key][:nnode])
+    for link, link_dict, n, keys in [('prog_', progs, nprog_links, graph_io.PROG_KEYS),
+                                     ('desc_', descs, ndesc_links, graph_io.DESC_KEYS)]:
+        for key in keys:
+            starts[link] = graph_io.append_dataset(hdf, pre + key, link_dict[key][:np.sum(n)])
+
+    graph_ids = np.where((nhalos > 0) | (nprog_links > 0) | (ndesc_links > 0))[0]
+    next_ext = hdf[pre + 'extension_graph'].shape[0] if pre + 'extension_graph' in hdf else 0
+    ext_ids = next_ext + np.arange(graph_ids.size)
+
+    ext = {'extension_graph': graph_ids, 'extension_prev_index': tables[pre + 'graph_extension_index'][graph_ids]}
+    for name, n, count_key, local_key in [('', nhalos, 'nhalos', 'nhalos_in_graph'),
+                                          ('prog_', nprog_links, 'nprog_links', 'graph_nprog_links'),
+                                          ('desc_', ndesc_links, 'ndesc_links', 'graph_ndesc_links')]:
+        ext['extension_' + name + 'start_index'] = starts[name] + (np.cumsum(n) - n)[graph_ids]
+        ext['extension_' + name + 'local_start'] = tables[pre + local_key][graph_ids]
+        ext['extension_' + count_key] = n[graph_ids]
+        tables[pre + local_key][graph_ids] += n[graph_ids]
+
+    for key in graph_io.EXTENSION_KEYS:
+        graph_io.append_dataset(hdf, pre + key, ext[key])
+    tables[pre + 'graph_extension_index'][graph_ids] = ext_ids
+
+
+def main_update_graph(treepath, graphpath, snaplist, halopath, cache_bytes=2 ** 32):
+    """ A function to add a new snapshot to an existing graph file without rebuilding it. Only the
+    graphs reached by the new snapshot's links are touched, a graph reached by a single existing graph
+    is extended in place and graphs joined by the new snapshot are merged into a new graph (flagging
+    those it replaces as superseded). The linking data of the previous snapshot must have been
+    rewritten with the new snapshot as its descendant snapshot.
+
+    :param treepath: The filepath of the direct progenitor and descendant (Mgraph) files.
+    :param graphpath: The filepath and basename of the graph file.
+    :param snaplist: The list of snapshot IDs in ascending time order, ending with the new snapshot.
+    :param halopath: The filepath of the halo catalogues.
+    :param cache_bytes: The maximum number of bytes of snapshot data held in memory.
+    :return: None
+    """
+
+    snaplist = list(snaplist)
+    prev_snap, new_snap = snaplist[-2], snaplist[-1]
+    nsnap = len(snaplist)
+    snap_ints = np.array(snaplist, dtype=np.int64)
+
+    prepare_graph_file(graphpath)
+    hdf = h5py.File(graphpath + '.hdf5', 'r+')
+
+    assert hdf['generation_length'].shape[1] == nsnap - 1, \
+        "The graph file must end at the snapshot before " + new_snap
+
+    # Only the previous and new snapshots are needed
+    cache = utilities.SnapshotCache(cache_bytes)
+    data = {'': utilities.get_graph_data(cache, treepath, halopath, [prev_snap, new_snap], sub=False),
+            'sub_': utilities.get_graph_data(cache, treepath, halopath, [prev_snap, new_snap], sub=True)}
+
+    tables = {pre: read_graph_tables(hdf, pre) for pre in data}
+    ngraph = tables['']['nhalos_in_graph'].size
+    superseded = tables['']['superseded']
+
+    prev = {pre: get_prev_nodes(hdf, tables[pre], pre, len(data[pre]['nparts'][prev_snap])) for pre in data}
+
+    # ===================== Find the graphs touched by the new snapshot =====================
+
+    new_reals = np.asarray(cache.read(treepath + 'Mgraph_' + new_snap + '.hdf5', 'real_flag'), dtype=bool)
+    new_target, old_target = get_update_targets(prev[''][0], ngraph, new_reals, data[''], prev_snap, new_snap)
+
+    columns = {key: hdf[key] for key in hdf.keys() if key != 'Header'}
+    for pre in tables:
+        columns.update(tables[pre])
+    nmerged = max(new_target.max() + 1 - ngraph, 0) if new_target.size > 0 else 0
+    merged = get_merged_graphs(columns, old_target, ngraph, nmerged, snap_ints[:-1])
+
+    # ===================== Get the new generation =====================
+
+    new = {}
+    for pre in data:
+
+        prev_graph, prev_local, _ = prev[pre]
+        prev_target = np.where(prev_graph >= 0, old_target[prev_graph], -1)
+
+        # Get the ID of each previous halo in a merged graph
+        okinds = prev_target >= ngraph
+        prev_local = prev_local.copy()
+        prev_local[okinds] = merged[pre]['inv'][merged[pre]['inv_start'][prev_target[okinds] - ngraph]
+                                                + merged[pre]['offset'][prev_graph[okinds]] + prev_local[okinds]]
+
+        base = {'nhalos': np.concatenate([tables[pre][pre + 'nhalos_in_graph'],
+                                          [len(g['nparts']) for g in merged[pre]['graphs']]]).astype(np.int64)}
+        for link in ['prog', 'desc']:
+            base['n' + link + '_links'] = np.concatenate([tables[pre][pre + 'graph_n' + link + '_links'],
+                                                          [len(g['direct_' + link + '_ids'])
+                                                           for g in merged[pre]['graphs']]]).astype(np.int64)
+
+        if pre == '':
+            halos = np.where(new_target >= 0)[0]
+            new[pre] = get_new_generation(halos, new_target[halos], prev_target, prev_local, base, data[pre],
+                                          prev_snap, new_snap)
+            new[pre][0]['halo_catalog_halo_ids'] = new[pre][0]['halo_ids']
+            continue
+
+        # Subhalos join the graph of their host if they are real or descend from a subhalo in it
+        host_nodes = new[''][0]
+        host_target = np.full(len(data['']['nparts'][new_snap]), -1, dtype=np.int64)
+        host_target[host_nodes['halo_ids']] = host_nodes['target']
+        host_local = np.zeros(host_target.size, dtype=np.int64)
+        host_local[host_nodes['halo_ids']] = host_nodes['local']
+        host_ind = np.zeros(host_target.size, dtype=np.int64)
+        host_ind[host_nodes['halo_ids']] = np.arange(host_nodes['halo_ids'].size)
+
+        sub_hosts = np.asarray(data[pre]['hosts'][new_snap], dtype=np.int64)
+        sub_target = host_target[sub_hosts]
+        sub_reals = np.asarray(cache.read(treepath + 'SubMgraph_' + new_snap + '.hdf5', 'real_flag'), dtype=bool)
+
+        subs, progs = utilities.get_link_edges(data[pre]['prog_start_index'][new_snap],
+                                               data[pre]['nprogs'][new_snap], data[pre]['progs'][new_snap])
+        linked = np.zeros(sub_target.size, dtype=bool)
+        linked[subs[(prev_target[progs] == sub_target[subs]) & (sub_target[subs] >= 0)]] = True
+
+        subs = np.where((sub_target >= 0) & (sub_reals | linked))[0]
+        new[pre] = get_new_generation(subs, sub_target[subs], prev_target, prev_local, base, data[pre],
+                                      prev_snap, new_snap, sort_key=host_local[sub_hosts[subs]])
+        sub_nodes = new[pre][0]
+        sub_nodes['subhalo_catalog_halo_ids'] = sub_nodes['halo_ids']
+        sub_nodes['host_halos'] = host_local[sub_hosts[sub_nodes['halo_ids']]]
+
+        # Point the new hosts at their subhalos, subhalos are sorted by host within each graph
+        host_nodes['subhalo_start_index'], host_nodes['nsubhalos'] = get_subhalo_pointers(
+            host_ind[sub_hosts[sub_nodes['halo_ids']]], host_nodes['halo_ids'].size, sub_nodes['local'])
+
+    # ===================== Write the updated graphs =====================
+
+    for pre in data:
+
+        nodes, progs, descs = new[pre]
+        tables_pre = tables[pre]
+        _, _, prev_pos = prev[pre]
+
+        # Rewrite the descendants of the final generation of existing graphs in place (except for
+        # merged graphs which are rewritten in full), graphs not reaching the new snapshot have none
+        okinds = (prev_pos >= 0) & ~np.isin(prev[pre][0], np.where(old_target >= ngraph)[0])
+        ndesc = np.zeros(prev_pos.size, dtype=np.int64)
+        desc_start = np.full(prev_pos.size, NO_DATA, dtype=np.int64)
+        ndesc[descs['halo_ids']] = descs['ndesc']
+        desc_start[descs['halo_ids']] = descs['desc_start_index']
+        sinds = np.argsort(prev_pos[okinds])
+        if sinds.size > 0:
+            hdf[pre + 'ndesc'][prev_pos[okinds][sinds]] = ndesc[okinds][sinds]
+            hdf[pre + 'desc_start_index'][prev_pos[okinds][sinds]] = desc_start[okinds][sinds]
+
+        # Add the new generation to the generation tables
+        gen_start = np.full(ngraph, NO_DATA, dtype=np.int64)
+        gen_len = np.bincount(nodes['target'], minlength=ngraph + nmerged)[:ngraph]
+        gen_start[gen_len > 0] = tables_pre[pre + 'nhalos_in_graph'][gen_len > 0]
+        for key, col in [('generation_start_index', gen_start),
+                         ('generation_length', np.where(gen_len > 0, gen_len, NO_DATA)),
+                         ('generation_id', np.where(gen_len > 0, nsnap - 1, NO_DATA))]:
+            hdf[pre + key].resize(nsnap, axis=1)
+            hdf[pre + key][:, nsnap - 1] = col
+
+        # The new generation holds the roots of each extended graph
+        extended = np.where(old_target == np.arange(ngraph))[0]
+        root_nparts = np.zeros(ngraph, dtype=np.int64)
+        okinds = nodes['target'] < ngraph
+        np.maximum.at(root_nparts, nodes['target'][okinds], nodes['nparts'][okinds])
+        tables_pre[pre + 'root_nparts'][extended] = root_nparts[extended]
+        tables_pre[pre + 'graph_lengths'][gen_len > 0] += 1
+
+        append_extensions(hdf, tables_pre, pre, nodes, progs, descs, ngraph)
+
+        for key in ['nhalos_in_graph', 'graph_nprog_links', 'graph_ndesc_links', 'graph_lengths', 'root_nparts',
+                    'graph_extension_index']:
+            hdf[pre + key][...] = tables_pre[pre + key]
+
+        # ===================== Write the merged graphs =====================
+
+        if nmerged == 0:
+            continue
+
+        graphs = merged[pre]['graphs']
+        for link, link_dict in [('prog', progs), ('desc', descs)]:
+            bounds = np.searchsorted(link_dict['target'], ngraph + np.arange(nmerged + 1))
+            nlink = link_dict['n' + link]
+            link_bounds = np.concatenate([[0], np.cumsum(nlink)])[bounds]
+            for ind, graph in enumerate(graphs):
+                halo_inds = np.arange(bounds[ind], bounds[ind + 1])
+                if link == 'desc':
+                    local = merged[pre]['inv'][merged[pre]['inv_start'][ind]
+                                               + merged[pre]['offset'][prev[pre][0][link_dict['halo_ids'][halo_inds]]]
+                                               + prev[pre][1][link_dict['halo_ids'][halo_inds]]]
+                    graph['ndesc'][local] = link_dict['ndesc'][halo_inds]
+                    graph['desc_start_index'][local] = link_dict['desc_start_index'][halo_inds]
+                for key in ['direct_' + link + '_ids', 'direct_' + link + '_contribution']:
+                    graph[key] = np.concatenate([graph[key],
+                                                 link_dict[key][link_bounds[ind]: link_bounds[ind + 1]]])
+
+        bounds = np.searchsorted(nodes['target'], ngraph + np.arange(nmerged + 1))
+        for ind, graph in enumerate(graphs):
+            for key in LEVEL_KEYS[pre]:
+                graph[key] = np.concatenate([graph[key], np.asarray(nodes[key][bounds[ind]: bounds[ind + 1]],
+                                                                    dtype=graph[key].dtype)])
+
+        merged_columns = {get_file_key(pre, key): np.concatenate([graph[key] for graph in graphs])
+                          for key in LEVEL_KEYS[pre]}
+        merged_columns.update({pre + key: np.concatenate([graph[key] for graph in graphs])
+                               for key in graph_io.PROG_KEYS + graph_io.DESC_KEYS})
+
+        nhalos = np.array([len(graph['nparts']) for graph in graphs], dtype=np.int64)
+        nprog_links = np.array([len(graph['direct_prog_ids']) for graph in graphs], dtype=np.int64)
+        ndesc_links = np.array([len(graph['direct_desc_ids']) for graph in graphs], dtype=np.int64)
+        gen_tables = [get_generation_tables(graph['snapshots'], snap_ints) for graph in graphs]
+        root_nparts = np.array([np.max(graph['nparts'][graph['snapshots'] == snap_ints[-1]], initial=0)
+                                for graph in graphs], dtype=np.int64)
+
+        starts = {}
+        for key, arr in merged_columns.items():
+            starts[key] = graph_io.append_dataset(hdf, key, arr)
+
+        graph_columns = {'graph_start_index': starts[get_file_key(pre, 'nparts')] + np.cumsum(nhalos) - nhalos,
+                         'nhalos_in_graph': nhalos,
+                         'graph_prog_start_index': starts[pre + 'direct_prog_ids'] + np.cumsum(nprog_links) - nprog_links,
+                         'graph_nprog_links': nprog_links,
+                         'graph_desc_start_index': starts[pre + 'direct_desc_ids'] + np.cumsum(ndesc_links) - ndesc_links,
+                         'graph_ndesc_links': ndesc_links,
+                         'graph_lengths': np.array([np.sum(gen[1] != NO_DATA) for gen in gen_tables]),
+                         'root_nparts': root_nparts,
+                         'generation_start_index': np.array([gen[0] for gen in gen_tables]),
+                         'generation_length': np.array([gen[1] for gen in gen_tables]),
+                         'generation_id': np.array([gen[2] for gen in gen_tables]),
+                         'graph_extension_index': np.full(nmerged, NO_DATA, dtype=np.int64)}
+        for key, arr in graph_columns.items():
+            graph_io.append_dataset(hdf, pre + key, arr)
+
+    # Flag the graphs replaced by merged graphs and the merged graphs themselves
+    superseded[old_target >= ngraph] = True
+    hdf['superseded'][...] = superseded
+    graph_io.append_dataset(hdf, 'superseded', np.zeros(nmerged, dtype=bool))
+
+    # Order the graphs still in use by root mass
+    superseded = hdf['superseded'][...]
+    root_nparts = hdf['root_nparts'][...]
+    in_use = np.where(~superseded)[0]
+    root_mass_index = in_use[graph_io.get_root_mass_index(root_nparts[in_use])]
+    hdf['root_mass_index'].resize(root_mass_index.shape)
+    hdf['root_mass_index'][...] = root_mass_index
+
+    hdf.close()
+    cache.close()
@@ -1,10 +1,15 @@
 import yaml
+import os
+from collections import OrderedDict
+from collections.abc import Mapping
 import readgadgetdata
 import h5py
 import time
 import networkx
 from networkx.algorithms.components.connected import connected_components
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as sparse_connected_components
 
 
 def read_param(paramfile):
@@ -210,32 +215,53 @@ def halo_energy_calc_exact(halo_poss, halo_vels, halo_npart, pmass, redshift, G,
     return halo_energy, KE, GE
 
 
-def wrap_halo(halo_poss, boxsize, domean=False):
+def periodic_centre(halo_poss, boxsize):
+    """ A function to centre a halo's particles in a periodic box. The centre is first estimated with
+    the circular mean (treating each coordinate as an angle around the box) so no assumption is made
+    about which side of the boundary the halo sits on. Particles are then placed at their nearest
+    periodic image to this estimate and the centre is refined to their mean.
 
-    # Define the comparison particle as the maximum position in the current dimension
-    max_part_pos = halo_poss.max(axis=0)
+    :param halo_poss: The positions of the halo's particles (left unchanged).
+    :param boxsize: The length of the box along one axis.
+    :return: centred_poss: The particle positions relative to the centre.
+             cent: The centre of the halo (inside the box).
+    """
 
-    # Compute all the halo particle separations from the maximum position
-    sep = max_part_pos - halo_poss
+    # Estimate the centre from the mean direction of the positions as angles
+    theta = halo_poss * (2 * np.pi / boxsize)
+    angle = np.arctan2(np.sin(theta).mean(axis=0), np.cos(theta).mean(axis=0))
+    cent = (angle % (2 * np.pi)) * (boxsize / (2 * np.pi))
 
-    # If any separations are greater than 50% the boxsize (i.e. the halo is split over the boundary)
-    # bring the particles at the lower boundary together with the particles at the upper boundary
-    # (ignores halos where constituent particles aren't separated by at least 50% of the boxsize)
-    # *** Note: fails if halo's extent is greater than 50% of the boxsize in any dimension ***
-    halo_poss[np.where(sep > 0.5 * boxsize)] += boxsize
+    # Get the nearest periodic image of each particle to the estimate
+    centred_poss = halo_poss - cent
+    centred_poss -= boxsize * np.round(centred_poss / boxsize)
 
-    if domean:
-        # Compute the shifted mean position in the dimension ixyz
-        mean_halo_pos = halo_poss.mean(axis=0)
+    # Refine the centre to the mean position
+    offset = centred_poss.mean(axis=0)
+    centred_poss -= offset
+    cent = (cent + offset) % boxsize
 
-        # Centre the halos about the mean in the dimension ixyz
-        halo_poss -= mean_halo_pos
+    return centred_poss, cent
+
+
+def wrap_halo(halo_poss, boxsize, domean=False):
+    """ A function to bring the particles of a halo split over the box boundary together.
+
+    :param halo_poss: The positions of the halo's particles (left unchanged).
+    :param boxsize: The length of the box along one axis.
+    :param domean: Whether to return the positions centred on the halo along with the centre.
+    :return: The wrapped positions (and centre if domean), see periodic_centre.
+    """
+
+    centred_poss, cent = periodic_centre(halo_poss, boxsize)
+
+    if domean:
 
-        return halo_poss, mean_halo_pos
+        return centred_poss, cent
 
     else:
 
-        return halo_poss
+        return centred_poss + cent
 
 
 def halo_energy_calc_approx(halo_poss, halo_vels, halo_npart, pmass, redshift, G, h, soft):
@@ -466,3 +492,574 @@ def get_linked_halo_data(all_linked_halos, start_ind, nlinked_halos):
     """
 
     return all_linked_halos[start_ind: start_ind + nlinked_halos]
+
+
+def get_realness_paths(halopath, snap, density_rank):
+    """ A helper function returning the paths of the reality flag sidecar files for a snapshot.
+
+    The linking of a snapshot writes the halos of that snapshot found to not be real to
+    realness_<snap>.hdf5 and the halos of the descendant snapshot found to be real to
+    promotions_<desc_snap>.hdf5 (prefixed with sub for subhalos), leaving the halo catalog untouched.
+
+    :param halopath: The filepath to the halo finder HDF5 files.
+    :param snap: The snapshot ID.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :return: The demotion and promotion sidecar filepaths.
+    """
+
+    if density_rank == 0:
+        prefix = ''
+    else:
+        prefix = 'sub'
+
+    return (halopath + prefix + 'realness_' + snap + '.hdf5',
+            halopath + prefix + 'promotions_' + snap + '.hdf5')
+
+
+def read_real_flags(halopath, snap, density_rank=0, promotions=True, demotions=True):
+    """ A function to read the reality flags of a snapshot's halos, merging the catalog's
+    real_flag with any updates made by the linking stage in the sidecar files.
+
+    :param halopath: The filepath to the halo finder HDF5 files.
+    :param snap: The snapshot ID.
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param promotions: Whether to include halos found to be real by the linking of the progenitor snapshot.
+    :param demotions: Whether to remove halos found to not be real by the linking of this snapshot.
+    :return: The reality flag array.
+    """
+
+    hdf = h5py.File(halopath + 'halos_' + snap + '.hdf5', 'r')
+    if density_rank == 0:
+        reals = hdf['real_flag'][...]
+    else:
+        reals = hdf['Subhalos']['real_flag'][...]
+    hdf.close()
+
+    demotion_path, promotion_path = get_realness_paths(halopath, snap, density_rank)
+
+    if promotions and os.path.isfile(promotion_path):
+        hdf = h5py.File(promotion_path, 'r')
+        reals = np.logical_or(reals, hdf['promoted'][...])
+        hdf.close()
+
+    if demotions and os.path.isfile(demotion_path):
+        hdf = h5py.File(demotion_path, 'r')
+        reals = np.logical_and(reals, ~hdf['demoted'][...])
+        hdf.close()
+
+    return reals
+
+
+def write_real_flag_updates(halopath, snap, desc_snap, density_rank, demoted, promoted):
+    """ A function to write the reality flag updates found while linking a snapshot to the sidecar
+    files (see get_realness_paths).
+
+    :param halopath: The filepath to the halo finder HDF5 files.
+    :param snap: The snapshot ID.
+    :param desc_snap: The descendant snapshot ID (None if this is the final snapshot).
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :param demoted: Boolean array flagging the halos in this snapshot found to not be real.
+    :param promoted: Boolean array flagging the halos in the descendant snapshot found to be real.
+    :return: None
+    """
+
+    demotion_path, _ = get_realness_paths(halopath, snap, density_rank)
+
+    hdf = h5py.File(demotion_path, 'w')
+    hdf.create_dataset('demoted', shape=demoted.shape, dtype=bool, data=demoted, compression='gzip')
+    hdf.close()
+
+    if desc_snap != None:
+
+        _, promotion_path = get_realness_paths(halopath, desc_snap, density_rank)
+
+        hdf = h5py.File(promotion_path, 'w')
+        hdf.create_dataset('promoted', shape=promoted.shape, dtype=bool, data=promoted, compression='gzip')
+        hdf.close()
+
+
+def get_compact_dtype(arr):
+    """ A helper function returning the narrowest integer type able to hold every value in an array.
+
+    :param arr: The integer array.
+    :return: The numpy dtype (one of uint16, int16, int32 or int64).
+    """
+
+    if arr.size == 0:
+        return np.dtype(np.int32)
+
+    arr_min = arr.min()
+    arr_max = arr.max()
+
+    for dtype in (np.uint16, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if arr_min >= info.min and arr_max <= info.max:
+            return np.dtype(dtype)
+
+    return np.dtype(np.int64)
+
+
+def write_compact_dataset(hdf, key, arr, compress_threshold=2 ** 24):
+    """ A function to write an array using the narrowest integer type able to hold its values.
+    Only arrays larger than compress_threshold bytes are chunked and compressed, smaller arrays
+    are stored contiguously so they can be memory mapped by read_mapped_dataset.
+
+    :param hdf: The open HDF5 file or group to write to.
+    :param key: The name of the dataset.
+    :param arr: The array to write.
+    :param compress_threshold: The size in bytes above which the dataset is compressed.
+    :return: None
+    """
+
+    if arr.dtype != bool:
+        arr = arr.astype(get_compact_dtype(arr))
+
+    if arr.nbytes > compress_threshold:
+        hdf.create_dataset(key, shape=arr.shape, dtype=arr.dtype, data=arr, chunks=True, compression='gzip')
+    else:
+        hdf.create_dataset(key, shape=arr.shape, dtype=arr.dtype, data=arr)
+
+
+def read_mapped_dataset(dset):
+    """ A function to read a dataset, memory mapping it from the file if it is stored contiguously
+    without compression (see write_compact_dataset) and reading it into memory otherwise.
+
+    :param dset: The HDF5 dataset.
+    :return: The array (a read only numpy memmap if the dataset could be mapped).
+    """
+
+    # Chunked, compressed or empty datasets cannot be mapped
+    offset = dset.id.get_offset()
+    if dset.chunks is not None or offset is None or dset.size == 0:
+        return dset[...]
+
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+
+
+def get_part_haloids_key(level):
+    """ A helper function returning the name of the dataset holding the halo ID of every particle at a
+    level of the halo catalogue.
+
+    :param level: 0 for host halos, 1 for subhalos and 2 or more for deeper levels of substructure.
+    :return: The dataset name.
+    """
+
+    if level == 0:
+        return 'host_halo_IDs'
+    elif level == 1:
+        return 'subhalo_IDs'
+    else:
+        return 'subhalo_IDs_' + str(level)
+
+
+def write_part_haloids(hdf, part_haloids, chunksize=2 ** 20):
+    """ A function to write the halo ID of every particle at each level of the halo catalogue as a
+    separate int32 dataset (-2 for particles not in a halo). The datasets are chunked along the
+    particle IDs and compressed with lzf so contiguous particle ID ranges are cheap to read.
+
+    :param hdf: The open HDF5 file or group to write to.
+    :param part_haloids: The (npart, nlevels) array of particle halo IDs, column 0 holding the host halos.
+    :param chunksize: The number of particles in each chunk.
+    :return: None
+    """
+
+    npart = part_haloids.shape[0]
+
+    for level in range(part_haloids.shape[1]):
+        if npart > 0:
+            hdf.create_dataset(get_part_haloids_key(level), data=part_haloids[:, level].astype(np.int32),
+                               chunks=(min(chunksize, npart),), compression='lzf')
+        else:
+            hdf.create_dataset(get_part_haloids_key(level), shape=(0,), dtype=np.int32)
+
+
+def read_part_haloids(hdf, level, low=None, high=None):
+    """ A function to read the halo ID of every particle in a contiguous particle ID range at a level of
+    the halo catalogue. Only the level's dataset is read, catalogues written before the levels were
+    split fall back to the level's column of "particle_halo_IDs" (or "Halo_IDs" for the serial finder).
+
+    :param hdf: The open halo catalogue HDF5 file.
+    :param level: 0 for host halos, 1 for subhalos and 2 or more for deeper levels of substructure.
+    :param low: The first particle ID of the range (the first particle if None).
+    :param high: The particle ID after the end of the range (the last particle if None).
+    :return: The halo ID of each particle in the range (-2 for particles not in a halo).
+    """
+
+    key = get_part_haloids_key(level)
+    if key in hdf:
+        return hdf[key][low:high]
+
+    if 'Halo_IDs' in hdf:
+        return hdf['Halo_IDs'][low:high, level]
+
+    return hdf['particle_halo_IDs'][low:high, level]
+
+
+def read_part_haloids_npart(hdf):
+    """ A helper function returning the number of particles in a halo catalogue's particle halo IDs.
+
+    :param hdf: The open halo catalogue HDF5 file.
+    :return: The number of particles.
+    """
+
+    if 'host_halo_IDs' in hdf:
+        return hdf['host_halo_IDs'].shape[0]
+
+    if 'Halo_IDs' in hdf:
+        return hdf['Halo_IDs'].shape[0]
+
+    return hdf['particle_halo_IDs'].shape[0]
+
+
+def get_link_edges(start_index, nlinks, links):
+    """ A function to expand the linked halo data of a snapshot stored as start index and number of
+    links arrays (see get_linked_halo_data) into a (halo, linked halo) pair for every link.
+
+    :param start_index: The start index of each halo's links in the links array.
+    :param nlinks: The number of links each halo has (values < 1 are treated as no links).
+    :param links: The array containing the linked halo IDs of all halos.
+    :return: The halo ID and linked halo ID of each link.
+    """
+
+    halos = np.where(nlinks > 0)[0]
+    n = nlinks[halos].astype(np.int64)
+
+    # Get the position of each link in the links array
+    first = np.cumsum(n) - n
+    pos = np.repeat(start_index[halos].astype(np.int64) - first, n) + np.arange(np.sum(n), dtype=np.int64)
+
+    return np.repeat(halos, n), np.asarray(links[pos], dtype=np.int64)
+
+
+def get_graph_components(snaplist, data_dict):
+    """ A function to label every halo in the simulation with the graph it belongs to. Each
+    (snapshot, halo) is given a global node ID, the progenitor and descendant links are used to
+    build a sparse adjacency matrix and the graphs are found as its connected components.
+
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param data_dict: The data dictionary containing the 'progs', 'descs', 'nprogs', 'ndescs',
+                      'prog_start_index', 'desc_start_index' and 'nparts' dictionaries keyed by snapshot.
+    :return: The graph label of each node and a dictionary of each snapshot's first global node ID.
+    """
+
+    # Assign each snapshot's halos a contiguous range of global node IDs
+    offsets = {}
+    nnodes = 0
+    for snap in snaplist:
+        offsets[snap] = nnodes
+        nnodes += len(data_dict['nparts'][snap])
+
+    rows = [np.array([], dtype=np.int64)]
+    cols = [np.array([], dtype=np.int64)]
+    for ind, snap in enumerate(snaplist):
+
+        if ind - 1 >= 0:
+            prog_snap = snaplist[ind - 1]
+            halos, linked = get_link_edges(data_dict['prog_start_index'][snap], data_dict['nprogs'][snap],
+                                           data_dict['progs'][snap])
+            rows.append(halos + offsets[snap])
+            cols.append(linked + offsets[prog_snap])
+
+        if ind + 1 < len(snaplist):
+            desc_snap = snaplist[ind + 1]
+            halos, linked = get_link_edges(data_dict['desc_start_index'][snap], data_dict['ndescs'][snap],
+                                           data_dict['descs'][snap])
+            rows.append(halos + offsets[snap])
+            cols.append(linked + offsets[desc_snap])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    adjacency = coo_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)), shape=(nnodes, nnodes))
+    _, labels = sparse_connected_components(adjacency, directed=False)
+
+    return labels, offsets
+
+
+def get_component_graphs(root_groups, root_snap, labels, offsets, snaplist, data_dict):
+    """ A function to build the graph and mass dictionaries (in the form produced by walking the
+    graph from its roots) for the graph containing each group of root halos. A group's graph holds
+    every halo connected to any of its roots, groups resulting in the same graph are only returned once.
+
+    :param root_groups: A list of lists of root halo IDs.
+    :param root_snap: The snapshot ID containing the roots.
+    :param labels: The graph label of each node from get_graph_components.
+    :param offsets: The first global node ID of each snapshot from get_graph_components.
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param data_dict: The data dictionary containing the 'nparts' dictionary keyed by snapshot.
+    :return: A list of (graph_dict, mass_dict) tuples.
+    """
+
+    # Sort the nodes by label, each graph's nodes are then contiguous and in ascending node ID order
+    sinds = np.argsort(labels, kind='stable')
+    label_start = np.searchsorted(labels[sinds], np.arange(labels.max() + 2 if labels.size > 0 else 1))
+    snap_offsets = np.array([offsets[snap] for snap in snaplist] + [labels.size])
+
+    graphs = []
+    done = set()
+    for roots in root_groups:
+
+        comps = tuple(np.unique(labels[offsets[root_snap] + np.asarray(roots, dtype=np.int64)]))
+
+        if comps in done:
+            continue
+        done.add(comps)
+
+        nodes = np.concatenate([sinds[label_start[c]: label_start[c + 1]] for c in comps])
+        if len(comps) > 1:
+            nodes = np.sort(nodes)
+
+        # Split the nodes into snapshots
+        bounds = np.searchsorted(nodes, snap_offsets)
+
+        graph_dict = {}
+        mass_dict = {}
+        for ind, snap in enumerate(snaplist):
+
+            if bounds[ind] == bounds[ind + 1]:
+                graph_dict[snap] = np.array([])
+                mass_dict[snap] = np.array([])
+                continue
+
+            halos = nodes[bounds[ind]: bounds[ind + 1]] - offsets[snap]
+            masses = data_dict['nparts'][snap][halos]
+
+            # Sort by mass
+            msinds = np.argsort(masses)[::-1]
+            graph_dict[snap] = halos[msinds]
+            mass_dict[snap] = masses[msinds]
+
+        graphs.append((graph_dict, mass_dict))
+
+    return graphs
+
+
+def assign_graphs(roots, root_snap, labels, offsets, nranks):
+    """ A function to group root halos by the graph they belong to and distribute the graphs
+    across ranks. Graphs are assigned largest first to the least loaded rank where the cost of
+    a graph is its number of halos.
+
+    :param roots: The root halo IDs.
+    :param root_snap: The snapshot ID containing the roots.
+    :param labels: The graph label of each node from get_graph_components.
+    :param offsets: The first global node ID of each snapshot from get_graph_components.
+    :param nranks: The number of ranks to distribute the graphs over.
+    :return: A list containing the list of root groups (one per graph) for each rank
+             and the number of halos assigned to each rank.
+    """
+
+    # Group the roots by graph
+    root_labels = labels[offsets[root_snap] + np.asarray(roots, dtype=np.int64)]
+    sinds = np.argsort(root_labels, kind='stable')
+    comps, starts = np.unique(root_labels[sinds], return_index=True)
+    root_groups = np.split(np.asarray(roots)[sinds], starts[1:]) if comps.size > 0 else []
+
+    # Get the cost of each graph and distribute them
+    costs = np.bincount(labels)[comps]
+    rank_inds, load = assign_costs(costs, nranks)
+    rank_groups = [[root_groups[ind] for ind in inds] for inds in rank_inds]
+
+    return rank_groups, load
+
+
+def assign_costs(costs, nbins):
+    """ A function to distribute items across bins (ranks or processes) balancing the total cost of
+    each bin. Items are assigned most expensive first to the least loaded bin.
+
+    :param costs: The cost of each item.
+    :param nbins: The number of bins to distribute the items over.
+    :return: A list containing the indices of the items assigned to each bin (in the order they
+             were assigned) and the total cost of each bin.
+    """
+
+    load = np.zeros(nbins, dtype=np.int64)
+    bin_inds = [[] for i in range(nbins)]
+    for ind in np.argsort(costs, kind='stable')[::-1]:
+        i = np.argmin(load)
+        load[i] += costs[ind]
+        bin_inds[i].append(ind)
+
+    return bin_inds, load
+
+
+def get_main_branches(treepath, snaplist, density_rank=0):
+    """ A function to walk the main branch of every real halo in the final snapshot at once. The
+    links are sorted by contribution so the main progenitor of a halo is its first progenitor, every
+    branch is advanced a snapshot at a time with array indexing.
+
+    :param treepath: The filepath of the direct progenitor and descendant (Mgraph) files.
+    :param snaplist: The list of snapshot IDs in ascending time order (past to present).
+    :param density_rank: 0 for host halos, 1 for subhalos.
+    :return: The root halo IDs, the main branch length of each root (the number of main progenitor
+             steps), the mass (number of particles) of the main branch halo in each snapshot
+             (0 before the branch starts) and the index in snaplist of the most recent main
+             branch halo with more than one progenitor (-1 for branches without a merger).
+    """
+
+    if density_rank == 0:
+        paths = [treepath + 'Mgraph_' + snap + '.hdf5' for snap in snaplist]
+    else:
+        paths = [treepath + 'SubMgraph_' + snap + '.hdf5' for snap in snaplist]
+
+    hdf = h5py.File(paths[-1], 'r')
+    roots = hdf['halo_IDs'][...][hdf['real_flag'][...]]
+    hdf.close()
+
+    lengths = np.zeros(roots.size, dtype=np.int64)
+    mass_history = np.zeros((roots.size, len(snaplist)), dtype=np.int64)
+    last_merger = np.full(roots.size, -1, dtype=np.int64)
+
+    # Walk from the present to the past, only branches with a progenitor continue
+    current = roots.astype(np.int64)
+    alive = np.ones(roots.size, dtype=bool)
+    for ind in range(len(snaplist) - 1, -1, -1):
+
+        hdf = h5py.File(paths[ind], 'r')
+
+        halos = current[alive]
+        mass_history[alive, ind] = read_mapped_dataset(hdf['nparts'])[halos]
+        nprogs = read_mapped_dataset(hdf['nProgs'])[halos]
+
+        # Record the most recent merger of each branch
+        mergers = np.where(alive)[0][nprogs > 1]
+        mergers = mergers[last_merger[mergers] < 0]
+        last_merger[mergers] = ind
+
+        # Step to the main progenitor
+        okinds = nprogs > 0
+        next_halos = read_mapped_dataset(hdf['Prog_haloIDs'])[
+            read_mapped_dataset(hdf['prog_start_index'])[halos[okinds]].astype(np.int64)]
+
+        hdf.close()
+
+        alive_inds = np.where(alive)[0]
+        alive[alive_inds[~okinds]] = False
+        current[alive_inds[okinds]] = next_halos
+        lengths[alive_inds[okinds]] += 1
+
+        if not alive.any():
+            break
+
+    return roots, lengths, mass_history, last_merger
+
+
+class SnapshotCache:
+    """ A least recently used cache of datasets read from HDF5 files. Each file is opened once,
+    datasets are memory mapped where possible (see read_mapped_dataset) and read into memory
+    otherwise. Only the in memory arrays count towards the byte limit of the cache.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: The maximum number of bytes held in memory by the cache.
+        """
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.files = {}
+        self.arrays = OrderedDict()
+
+    def get_file(self, path):
+        """ Get the open HDF5 file at path, opening it if it has not been opened yet. """
+
+        if path not in self.files:
+            self.files[path] = h5py.File(path, 'r')
+
+        return self.files[path]
+
+    def read(self, path, key):
+        """ Get the dataset key from the HDF5 file at path, reading it if it is not in the cache. """
+
+        if (path, key) in self.arrays:
+            self.arrays.move_to_end((path, key))
+            return self.arrays[(path, key)]
+
+        arr = read_mapped_dataset(self.get_file(path)[key])
+        nbytes = 0 if isinstance(arr, np.memmap) else arr.nbytes
+
+        # Evict the least recently used arrays until this array fits
+        while len(self.arrays) > 0 and self.nbytes + nbytes > self.max_bytes:
+            _, old = self.arrays.popitem(last=False)
+            self.nbytes -= 0 if isinstance(old, np.memmap) else old.nbytes
+
+        self.arrays[(path, key)] = arr
+        self.nbytes += nbytes
+
+        return arr
+
+    def close(self):
+        """ Empty the cache and close all open files. """
+
+        self.arrays.clear()
+        self.nbytes = 0
+        for hdf in self.files.values():
+            hdf.close()
+        self.files = {}
+
+
+class LazySnapshotDict(Mapping):
+    """ A read only dictionary keyed by snapshot ID whose values are a dataset from each snapshot's
+    file, read through a SnapshotCache when they are first accessed.
+    """
+
+    def __init__(self, cache, paths, key):
+        """
+        :param cache: The SnapshotCache to read through.
+        :param paths: A dictionary of the file path for each snapshot ID.
+        :param key: The dataset key within each file.
+        """
+
+        self.cache = cache
+        self.paths = paths
+        self.key = key
+
+    def __getitem__(self, snap):
+        return self.cache.read(self.paths[snap], self.key)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def get_graph_data(cache, treepath, halopath, snaplist, sub=False):
+    """ A function to set up the data dictionary used to build and write graphs. The linking data
+    and halo properties of each snapshot are only read when they are accessed.
+
+    :param cache: The SnapshotCache to read through.
+    :param treepath: The filepath of the direct progenitor and descendant (Mgraph) files.
+    :param halopath: The filepath of the halo catalogues.
+    :param snaplist: The list of snapshot IDs.
+    :param sub: Flag for subhalo graph data.
+    :return: The data dictionary.
+    """
+
+    if sub:
+        graph_paths = {snap: treepath + 'SubMgraph_' + snap + '.hdf5' for snap in snaplist}
+        prop_prefix = 'Subhalos/'
+    else:
+        graph_paths = {snap: treepath + 'Mgraph_' + snap + '.hdf5' for snap in snaplist}
+        prop_prefix = ''
+    halo_paths = {snap: halopath + 'halos_' + str(snap) + '.hdf5' for snap in snaplist}
+
+    graph_keys = {'progs': 'Prog_haloIDs', 'descs': 'Desc_haloIDs', 'nprogs': 'nProgs', 'ndescs': 'nDescs',
+                  'prog_start_index': 'prog_start_index', 'desc_start_index': 'desc_start_index',
+                  'nparts': 'nparts', 'prog_conts': 'Prog_Mass_Contribution',
+                  'desc_conts': 'Desc_Mass_Contribution'}
+    prop_keys = {'mean_pos': 'mean_positions', 'mean_vel': 'mean_velocities', 'rms_rad': 'rms_spatial_radius',
+                 'vdisp': '3D_velocity_dispersion', 'vmax': 'v_max', 'hmrs': 'half_mass_radius',
+                 'hmvrs': 'half_mass_velocity_radius'}
+
+    data_dict = {}
+    for name, key in graph_keys.items():
+        data_dict[name] = LazySnapshotDict(cache, graph_paths, key)
+    for name, key in prop_keys.items():
+        data_dict[name] = LazySnapshotDict(cache, halo_paths, prop_prefix + key)
+    data_dict['hosts'] = LazySnapshotDict(cache, halo_paths, 'Subhalos/host_IDs')
+
+    # The header attributes are small so are read now
+    data_dict['redshift'] = {snap: cache.get_file(halo_paths[snap]).attrs['redshift'] for snap in snaplist}
+    data_dict['pmass'] = cache.get_file(halo_paths[snaplist[0]]).attrs['part_mass'] if len(snaplist) > 0 else 0
+
+    return data_dict
@@ -18,6 +18,8 @@ PARM_DIR="./params"
 
 i=$(($SLURM_ARRAY_TASK_ID - 1))
 
+# Each invocation processes snapshot $i, stages working across every snapshot (the windowed linking
+# and splitting halos into tree halos) only run in the final invocation
 for i in {0..61}
 do
     echo "$i"
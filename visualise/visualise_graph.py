@@ -1,10 +1,10 @@
 import numpy as np
-import h5py
 import sys
 sys.path.insert(1, "/Users/willroper/Documents/University/Merger_Trees_to_Merger_Graphs/mega/core")
 import matplotlib.pyplot as plt
 import matplotlib
 import utilities
+import graph_io
 import networkx as nx
 
 
@@ -13,10 +13,10 @@ paramfile = sys.argv[1]
 inputs, flags, params = utilities.read_param(paramfile)
 
 # Open Graph file
-hdf = h5py.File(inputs['graphSavePath'] + ".hdf5", "r")
+columns, header = graph_io.read_graph_file(inputs['graphSavePath'])
 
 if sys.argv[2] == "All":
-    graphs = list(hdf.keys())
+    graphs = [str(g) for g in columns['root_mass_index']]
 else:
     graphs = [sys.argv[2], ]
 
@@ -31,19 +31,21 @@ for g in graphs:
     rs = []
     nodes = []
 
-    halo_ids = hdf[g]["graph_halo_ids"][...]
-    nprogs = hdf[g]["nprog"][...]
-    ndescs = hdf[g]["ndesc"][...]
-    prog_sind = hdf[g]["prog_start_index"][...]
-    desc_sind = hdf[g]["desc_start_index"][...]
-    progs = hdf[g]["direct_prog_ids"][...]
-    descs = hdf[g]["direct_desc_ids"][...]
-    nparts = hdf[g]["nparts"][...]
-    snapshots = hdf[g]["snapshots"][...]
-    mean_pos = hdf[g]['mean_pos'][...]
-    zs = hdf[g]["redshifts"][...]
-    pmass = hdf["Header"].attrs["part_mass"]
-    rms_rads = hdf[g]['rms_radius'][...]
+    graph = graph_io.get_graph_view(columns, int(g))
+
+    halo_ids = np.arange(graph["nhalos_in_graph"])
+    nprogs = graph["nprog"]
+    ndescs = graph["ndesc"]
+    prog_sind = graph["prog_start_index"]
+    desc_sind = graph["desc_start_index"]
+    progs = graph["direct_prog_ids"]
+    descs = graph["direct_desc_ids"]
+    nparts = graph["nparts"]
+    snapshots = graph["snapshots"]
+    mean_pos = graph['mean_pos']
+    zs = graph["redshifts"]
+    pmass = header["part_mass"]
+    rms_rads = graph['rms_radius']
 
     prev_snap = snapshots[0]
     snap_count = -1
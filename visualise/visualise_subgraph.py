@@ -1,9 +1,9 @@
 import numpy as np
-import h5py
 import sys
 sys.path.insert(1, "/Users/willroper/Documents/University/Merger_Trees_to_Merger_Graphs/mega/core")
 import matplotlib.pyplot as plt
 import utilities
+import graph_io
 import networkx as nx
 
 
@@ -12,10 +12,10 @@ paramfile = sys.argv[1]
 inputs, flags, params = utilities.read_param(paramfile)
 
 # Open Graph file
-hdf = h5py.File(inputs['graphSavePath'] + ".hdf5", "r")
+columns, header = graph_io.read_graph_file(inputs['graphSavePath'])
 
 if sys.argv[2] == "All":
-    graphs = list(hdf.keys())
+    graphs = [str(g) for g in columns['root_mass_index']]
 else:
     graphs = [sys.argv[2], ]
 
@@ -28,23 +28,25 @@ for g in graphs:
     edges = set()
     sizes = []
     nodes = []
-    try:
-        halo_ids = hdf[g]["sub_graph_halo_ids"][...]
-        nprogs = hdf[g]["sub_nprog"][...]
-        ndescs = hdf[g]["sub_ndesc"][...]
-        prog_sind = hdf[g]["sub_prog_start_index"][...]
-        desc_sind = hdf[g]["sub_desc_start_index"][...]
-        progs = hdf[g]["sub_direct_prog_ids"][...]
-        descs = hdf[g]["sub_direct_desc_ids"][...]
-        nparts = hdf[g]["sub_nparts"][...]
-        snapshots = hdf[g]["sub_snapshots"][...]
-        mean_pos = hdf[g]['sub_mean_pos'][...]
-        zs = hdf[g]["sub_redshifts"][...]
-        pmass = hdf["Header"].attrs["part_mass"]
-    except KeyError:
+    graph = graph_io.get_graph_view(columns, int(g), sub=True)
+
+    if graph["nhalos_in_graph"] == 0:
         print("There are no Subhalos in this graph")
         continue
 
+    halo_ids = np.arange(graph["nhalos_in_graph"])
+    nprogs = graph["nprog"]
+    ndescs = graph["ndesc"]
+    prog_sind = graph["prog_start_index"]
+    desc_sind = graph["desc_start_index"]
+    progs = graph["direct_prog_ids"]
+    descs = graph["direct_desc_ids"]
+    nparts = graph["nparts"]
+    snapshots = graph["snapshots"]
+    mean_pos = graph['mean_pos']
+    zs = graph["redshifts"]
+    pmass = header["part_mass"]
+
     prev_snap = snapshots[0]
     snap_count = -1
 